@@ -6,15 +6,18 @@ from flask import Flask
 app = Flask(__name__)
 
 import minion.backend.views.base
+import minion.backend.views.campaigns
 import minion.backend.views.groups
 import minion.backend.views.invites
 import minion.backend.views.reports
 import minion.backend.views.users
 import minion.backend.views.scans
+import minion.backend.views.schedules
 import minion.backend.views.sites
 import minion.backend.views.plans
 import minion.backend.views.plugins
 import minion.backend.views.issues
+import minion.backend.views.metrics
 
 def configure_app(app, production=True, debug=False):
     app.debug = debug
@@ -0,0 +1,142 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import logging
+import threading
+import time
+
+from pymongo import MongoClient
+
+# Upper bounds in seconds of the request latency histogram buckets
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+logger = logging.getLogger(__name__)
+
+# The statistics of the request that is being handled by this thread
+_local = threading.local()
+
+class InstrumentedMongoClient(MongoClient):
+
+    """
+    A MongoClient that counts and times the round trips to the database
+    made while handling a request. Every query, getmore, write and command
+    goes through one of these two methods.
+    """
+
+    def _timed(self, send, *args, **kwargs):
+        stats = getattr(_local, 'stats', None)
+        if stats is None:
+            return send(*args, **kwargs)
+        start = time.time()
+        try:
+            return send(*args, **kwargs)
+        finally:
+            stats['mongo_operations'] += 1
+            stats['mongo_seconds'] += time.time() - start
+
+    def _send_message(self, *args, **kwargs):
+        return self._timed(super(InstrumentedMongoClient, self)._send_message, *args, **kwargs)
+
+    def _send_message_with_response(self, *args, **kwargs):
+        return self._timed(super(InstrumentedMongoClient, self)._send_message_with_response, *args, **kwargs)
+
+class MetricsMiddleware(object):
+
+    """
+    WSGI middleware that records for every request its latency, the number
+    of and the time spent in database operations and the size of the
+    response. A request is only done when its body has been sent, which
+    matters for streamed responses.
+
+    The numbers are added up per endpoint, method and status in the given
+    collection, so that they are the same for all processes serving the
+    API. Requests that take longer than slow_threshold seconds are logged.
+    The endpoint is taken from environ['minion.endpoint'], which the
+    application has to set.
+    """
+
+    def __init__(self, app, collection, slow_threshold=None):
+        self.app = app
+        self.collection = collection
+        self.slow_threshold = slow_threshold
+
+    def __call__(self, environ, start_response):
+        _local.stats = {'start': time.time(), 'mongo_operations': 0, 'mongo_seconds': 0.0, 'bytes': 0, 'status': None}
+        def _start_response(status, headers, exc_info=None):
+            _local.stats['status'] = status.split(' ', 1)[0]
+            return start_response(status, headers, exc_info)
+        try:
+            body = self.app(environ, _start_response)
+        except Exception:
+            self._finish(environ)
+            raise
+        return self._iterate(environ, body)
+
+    def _iterate(self, environ, body):
+        try:
+            for chunk in body:
+                _local.stats['bytes'] += len(chunk)
+                yield chunk
+        finally:
+            if hasattr(body, 'close'):
+                body.close()
+            self._finish(environ)
+
+    def _finish(self, environ):
+        stats = _local.stats
+        _local.stats = None
+        latency = time.time() - stats['start']
+        endpoint = environ.get('minion.endpoint') or 'unknown'
+        method = environ.get('REQUEST_METHOD')
+        status = stats['status'] or '500'
+        bucket = len(BUCKETS)
+        for i, bound in enumerate(BUCKETS):
+            if latency <= bound:
+                bucket = i
+                break
+        try:
+            self.collection.update({'endpoint': endpoint, 'method': method, 'status': status},
+                                   {'$inc': {'count': 1,
+                                             'buckets.%d' % bucket: 1,
+                                             'seconds': latency,
+                                             'mongo_operations': stats['mongo_operations'],
+                                             'mongo_seconds': stats['mongo_seconds'],
+                                             'bytes': stats['bytes']}},
+                                   upsert=True, w=0)
+        except Exception:
+            logger.exception("Unable to record metrics")
+        if self.slow_threshold is not None and latency > self.slow_threshold:
+            logger.warning("Slow request %s %s%s (%s): %.3fs, %d mongo operations in %.3fs, %d bytes"
+                           % (method, environ.get('PATH_INFO'),
+                              '?' + environ['QUERY_STRING'] if environ.get('QUERY_STRING') else '',
+                              endpoint, latency, stats['mongo_operations'], stats['mongo_seconds'], stats['bytes']))
+
+def render_metrics(collection):
+    """ Return the recorded metrics in the Prometheus text format. """
+    lines = []
+    def metric(name, kind, description):
+        lines.append("# HELP %s %s" % (name, description))
+        lines.append("# TYPE %s %s" % (name, kind))
+    docs = list(collection.find().sort([('endpoint', 1), ('method', 1), ('status', 1)]))
+    def labels(doc, **extra):
+        pairs = [('endpoint', doc['endpoint']), ('method', doc['method']), ('status', doc['status'])] + sorted(extra.items())
+        return ','.join('%s="%s"' % (k, v) for k, v in pairs)
+    metric('minion_http_request_duration_seconds', 'histogram', 'Time spent handling requests.')
+    for doc in docs:
+        buckets = doc.get('buckets', {})
+        count = 0
+        for i, bound in enumerate(BUCKETS):
+            count += buckets.get(str(i), 0)
+            lines.append('minion_http_request_duration_seconds_bucket{%s} %d' % (labels(doc, le=repr(bound)), count))
+        lines.append('minion_http_request_duration_seconds_bucket{%s} %d' % (labels(doc, le='+Inf'), doc['count']))
+        lines.append('minion_http_request_duration_seconds_sum{%s} %f' % (labels(doc), doc['seconds']))
+        lines.append('minion_http_request_duration_seconds_count{%s} %d' % (labels(doc), doc['count']))
+    for name, field, fmt, description in (
+            ('minion_mongo_operations_total', 'mongo_operations', '%d', 'Database operations made by requests.'),
+            ('minion_mongo_duration_seconds_total', 'mongo_seconds', '%f', 'Time spent in database operations by requests.'),
+            ('minion_http_response_bytes_total', 'bytes', '%d', 'Size of the response bodies.')):
+        metric(name, 'counter', description)
+        for doc in docs:
+            lines.append(('%s{%s} ' + fmt) % (name, labels(doc), doc[field]))
+    return '\n'.join(lines) + '\n'
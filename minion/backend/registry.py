@@ -0,0 +1,183 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import hashlib
+import importlib
+import inspect
+import json
+import logging
+import os
+import pkgutil
+
+import pkg_resources
+
+ENTRY_POINT_GROUP = 'minion.plugins'
+PLUGIN_PACKAGE = 'minion.plugins'
+BASE_CLASSES = ('AbstractPlugin', 'BlockingPlugin', 'ExternalProcessPlugin')
+DEFAULT_MANIFEST_PATH = '~/.minion/plugin-manifest.json'
+
+logger = logging.getLogger(__name__)
+
+
+def _describe(plugin_name, plugin_class):
+    return { 'class': plugin_name,
+             'name': plugin_class.name(),
+             'version': plugin_class.version(),
+             'weight': plugin_class.weight(),
+             'inputs': plugin_class.inputs() }
+
+def _split_plugin_class_name(plugin_class_name):
+    e = plugin_class_name.split(".")
+    return '.'.join(e[:-1]), e[-1]
+
+
+class PluginRegistry(object):
+
+    """
+    Registry of the installed plugins. Plugins are found through the
+    minion.plugins setuptools entry point group and by looking at the
+    modules in the minion.plugins package.
+
+    Finding the plugins means importing them, so the descriptors are
+    cached in a manifest file. The manifest is only rebuilt when the
+    entry points or the plugin modules have changed, which can be told
+    without importing anything. Plugin classes are only imported when
+    they are asked for with load_class().
+    """
+
+    def __init__(self, manifest_path=None):
+        self._manifest_path = os.path.expanduser(manifest_path or DEFAULT_MANIFEST_PATH)
+        self._descriptors = None
+        self._revision = None
+        self._classes = {}
+
+    # Discovery
+
+    def _entry_points(self):
+        return list(pkg_resources.iter_entry_points(ENTRY_POINT_GROUP))
+
+    def _package_paths(self):
+        return list(importlib.import_module(PLUGIN_PACKAGE).__path__)
+
+    def _sources(self):
+        """ Describe where the plugins come from: the entry points with
+        the version of their distribution and the plugin module files with
+        their modification time. """
+        sources = sorted("%s (%s)" % (ep, ep.dist) for ep in self._entry_points())
+        for path in self._package_paths():
+            if os.path.isdir(path):
+                for filename in sorted(os.listdir(path)):
+                    if filename.endswith('.py'):
+                        filepath = os.path.join(path, filename)
+                        sources.append("%s %d" % (filepath, os.path.getmtime(filepath)))
+        return sources
+
+    def _discover(self):
+        """ Import all plugins and return their descriptors. """
+        descriptors = {}
+        for ep in self._entry_points():
+            plugin_name = "%s.%s" % (ep.module_name, '.'.join(ep.attrs))
+            try:
+                plugin_class = ep.load(require=False)
+            except Exception as e:
+                logger.exception("Unable to import %s" % plugin_name)
+                continue
+            self._classes[plugin_name] = plugin_class
+            descriptors[plugin_name] = _describe(plugin_name, plugin_class)
+
+        # Plugins that are installed in the minion.plugins namespace without
+        # declaring an entry point are found by looking at every module.
+        from minion.plugins.base import AbstractPlugin
+        for importer, package, ispkg in pkgutil.iter_modules(self._package_paths(), PLUGIN_PACKAGE + '.'):
+            try:
+                module = importlib.import_module(package)
+            except Exception as e:
+                logger.exception("Unable to import %s" % package)
+                continue
+            for name in dir(module):
+                obj = getattr(module, name)
+                if inspect.isclass(obj) and issubclass(obj, AbstractPlugin) and name not in BASE_CLASSES:
+                    plugin_name = module.__name__ + '.' + obj.__name__
+                    if plugin_name not in descriptors:
+                        logger.info("Found %s" % str(obj))
+                        self._classes[plugin_name] = obj
+                        descriptors[plugin_name] = _describe(plugin_name, obj)
+        return descriptors
+
+    # Manifest
+
+    def _read_manifest(self):
+        try:
+            with open(self._manifest_path) as fp:
+                return json.load(fp)
+        except (IOError, ValueError) as e:
+            return None
+
+    def _write_manifest(self, manifest):
+        # Write to a temporary file first so that other processes never
+        # see a partially written manifest.
+        tmp_path = "%s.%d" % (self._manifest_path, os.getpid())
+        try:
+            directory = os.path.dirname(self._manifest_path)
+            if not os.path.isdir(directory):
+                os.makedirs(directory)
+            with open(tmp_path, 'w') as fp:
+                json.dump(manifest, fp)
+            os.rename(tmp_path, self._manifest_path)
+        except (IOError, OSError) as e:
+            logger.warning("Unable to write plugin manifest %s: %s" % (self._manifest_path, str(e)))
+
+    def _load(self):
+        sources = self._sources()
+        manifest = self._read_manifest()
+        if manifest and manifest.get('sources') == sources:
+            return manifest['plugins']
+        descriptors = self._discover()
+        self._write_manifest({'sources': sources, 'plugins': descriptors})
+        return descriptors
+
+    def refresh(self):
+        """ Forget the known plugins. They are found again on next use. """
+        self._descriptors = None
+        self._revision = None
+        self._classes = {}
+
+    # Registry
+
+    def descriptors(self):
+        if self._descriptors is None:
+            self._descriptors = self._load()
+        return self._descriptors.values()
+
+    def revision(self):
+        """ Return a hash of the descriptors. It changes when plugins are
+        added, removed or upgraded. """
+        if self._revision is None:
+            descriptors = sorted(self.descriptors(), key=lambda d: d['class'])
+            self._revision = hashlib.sha1(json.dumps(descriptors, sort_keys=True)).hexdigest()
+        return self._revision
+
+    def descriptor(self, plugin_name):
+        """ Return the descriptor of the plugin. Raises KeyError if there
+        is no such plugin. """
+        self.descriptors()
+        return self._descriptors[plugin_name]
+
+    def get(self, plugin_name, default=None):
+        try:
+            return self.descriptor(plugin_name)
+        except KeyError:
+            return default
+
+    def __contains__(self, plugin_name):
+        return self.get(plugin_name) is not None
+
+    def load_class(self, plugin_name):
+        """ Import and return the plugin class. Raises KeyError if there
+        is no such plugin. """
+        self.descriptor(plugin_name)
+        if plugin_name not in self._classes:
+            module_name, class_name = _split_plugin_class_name(plugin_name)
+            self._classes[plugin_name] = getattr(importlib.import_module(module_name), class_name)
+        return self._classes[plugin_name]
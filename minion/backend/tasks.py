@@ -3,7 +3,10 @@
 # file, You can obtain one at http://mozilla.org/MPL/2.0/.
 
 import Queue
+import calendar
 import datetime
+import gzip
+import hashlib
 import json
 import os
 import signal
@@ -17,33 +20,234 @@ import uuid
 from celery import Celery
 from celery.app.control import Control
 from celery.exceptions import TaskRevokedError
+from celery.schedules import crontab, crontab_parser
 from celery.execute import send_task
 from celery.signals import celeryd_after_setup
 from celery.task.control import revoke
 from celery.utils.log import get_task_logger
-from pymongo import MongoClient
+from bson import json_util
+from bson.son import SON
+from pymongo.errors import DuplicateKeyError
 import requests
 from twisted.internet import reactor
 from twisted.internet.error import ProcessDone, ProcessTerminated, ProcessExitedAlready
 from twisted.internet.protocol import ProcessProtocol
 
+import minion.curly
 from minion.backend import ownership
+from minion.backend.metrics import InstrumentedMongoClient
+from minion.backend.registry import PluginRegistry
 from minion.backend.utils import backend_config, scan_config, scannable
 
 
 cfg = backend_config()
 celery = Celery('tasks', broker=cfg['celery']['broker'], backend=cfg['celery']['backend'])
 
+# Describes the plugins of the plans of the scans that are created here
+plugin_registry = PluginRegistry(cfg.get('plugins', {}).get('manifest'))
+
 # If the config does not mention mongo then we do not set it up. That is ok because
 # that will only happen in plugin-workers that do not need direct mongodb access.
 if cfg.get('mongodb') is not None:
-    mongodb = MongoClient(host=cfg['mongodb']['host'], port=cfg['mongodb']['port'])
+    mongodb = InstrumentedMongoClient(host=cfg['mongodb']['host'], port=cfg['mongodb']['port'])
     db = mongodb.minion
     plans = db.plans
     scans = db.scans
+    latest_scans = db.latest_scans
+    scan_events = db.scan_events
+    issues = db.issues
+    issue_templates = db.issue_templates
+    scan_diffs = db.scan_diffs
+    rollups = db.rollups
+    plugin_stats = db.plugin_stats
+    scheduler = db.scheduler
+    campaigns = db.campaigns
+    scan_schedules = db.scan_schedules
+    groups = db.groups
+    archived_scans = db.archived_scans
+    archived_issues = db.archived_issues
+    scans.ensure_index('id')
+    scans.ensure_index([('configuration.target', 1), ('plan.name', 1), ('created', -1)])
+    scans.ensure_index([('state', 1), ('schedule.rank', 1), ('schedule.tag', 1)])
+    scans.ensure_index([('campaign', 1), ('state', 1)], sparse=True)
+    scans.ensure_index([('configuration_hash', 1), ('state', 1), ('finished', -1)])
+    campaigns.ensure_index('id', unique=True)
+    campaigns.ensure_index([('group', 1), ('created', -1)])
+    scan_schedules.ensure_index('id', unique=True)
+    scan_schedules.ensure_index([('enabled', 1), ('next_run', 1)])
+    scan_schedules.ensure_index([('target', 1), ('plan', 1)])
+    latest_scans.ensure_index([('target', 1), ('plan', 1)], unique=True)
+    scan_events.ensure_index([('scan_id', 1), ('seq', 1)], unique=True)
+    issues.ensure_index([('scan_id', 1), ('seq', 1)])
+    issues.ensure_index([('scan_id', 1), ('session_id', 1), ('seq', 1)])
+    issues.ensure_index([('scan_id', 1), ('code', 1)])
+    issues.ensure_index([('target', 1), ('plan', 1), ('code', 1), ('severity', 1)])
+    scan_diffs.ensure_index('scan_id', unique=True)
+    rollups.ensure_index([('scope', 1), ('key', 1), ('day', 1)], unique=True)
+    rollups.ensure_index([('scope', 1), ('target', 1), ('day', 1)])
+    plugin_stats.ensure_index([('class', 1), ('version', 1)], unique=True)
 
 logger = get_task_logger(__name__)
 
+# A scan in one of these states never changes again
+TERMINAL_STATES = ('FINISHED', 'FAILED', 'ABORTED', 'STOPPED')
+
+#
+# Old scans are compacted by the compact_scans task, which runs on the beat
+# of the state worker. The retention policy is configured in backend.json:
+#
+#  "retention": {
+#    "keep": 10,
+#    "archive": "file",
+#    "archive_path": "/var/lib/minion/archive",
+#    "interval": 300,
+#    "batch": 100
+#  }
+#
+# The last keep FINISHED scans of every site and plan, and the scans that
+# were created after the oldest of those, are kept as they are. Older scans
+# only keep their counters and the codes of their issues. If archive is
+# "collection" then their issues are moved to the archived_scans and
+# archived_issues collections first, if it is "file" then the scan and its
+# issues are written to a gzipped JSON file in archive_path. Without a keep
+# scans are never compacted.
+#
+# The state worker also records scan progress, so every run only looks at
+# batch sites and plans and compacts at most batch scans. The next run goes
+# on where it stopped.
+#
+
+DEFAULT_RETENTION = {
+    'keep': None,
+    'archive': None,
+    'archive_path': '/var/lib/minion/archive',
+    'interval': 300,
+    'batch': 100
+}
+
+def retention_policy():
+    policy = dict(DEFAULT_RETENTION)
+    policy.update(cfg.get('retention') or {})
+    return policy
+
+#
+# Started scans are not sent to the scan workers right away. The scheduler
+# releases them when fewer than max_running scans are running, interactive
+# scans before scheduled ones and otherwise fairly across tenants. A tenant
+# is the group that has both the site and the user of the scan, or else the
+# user. Tenants get a share of the scan slots in proportion to their weight
+# (1 by default). It is configured in backend.json:
+#
+#  "scheduler": {
+#    "max_running": 10,
+#    "weights": { "group:Security": 2, "user:bob@example.org": 0.5 },
+#    "interval": 30,
+#    "stale_after": 86400
+#  }
+#
+# Scans that were released or started more than stale_after seconds ago
+# no longer take a slot. Every interval seconds the scheduler also looks
+# for free slots on its own.
+#
+
+SCAN_PRIORITIES = ('interactive', 'scheduled')
+
+DEFAULT_SCHEDULER = {
+    'max_running': 10,
+    'weights': {},
+    'interval': 30,
+    'stale_after': 86400
+}
+
+def scheduler_policy():
+    policy = dict(DEFAULT_SCHEDULER)
+    policy.update(cfg.get('scheduler') or {})
+    return policy
+
+#
+# The state worker looks for scan schedules that are due every interval
+# seconds. The runs of schedules are spread over jitter seconds after their
+# planned time, unless a schedule has its own jitter. It is configured in
+# backend.json:
+#
+#  "schedules": {
+#    "interval": 60,
+#    "jitter": 3600
+#  }
+#
+
+DEFAULT_SCAN_SCHEDULES = {
+    'interval': 60,
+    'jitter': 3600
+}
+
+def schedules_policy():
+    policy = dict(DEFAULT_SCAN_SCHEDULES)
+    policy.update(cfg.get('schedules') or {})
+    return policy
+
+#
+# A scan that is started with the same plan and configuration as a scan
+# that is already queued or running can be coalesced with that scan
+# instead of running itself. When enabled, scans are coalesced unless
+# they are started with coalesce=false, and scans that finished less than
+# reuse_finished seconds ago are reused as well. It is configured in
+# backend.json:
+#
+#  "coalescing": {
+#    "enabled": false,
+#    "reuse_finished": 0
+#  }
+#
+
+DEFAULT_COALESCING = {
+    'enabled': False,
+    'reuse_finished': 0
+}
+
+def coalescing_policy():
+    policy = dict(DEFAULT_COALESCING)
+    policy.update(cfg.get('coalescing') or {})
+    return policy
+
+#
+# A smart rescan does not run the plugins whose inputs have not changed
+# since the previous finished scan of the site with the plan, but carries
+# their issues over. Scans are smart rescans when they are created with
+# smart_rescan, or else when it is enabled in backend.json:
+#
+#  "rescan": {
+#    "smart": false
+#  }
+#
+
+DEFAULT_RESCAN = {
+    'smart': False
+}
+
+def rescan_policy():
+    policy = dict(DEFAULT_RESCAN)
+    policy.update(cfg.get('rescan') or {})
+    return policy
+
+celery.conf.CELERYBEAT_SCHEDULE = {
+    'compact-scans': {
+        'task': 'minion.backend.tasks.compact_scans',
+        'schedule': datetime.timedelta(seconds=retention_policy()['interval']),
+        'options': {'queue': 'state'}
+    },
+    'dispatch-scans': {
+        'task': 'minion.backend.tasks.dispatch_scans',
+        'schedule': datetime.timedelta(seconds=scheduler_policy()['interval']),
+        'options': {'queue': 'state'}
+    },
+    'run-scan-schedules': {
+        'task': 'minion.backend.tasks.run_scan_schedules',
+        'schedule': datetime.timedelta(seconds=schedules_policy()['interval']),
+        'options': {'queue': 'state'}
+    }
+}
+
 
 def find_session(scan, session_id):
     for session in scan['sessions']:
@@ -51,11 +255,1067 @@ def find_session(scan, session_id):
             return session
 
 
+SEVERITIES = ('high', 'medium', 'low', 'info')
+
+#
+# Issues are not kept in the scans but in their own collection, so that
+# scans stay small and issues can be queried without loading scans:
+#
+#  { 'scan_id': '...', 'session_id': '...', 'seq': 3,
+#    'target': 'http://www.mozilla.com', 'plan': 'basic',
+#    'code': 'XFO-0', 'severity': 'High',
+#    'issue': { 'Id': '...', 'Code': 'XFO-0', 'Severity': 'High', 'Summary': '...', ... } }
+#
+# The seq is the sequence number of the issue event and keeps the issues
+# in the order they were reported. A scan only keeps a count of its issues
+# by severity in its issues field.
+#
+
+def count_issues(scan):
+    """ Return the counts of the issues of a scan by severity. """
+    counts = dict((severity, 0) for severity in SEVERITIES)
+    counts.update(scan.get('issues') or {})
+    return counts
+
+#
+# Most of the text of an issue, like its description and solution, is the
+# same for every issue with the same code from the same plugin. That text
+# is only stored once, in the issue_templates collection:
+#
+#  { '_id': 'minion.plugins.basic.XFrameOptionsPlugin 0.1 XFO-2',
+#    'fields': { 'Description': '...', 'Solution': '...', 'FurtherInfo': [...] } }
+#
+# The template of a code is taken from the first issue reported with it. An
+# issue then only stores the fields that are different from its template and
+# the fields that are always different or needed to query issues.
+#
+
+INSTANCE_FIELDS = ('Id', 'Code', 'Severity', 'Summary')
+
+# Templates never change, so they are kept once they have been loaded
+_issue_templates = {}
+
+# Templates that this process made sure are stored. A template can be
+# cached here while the database lost it, after a restore for example.
+_stored_issue_templates = set()
+
+def find_issue_template(key):
+    if key not in _issue_templates:
+        template = issue_templates.find_one({'_id': key})
+        if not template:
+            return None
+        _issue_templates[key] = template['fields']
+    return _issue_templates[key]
+
+def store_issue_template(key, fields):
+    """ Store the template unless there already is one with that key. """
+    try:
+        issue_templates.insert({'_id': key, 'fields': fields})
+    except DuplicateKeyError:
+        pass
+    _stored_issue_templates.add(key)
+
+def intern_issue(plugin, issue):
+    """ Return the key of the template of the issue and the fields of the
+    issue that are not in that template. The key is None if the issue does
+    not fit the template. """
+    key = "%s %s %s" % (plugin['class'], plugin['version'], issue.get('Code'))
+    if key not in _stored_issue_templates:
+        fields = _issue_templates.get(key)
+        if fields is None:
+            fields = dict((k, v) for k, v in issue.iteritems() if k not in INSTANCE_FIELDS)
+        store_issue_template(key, fields)
+    template = find_issue_template(key)
+    if template is None or not set(template).issubset(issue):
+        return None, issue
+    return key, dict((k, v) for k, v in issue.iteritems() if k not in template or template[k] != v)
+
+def expand_issue(key, issue):
+    """ Return the complete issue from its template and its own fields.
+    Only the fields of the issue itself are left when its template is
+    missing. """
+    template = find_issue_template(key) if key is not None else None
+    if template is None:
+        return issue
+    expanded = dict(template)
+    expanded.update(issue)
+    return expanded
+
+def fingerprint_issue(plugin, issue):
+    """ Return a fingerprint of the issue that is the same for the same
+    finding in different scans. It is made from the plugin, the code, the
+    urls and the summary of the issue, but not from its id or its version. """
+    urls = sorted((u.get('URL') or '') if isinstance(u, dict) else u for u in issue.get('URLs') or [])
+    summary = ' '.join((issue.get('Summary') or '').lower().split())
+    return hashlib.sha1(json.dumps([plugin['class'], issue.get('Code'), urls, summary])).hexdigest()
+
+def add_issue(scan_id, session_id, issue, template, fingerprint, seq, target, plan):
+    issues.insert({'scan_id': scan_id,
+                   'session_id': session_id,
+                   'seq': seq,
+                   'target': target,
+                   'plan': plan,
+                   'code': issue.get('Code'),
+                   'severity': issue.get('Severity'),
+                   'fingerprint': fingerprint,
+                   'template': template,
+                   'issue': issue})
+
+def migrate_issues():
+    """ Move the issues that are still kept in scans to the issues
+    collection and count them in the scans. Can be run again after it
+    was interrupted: issues of a scan that was only partly moved are
+    removed and moved again. """
+    for scan in scans.find({'sessions.issues': {'$exists': True}}):
+        issues.remove({'scan_id': scan['id']})
+        counts = dict((severity, 0) for severity in SEVERITIES)
+        seq = 0
+        for session in scan['sessions']:
+            for issue in session.pop('issues', []):
+                seq += 1
+                template, instance = intern_issue(session['plugin'], issue)
+                add_issue(scan['id'], session['id'], instance, template, fingerprint_issue(session['plugin'], issue),
+                          seq, scan['configuration']['target'], scan['plan']['name'])
+                severity = issue.get('Severity', '').lower()
+                if severity in counts:
+                    counts[severity] += 1
+        scans.update({'id': scan['id']}, {'$set': {'sessions': scan['sessions'], 'issues': counts}})
+
+def summarize_scan(scan):
+    """ Return the basic info about a scan and a count of its issues. """
+    summary = { 'id': scan['id'],
+                'meta': scan['meta'],
+                'state': scan['state'],
+                'configuration': scan['configuration'],
+                'plan': scan['plan'],
+                'sessions': [ ],
+                'created': scan.get('created'),
+                'queued': scan.get('queued'),
+                'finished': scan.get('finished'),
+                'issues': count_issues(scan) }
+    for session in scan['sessions']:
+        summary['sessions'].append({ 'plugin': session['plugin'],
+                                     'id': session['id'],
+                                     'state': session['state'] })
+    return summary
+
+def update_latest_scan(scan, latest=None):
+    """ Record the scan in the latest_scans collection. That collection
+    keeps one document per (target, plan) with a summary of the most
+    recently created scan and a pointer to the most recent FINISHED
+    scan, so that reports do not have to sort the scans collection.
+    latest is the current document of the target and plan, if it has
+    been loaded already. """
+    target = scan['configuration']['target']
+    plan = scan['plan']['name']
+    if latest is None:
+        latest = latest_scans.find_one({'target': target, 'plan': plan}) or {}
+    changes = {}
+    current = latest.get('scan')
+    if not current or current['id'] == scan['id'] or current['created'] <= scan['created']:
+        changes['scan'] = summarize_scan(scan)
+    if scan['state'] == 'FINISHED':
+        finished = latest.get('finished')
+        if not finished or finished['created'] <= scan['created']:
+            changes['finished'] = {'id': scan['id'], 'created': scan['created']}
+    if changes:
+        latest_scans.update({'target': target, 'plan': plan}, {'$set': changes}, upsert=True)
+
+# Many scans are recorded in the latest_scans collection this many sites
+# and plans at a time
+LATEST_SCANS_CHUNK_SIZE = 500
+
+def update_latest_scans(new_scans):
+    """ Record many new scans in the latest_scans collection. Only the last
+    of the scans of each target and plan is recorded, and the current
+    documents are loaded together. """
+    last = {}
+    for scan in new_scans:
+        last[(scan['configuration']['target'], scan['plan']['name'])] = scan
+    pairs = last.keys()
+    for i in range(0, len(pairs), LATEST_SCANS_CHUNK_SIZE):
+        chunk = pairs[i:i + LATEST_SCANS_CHUNK_SIZE]
+        current = {}
+        for latest in latest_scans.find({'target': {'$in': list(set(target for target, _ in chunk))}},
+                                        {'target': True, 'plan': True, 'scan.id': True, 'scan.created': True,
+                                         'finished': True}):
+            current[(latest['target'], latest['plan'])] = latest
+        for pair in chunk:
+            update_latest_scan(last[pair], current.get(pair, {}))
+
+def refresh_latest_scan(scan_id):
+    scan = scans.find_one({'id': scan_id})
+    if scan:
+        update_latest_scan(scan)
+
+def rebuild_latest_scans():
+    """ Rebuild the latest_scans collection from all existing scans. """
+    latest_scans.remove()
+    for scan in scans.find().sort('created', 1):
+        update_latest_scan(scan)
+
+#
+# Every state change of a scan or its sessions and every reported issue is
+# also recorded in the scan_events collection, so that clients can follow
+# a scan without loading it again and again. Events are numbered by a
+# sequence number that is kept in the scan and is increasing per scan:
+#
+#  { 'scan_id': '...', 'seq': 1, 'type': 'scan-state', 'state': 'QUEUED' }
+#  { 'scan_id': '...', 'seq': 2, 'type': 'session-state', 'session': '...', 'state': 'QUEUED' }
+#  { 'scan_id': '...', 'seq': 3, 'type': 'issue', 'session': '...', 'issue': {...} }
+#
+
+def record_event(scan_id, event_type, **fields):
+    """ Record an event for the scan and return its sequence number. """
+    scan = scans.find_and_modify({'id': scan_id}, {'$inc': {'seq': 1}}, fields={'seq': True}, new=True)
+    if not scan:
+        return None
+    event = new_event(scan_id, scan['seq'], event_type, **fields)
+    scan_events.insert(event)
+    return event['seq']
+
+def new_event(scan_id, seq, event_type, **fields):
+    return dict(fields, scan_id=scan_id, seq=seq, type=event_type, created=datetime.datetime.utcnow())
+
+#
+# When a scan has finished its issues are compared with those of the
+# previous finished scan of the same site and plan. The result is kept
+# in the scan_diffs collection:
+#
+#  { 'scan_id': '...', 'previous': '...',
+#    'new': [ { 'fingerprint': '...', 'id': '...', 'session': '...',
+#               'code': 'XFO-2', 'severity': 'High', 'summary': '...' } ],
+#    'fixed': [...],
+#    'unchanged': [...] }
+#
+# Fixed issues are those of the previous scan, the others those of the
+# scan itself. Without a previous scan all issues are new.
+#
+
+def _find_fingerprinted_issues(scan):
+    plugins = dict((session['id'], session['plugin']) for session in scan['sessions'])
+    found = {}
+    for i in issues.find({'scan_id': scan['id']}).sort('seq', 1):
+        fingerprint = i.get('fingerprint')
+        if fingerprint is None:
+            fingerprint = fingerprint_issue(plugins[i['session_id']], expand_issue(i.get('template'), i['issue']))
+        found.setdefault(fingerprint, {'fingerprint': fingerprint,
+                                       'id': i['issue'].get('Id'),
+                                       'session': i['session_id'],
+                                       'code': i['issue'].get('Code'),
+                                       'severity': i['issue'].get('Severity'),
+                                       'summary': i['issue'].get('Summary')})
+    return found
+
+def diff_scan(scan_id):
+    scan = scans.find_one({'id': scan_id})
+    previous = scans.find_one({'configuration.target': scan['configuration']['target'],
+                               'plan.name': scan['plan']['name'],
+                               'state': 'FINISHED',
+                               'created': {'$lt': scan['created']}},
+                              sort=[('created', -1)])
+    if previous and previous.get('compacted'):
+        logger.info("Not comparing scan %s with compacted scan %s" % (scan_id, previous['id']))
+        return
+    current = _find_fingerprinted_issues(scan)
+    before = _find_fingerprinted_issues(previous) if previous else {}
+    diff = {'scan_id': scan_id,
+            'previous': previous['id'] if previous else None,
+            'new': [current[f] for f in current if f not in before],
+            'fixed': [before[f] for f in before if f not in current],
+            'unchanged': [current[f] for f in current if f in before]}
+    scan_diffs.update({'scan_id': scan_id}, diff, upsert=True)
+
+#
+# Daily rollups of the state of sites, groups and everything together, so
+# that trends can be shown without loading old scans:
+#
+#  { 'scope': 'group', 'key': 'mozilla', 'day': '2013-06-01',
+#    'issues': { 'high': 3, 'medium': 0, 'low': 12, 'info': 40 },
+#    'codes': { 'XFO-2': 2, 'HSTS-2': 5 },
+#    'sites': 6 }
+#
+# The site scope has one rollup per site and plan, with as key the url and
+# the plan name separated by a space. It holds the issue counts of the last
+# finished scan of that day, and codes are 1 if the scan found that code.
+# The global scope (with an empty key) holds the sum over all sites, so
+# there codes are the number of sites and plans that found that code, and
+# sites is the number of sites that have been scanned. A day without
+# rollup is the same as the day before it.
+#
+# Issue codes can hold dots or start with a dollar sign, so they are
+# escaped with rollup_field before they are used as field names.
+#
+# Groups have no rollups of their own. Their trends are summed from the
+# rollups of the sites that are in the group when the trend is asked for,
+# so they follow sites that join or leave the group.
+#
+# Rollups can be rebuilt with minion-db-backfill rollups.
+#
+
+def rollup_field(code):
+    """ Return the issue code escaped to be used as a field name. """
+    return code.replace('%', '%25').replace('.', '%2E').replace('$', '%24')
+
+def rollup_code(field):
+    """ Return the issue code of a field name made by rollup_field. """
+    return field.replace('%24', '$').replace('%2E', '.').replace('%25', '%')
+
+def _empty_rollup():
+    return {'issues': dict((severity, 0) for severity in SEVERITIES), 'codes': {}, 'sites': 0}
+
+def find_rollup(scope, key, day):
+    """ Return the rollup of the day or of the last day before it. """
+    return rollups.find_one({'scope': scope, 'key': key, 'day': {'$lte': day}}, sort=[('day', -1)])
+
+def find_rollups(scope, keys, day):
+    """ Return the rollups of many keys like find_rollup, by key. They are
+    read with one aggregation instead of a query for every key. """
+    result = rollups.aggregate([{'$match': {'scope': scope, 'key': {'$in': keys}, 'day': {'$lte': day}}},
+                                {'$sort': SON([('key', 1), ('day', 1)])},
+                                {'$group': {'_id': '$key',
+                                            'day': {'$last': '$day'},
+                                            'issues': {'$last': '$issues'},
+                                            'codes': {'$last': '$codes'},
+                                            'sites': {'$last': '$sites'}}}])
+    return dict((rollup['_id'], dict(rollup, key=rollup['_id'])) for rollup in result['result'])
+
+def _inc_rollup(scope, key, day, delta):
+    query = {'scope': scope, 'key': key, 'day': day}
+    if rollups.find_one(query, {'_id': True}) is None:
+        rollup = dict(query, **_empty_rollup())
+        previous = find_rollup(scope, key, day)
+        if previous:
+            rollup.update(issues=previous['issues'], codes=previous['codes'], sites=previous['sites'])
+        rollups.insert(rollup)
+    inc = {}
+    for field in ('issues', 'codes'):
+        for name, n in delta[field].iteritems():
+            if n:
+                inc[field + '.' + name] = n
+    if delta['sites']:
+        inc['sites'] = delta['sites']
+    if inc:
+        rollups.update(query, {'$inc': inc})
+
+def update_rollups(scan):
+    """ Update the rollups of the day the scan finished with the issues
+    found by the scan. """
+    day = scan['finished'].strftime('%Y-%m-%d')
+    target = scan['configuration']['target']
+    key = "%s %s" % (target, scan['plan']['name'])
+    if scan.get('compacted'):
+        codes = scan.get('issue_codes', [])
+    else:
+        codes = issues.find({'scan_id': scan['id']}, {'code': True}).distinct('code')
+    current = {'issues': count_issues(scan), 'codes': dict((rollup_field(code), 1) for code in codes if code), 'sites': 1}
+    previous = find_rollup('site', key, day)
+    # A site is counted once, when the first of its plans gets a rollup
+    new_site = previous is None and rollups.find_one({'scope': 'site', 'target': target, 'day': {'$lte': day}},
+                                                     {'_id': True}) is None
+    previous = previous or _empty_rollup()
+    delta = {'issues': {}, 'codes': {}, 'sites': 1 if new_site else 0}
+    for field in ('issues', 'codes'):
+        for name in set(current[field]) | set(previous[field]):
+            delta[field][name] = current[field].get(name, 0) - previous[field].get(name, 0)
+    rollups.update({'scope': 'site', 'key': key, 'day': day},
+                   {'$set': dict(current, target=target, plan=scan['plan']['name'])}, upsert=True)
+    _inc_rollup('global', '', day, delta)
+
+def rebuild_rollups():
+    """ Rebuild the rollups from all finished scans. """
+    rollups.remove()
+    for scan in scans.find({'state': 'FINISHED'}).sort('finished', 1):
+        update_rollups(scan)
+
+#
+# Plugin statistics are kept per plugin class and version and are updated
+# by run_plugin after each session. Durations are counted in buckets, so
+# that percentiles can be estimated without keeping every run around.
+#
+
+# Upper bounds in seconds of the plugin duration buckets
+PLUGIN_DURATION_BUCKETS = (1, 2, 5, 10, 30, 60, 120, 300, 600, 1200, 1800, 3600, 7200, 14400)
+
+# Session states that count as failed or aborted runs
+FAILED_SESSION_STATES = ('FAILED', 'TERMINATED', 'TIMEOUT')
+ABORTED_SESSION_STATES = ('ABORTED', 'STOPPED')
+
+def _duration_bucket(duration):
+    for i, bound in enumerate(PLUGIN_DURATION_BUCKETS):
+        if duration <= bound:
+            return i
+    return len(PLUGIN_DURATION_BUCKETS)
+
+def record_plugin_run(plugin, state, duration, issue_count, rss):
+    """ Count a run of the plugin. The duration and rss (in bytes) are
+    left out when they are not known. """
+    inc = {'runs': 1, 'states.' + state: 1, 'issues': issue_count}
+    if duration is not None:
+        inc['durations.%d' % _duration_bucket(duration)] = 1
+        inc['duration_sum'] = duration
+    if rss is not None:
+        inc['rss_sum'] = rss
+        inc['rss_runs'] = 1
+    plugin_stats.update({'class': plugin['class'], 'version': plugin.get('version')},
+                        {'$inc': inc, '$set': {'name': plugin.get('name'), 'weight': plugin.get('weight')}},
+                        upsert=True)
+
+def _duration_percentile(durations, runs, q):
+    """ Estimate a percentile by interpolating within the bucket it falls in. """
+    rank = q * runs
+    seen = 0
+    for i in range(len(PLUGIN_DURATION_BUCKETS) + 1):
+        n = durations.get(str(i), 0)
+        if n and seen + n >= rank:
+            lower = PLUGIN_DURATION_BUCKETS[i - 1] if i > 0 else 0
+            if i == len(PLUGIN_DURATION_BUCKETS):
+                return lower
+            return lower + (PLUGIN_DURATION_BUCKETS[i] - lower) * (rank - seen) / float(n)
+        seen += n
+
+def summarize_plugin_stats(stats):
+    runs = stats.get('runs', 0)
+    states = stats.get('states', {})
+    durations = stats.get('durations', {})
+    timed = sum(durations.values())
+    def rate(names):
+        return sum(states.get(name, 0) for name in names) / float(runs) if runs else None
+    return {'class': stats['class'],
+            'version': stats.get('version'),
+            'name': stats.get('name'),
+            'weight': stats.get('weight'),
+            'runs': runs,
+            'states': states,
+            'duration': {'mean': stats.get('duration_sum', 0) / float(timed) if timed else None,
+                         'p50': _duration_percentile(durations, timed, 0.50),
+                         'p95': _duration_percentile(durations, timed, 0.95),
+                         'p99': _duration_percentile(durations, timed, 0.99)},
+            'failure_rate': rate(FAILED_SESSION_STATES),
+            'abort_rate': rate(ABORTED_SESSION_STATES),
+            'issues_per_run': stats.get('issues', 0) / float(runs) if runs else None,
+            'rss': stats['rss_sum'] / float(stats['rss_runs']) if stats.get('rss_runs') else None}
+
+#
+# Sessions are routed to the heavy or the light plugin worker queue by
+# their weight, which is decided when the scan is created. A step in a
+# plan can set "weight" to "heavy" or "light" to choose it. Otherwise a
+# plugin that has run at least min_runs times is heavy if its p95 duration
+# or its average rss is above the limits in backend.json:
+#
+#  "plugin_routing": {
+#    "min_runs": 5,
+#    "heavy_duration": 300,
+#    "heavy_rss": 268435456
+#  }
+#
+# Plugins that have not run often enough keep the weight they declare.
+#
+
+DEFAULT_PLUGIN_ROUTING = {
+    'min_runs': 5,
+    'heavy_duration': 300,
+    'heavy_rss': 256 * 1024 * 1024
+}
+
+def plugin_routing():
+    policy = dict(DEFAULT_PLUGIN_ROUTING)
+    policy.update(cfg.get('plugin_routing') or {})
+    return policy
+
+def session_weight(plugin, step=None, policy=None):
+    """ Return whether a session of the plugin is heavy or light. """
+    if step and step.get('weight') in ('heavy', 'light'):
+        return step['weight']
+    policy = policy or plugin_routing()
+    stats = plugin_stats.find_one({'class': plugin['class'], 'version': plugin.get('version')})
+    if stats and stats.get('runs', 0) >= policy['min_runs']:
+        summary = summarize_plugin_stats(stats)
+        p95, rss = summary['duration']['p95'], summary['rss']
+        if (p95 is not None and p95 > policy['heavy_duration']) or (rss is not None and rss > policy['heavy_rss']):
+            return 'heavy'
+        return 'light'
+    return plugin.get('weight')
+
+def plan_sessions(plan):
+    """ Return the step, plugin and weight of every session of a scan of
+    the plan. These are the same for all scans created at once. """
+    sessions = []
+    for step in plan['workflow']:
+        plugin = plugin_registry.descriptor(step['plugin_name'])
+        sessions.append((step, plugin, session_weight(plugin, step)))
+    return sessions
+
+def configuration_hash(plan, configuration):
+    """ Return a hash of what a scan of the plan with the configuration
+    does. Scans with the same hash can be coalesced. """
+    return hashlib.sha1(json.dumps([plan['name'], plan.get('revision', 0), configuration],
+                                   sort_keys=True, default=json_util.default)).hexdigest()
+
+def new_scan(plan, sessions, configuration, user, now):
+    scan = { "id": str(uuid.uuid4()),
+             "state": "CREATED",
+             "created": now,
+             "queued": None,
+             "started": None,
+             "finished": None,
+             "seq": 0,
+             "plan": { "name": plan['name'], "revision": plan.get('revision', 0) },
+             "configuration": configuration,
+             "configuration_hash": configuration_hash(plan, configuration),
+             "sessions": [],
+             "issues": dict((severity, 0) for severity in SEVERITIES),
+             "schedule": None,
+             "meta": { "user": user, "tags": [] } }
+    for step, plugin, weight in sessions:
+        session_configuration = dict(step['configuration'])
+        session_configuration.update(configuration)
+        session = { "id": str(uuid.uuid4()),
+                    "state": "CREATED",
+                    "plugin": plugin,
+                    "weight": weight,
+                    "configuration": session_configuration, # TODO Do recursive merging here, not just at the top level
+                    "description": step["description"],
+                    "artifacts": {},
+                    "created": now,
+                    "queued": None,
+                    "started": None,
+                    "finished": None,
+                    "progress": None }
+        scan['sessions'].append(session)
+    return scan
+
+def rebuild_plugin_stats():
+    """ Rebuild the plugin statistics from the finished sessions of scans
+    that have not been compacted. The memory use of those sessions is not
+    known. """
+    plugin_stats.remove()
+    for scan in scans.find({'state': {'$in': list(TERMINAL_STATES)}, 'compacted': {'$exists': False}},
+                           {'id': True, 'sessions': True}):
+        counts = {}
+        for issue in issues.find({'scan_id': scan['id']}, {'session_id': True}):
+            counts[issue['session_id']] = counts.get(issue['session_id'], 0) + 1
+        for session in scan['sessions']:
+            if not session.get('finished') or session.get('state') in ('CREATED', 'QUEUED', 'STARTED'):
+                continue
+            duration = None
+            if session.get('started'):
+                duration = (session['finished'] - session['started']).total_seconds()
+            record_plugin_run(session['plugin'], session['state'], duration, counts.get(session['id'], 0), None)
+
+def archive_scan(scan, scan_issues, policy):
+    # Saving keeps the _id, so archiving the same scan again is harmless
+    if policy['archive'] == 'collection':
+        archived_scans.save(scan)
+        for issue in scan_issues:
+            archived_issues.save(issue)
+    elif policy['archive'] == 'file':
+        if not os.path.isdir(policy['archive_path']):
+            os.makedirs(policy['archive_path'])
+        path = os.path.join(policy['archive_path'], scan['id'] + '.json.gz')
+        # Files do not depend on the issue templates
+        scan_issues = [dict(i, issue=expand_issue(i.get('template'), i['issue']), template=None) for i in scan_issues]
+        fp = gzip.open(path + '.tmp', 'wb')
+        try:
+            json.dump({'scan': scan, 'issues': scan_issues}, fp, default=json_util.default)
+        finally:
+            fp.close()
+        os.rename(path + '.tmp', path)
+
+def compact_scan(scan_id, policy):
+    """ Archive the issues and events of a scan and remove them. The scan
+    keeps its counters and the codes of its issues. """
+    scan = scans.find_one({'id': scan_id})
+    scan_issues = list(issues.find({'scan_id': scan_id}))
+    if policy['archive']:
+        archive_scan(scan, scan_issues, policy)
+    codes = sorted(set(i['code'] for i in scan_issues if i.get('code')))
+    scans.update({'id': scan_id}, {'$set': {'compacted': True, 'issue_codes': codes}})
+    issues.remove({'scan_id': scan_id})
+    scan_events.remove({'scan_id': scan_id})
+
+def compaction_candidates(target, plan, keep, limit):
+    """ Return the ids of at most limit scans of the site with the plan
+    that can be compacted, oldest first. Those are the scans that ended
+    and were created before the oldest of the last keep FINISHED scans. """
+    kept = list(scans.find({'configuration.target': target, 'plan.name': plan, 'state': 'FINISHED'},
+                           {'created': True}).sort('created', -1).skip(keep - 1).limit(1))
+    if not kept:
+        return []
+    older = scans.find({'configuration.target': target,
+                        'plan.name': plan,
+                        'state': {'$in': list(TERMINAL_STATES)},
+                        'created': {'$lt': kept[0]['created']},
+                        'compacted': {'$ne': True}},
+                       {'id': True}).sort('created', 1).limit(limit)
+    return [scan['id'] for scan in older]
+
+@celery.task(ignore_result=True)
+def compact_scans():
+    policy = retention_policy()
+    if not policy['keep']:
+        return
+    keep, batch = max(1, policy['keep']), policy['batch']
+    # The sites and plans are visited in order, starting after the last
+    # one that was done completely
+    progress = scheduler.find_one({'_id': 'compaction'}) or {}
+    after = progress.get('after')
+    query = {}
+    if after:
+        query = {'$or': [{'target': {'$gt': after[0]}}, {'target': after[0], 'plan': {'$gt': after[1]}}]}
+    pairs = list(latest_scans.find(query, {'target': True, 'plan': True}).sort([('target', 1), ('plan', 1)]).limit(batch))
+    budget = batch
+    for i, latest in enumerate(pairs):
+        scan_ids = compaction_candidates(latest['target'], latest['plan'], keep, budget)
+        for scan_id in scan_ids:
+            try:
+                compact_scan(scan_id, policy)
+            except Exception as e:
+                logger.exception("Error while compacting scan %s" % scan_id)
+        budget -= len(scan_ids)
+        if budget <= 0:
+            # This site and plan may have more scans to compact
+            if i:
+                after = [pairs[i - 1]['target'], pairs[i - 1]['plan']]
+            break
+    else:
+        after = [pairs[-1]['target'], pairs[-1]['plan']] if len(pairs) == batch else None
+    scheduler.update({'_id': 'compaction'}, {'$set': {'after': after}}, upsert=True)
+
+#
+# The scheduler uses weighted fair queueing. When a scan is queued it is
+# tagged with the virtual time at which its tenant would be done with it:
+# one over the weight of the tenant after the later of the tag of the
+# previous scan of the tenant and the tag of the last released scan. Scans
+# are released by priority and then by tag, so a tenant that queues many
+# scans at once only gets its share of the slots.
+#
+
+def scan_tenant(target, user):
+    group = groups.find_one({'sites': target, 'users': user}, {'name': True}, sort=[('name', 1)])
+    if group:
+        return 'group:' + group['name']
+    return 'user:' + user
+
+def scan_tenants(targets, user):
+    """ Return the tenants of the scans of a user for many targets at once. """
+    tenants = dict((target, 'user:' + user) for target in targets)
+    for group in groups.find({'users': user}, {'name': True, 'sites': True}).sort('name', -1):
+        for target in group.get('sites', []):
+            if target in tenants:
+                tenants[target] = 'group:' + group['name']
+    return tenants
+
+def new_schedule(tenant, priority='interactive'):
+    return {'priority': priority,
+            'rank': SCAN_PRIORITIES.index(priority),
+            'tenant': tenant,
+            'tag': None,
+            'dispatched': None}
+
+def queue_scan(scan, priority='interactive'):
+    """ Move a created scan to the QUEUED state and hand it to the scheduler.
+    Scans that were coalesced are QUEUED already but not scheduled. Returns
+    False when the scan was handed to the scheduler before, by a campaign
+    or another request, so that it never runs twice. """
+    schedule = new_schedule(scan_tenant(scan['configuration']['target'], scan['meta']['user']), priority)
+    queued = scans.update({"id": scan['id'], "state": {"$in": ["CREATED", "QUEUED"]}, "schedule": None},
+                          {"$set": {"state": "QUEUED", "queued": datetime.datetime.utcnow(), "schedule": schedule}})
+    if not queued['n']:
+        return False
+    record_event(scan['id'], 'scan-state', state='QUEUED')
+    refresh_latest_scan(scan['id'])
+    schedule_scan.apply_async([scan['id']], queue='state')
+    return True
+
+def _virtual_time():
+    clock = scheduler.find_one({'_id': 'clock'})
+    return clock['time'] if clock else 0.0
+
+def _tag_scans(scan_ids):
+    """ Tag queued scans in the given order. """
+    weights = scheduler_policy()['weights']
+    now = _virtual_time()
+    queued = dict((scan['id'], scan['schedule'])
+                  for scan in scans.find({'id': {'$in': scan_ids}, 'state': 'QUEUED'}, {'id': True, 'schedule': True})
+                  if scan.get('schedule') and scan['schedule']['tag'] is None)
+    tags = {}
+    for scan_id in scan_ids:
+        if scan_id not in queued:
+            continue
+        tenant = queued[scan_id]['tenant']
+        if tenant not in tags:
+            previous = scheduler.find_one({'_id': 'tenant:' + tenant})
+            tags[tenant] = previous['tag'] if previous else 0.0
+        tags[tenant] = max(now, tags[tenant]) + 1.0 / weights.get(tenant, 1)
+        scans.update({'id': scan_id}, {'$set': {'schedule.tag': tags[tenant]}})
+    for tenant, tag in tags.iteritems():
+        scheduler.update({'_id': 'tenant:' + tenant}, {'$set': {'tag': tag}}, upsert=True)
+
+@celery.task(ignore_result=True)
+def schedule_scan(scan_id):
+    _tag_scans([scan_id])
+    dispatch_scans()
+
+@celery.task(ignore_result=True)
+def schedule_scans(scan_ids):
+    _tag_scans(scan_ids)
+    dispatch_scans()
+
+def running_scans(policy):
+    since = datetime.datetime.utcnow() - datetime.timedelta(seconds=policy['stale_after'])
+    return scans.find({'$or': [{'state': 'STARTED', 'started': {'$gt': since}},
+                               {'state': 'QUEUED', 'schedule.dispatched': {'$gt': since}}]}).count()
+
+@celery.task(ignore_result=True)
+def dispatch_scans():
+    """ Release queued scans to the scan workers while there are free slots. """
+    policy = scheduler_policy()
+    free = policy['max_running'] - running_scans(policy)
+    if free <= 0:
+        return
+    waiting = scans.find({'state': 'QUEUED', 'schedule.dispatched': None, 'schedule.tag': {'$ne': None}},
+                         {'id': True}).sort([('schedule.rank', 1), ('schedule.tag', 1)]).limit(free)
+    for scan in list(waiting):
+        released = scans.find_and_modify({'id': scan['id'], 'state': 'QUEUED', 'schedule.dispatched': None},
+                                         {'$set': {'schedule.dispatched': datetime.datetime.utcnow()}},
+                                         fields={'schedule': True}, new=True)
+        if not released:
+            continue
+        scheduler.update({'_id': 'clock'}, {'$set': {'time': max(_virtual_time(), released['schedule']['tag'])}}, upsert=True)
+        send_task("minion.backend.tasks.scan", [scan['id']], queue='scan')
+
+def queue_position(scan):
+    """ Return the number of scans that will be released before a queued
+    scan, or None if the scan is not waiting for the scheduler. """
+    schedule = scan.get('schedule') or {}
+    if scan.get('state') != 'QUEUED' or schedule.get('dispatched') or schedule.get('tag') is None:
+        return None
+    return scans.find({'state': 'QUEUED', 'schedule.dispatched': None,
+                       '$or': [{'schedule.rank': {'$lt': schedule['rank']}},
+                               {'schedule.rank': schedule['rank'], 'schedule.tag': {'$lt': schedule['tag']}}]}).count()
+
+def estimate_start(position, policy=None):
+    """ Estimate when the scan at the given queue position starts, from how
+    long the last finished scans took. """
+    policy = policy or scheduler_policy()
+    durations = [(s['finished'] - s['started']).total_seconds()
+                 for s in scans.find({'state': 'FINISHED'}, {'started': True, 'finished': True}).sort('created', -1).limit(20)
+                 if s.get('started') and s.get('finished')]
+    if not durations:
+        return None
+    wait = (position + 1) * (sum(durations) / len(durations)) / max(1, policy['max_running'])
+    return datetime.datetime.utcnow() + datetime.timedelta(seconds=wait)
+
+#
+# A coalesced scan waits in the QUEUED state for the scan it was coalesced
+# with, and then gets a copy of its sessions, issues and outcome:
+#
+#  { 'id': '...', 'state': 'QUEUED', ...
+#    'coalesced': { 'scan': '...', 'priority': 'interactive' } }
+#
+# The scan it waits for keeps a list of its followers. When that scan was
+# stopped, its followers are queued to run on their own.
+#
+
+COALESCED_RESULT_FIELDS = ('state', 'queued', 'started', 'finished', 'progress', 'artifacts', 'failure',
+                           'fingerprint', 'carried_over')
+
+def coalesce_scan(scan, priority='interactive'):
+    """ Coalesce a created scan with a queued or running scan with the same
+    configuration hash, or with one that finished recently. Returns the id
+    of that scan, or None when the scan has to run itself. """
+    key = scan.get('configuration_hash')
+    if not key:
+        return None
+    policy = coalescing_policy()
+    now = datetime.datetime.utcnow()
+    coalesced = {'priority': priority}
+    leader = scans.find_one({'configuration_hash': key, 'state': {'$in': ['QUEUED', 'STARTED']},
+                             'coalesced': None, 'id': {'$ne': scan['id']}}, {'id': True})
+    if leader:
+        coalesced['scan'] = leader['id']
+        scans.update({'id': scan['id']}, {'$set': {'coalesced': coalesced}})
+        # The leader can end at any time, it only takes followers while it has not
+        attached = scans.update({'id': leader['id'], 'state': {'$in': ['QUEUED', 'STARTED']}},
+                                {'$push': {'followers': scan['id']}})
+        if not attached['n']:
+            scans.update({'id': scan['id']}, {'$unset': {'coalesced': 1}})
+            leader = None
+    if not leader and policy['reuse_finished']:
+        since = now - datetime.timedelta(seconds=policy['reuse_finished'])
+        leader = scans.find_one({'configuration_hash': key, 'state': 'FINISHED', 'finished': {'$gte': since},
+                                 'compacted': {'$exists': False}}, {'id': True}, sort=[('finished', -1)])
+        if leader:
+            coalesced['scan'] = leader['id']
+            scans.update({'id': scan['id']}, {'$set': {'coalesced': coalesced}})
+            adopt_scan_results.apply_async([scan['id'], leader['id']], queue='state')
+    if not leader:
+        return None
+    queued = scans.update({'id': scan['id'], 'state': 'CREATED'}, {'$set': {'state': 'QUEUED', 'queued': now}})
+    if queued['n']:
+        record_event(scan['id'], 'scan-state', state='QUEUED')
+        refresh_latest_scan(scan['id'])
+    return leader['id']
+
+@celery.task(ignore_result=True)
+def adopt_scan_results(scan_id, leader_id):
+    """ Give a coalesced scan a copy of the sessions and issues of the scan
+    it was coalesced with and finish it like that scan. """
+    scan = scans.find_one({'id': scan_id})
+    leader = scans.find_one({'id': leader_id})
+    if not scan or scan['state'] not in ('CREATED', 'QUEUED'):
+        return
+    if not leader or leader.get('compacted') or len(leader['sessions']) != len(scan['sessions']):
+        run_coalesced_scan(scan)
+        return
+    session_ids = {}
+    for session, leader_session in zip(scan['sessions'], leader['sessions']):
+        session_ids[leader_session['id']] = session['id']
+        for field in COALESCED_RESULT_FIELDS:
+            if field in leader_session:
+                session[field] = leader_session[field]
+    copied = list(issues.find({'scan_id': leader_id}).sort('seq', 1))
+    # Number the events of the copied sessions and issues at once
+    count = len(scan['sessions']) + len(copied)
+    reserved = scans.find_and_modify({'id': scan_id},
+                                     {'$set': {'sessions': scan['sessions'], 'started': leader['started'],
+                                               'issues': count_issues(leader)},
+                                      '$inc': {'seq': count}},
+                                     fields={'seq': True}, new=True)
+    seq = reserved['seq'] - count
+    events = []
+    for session in scan['sessions']:
+        seq += 1
+        events.append(new_event(scan_id, seq, 'session-state', session=session['id'], state=session['state']))
+    events += copy_issues(scan_id, copied, session_ids, seq)
+    for i in range(0, len(events), 500):
+        scan_events.insert(events[i:i + 500])
+    scan_finish(scan_id, leader['state'], calendar.timegm(leader['finished'].utctimetuple()), leader.get('failure'))
+
+def copy_issues(scan_id, copied, session_ids, seq, carried_over=None):
+    """ Add the issues of another scan to the scan, in the sessions that
+    session_ids maps their sessions to. They are numbered after seq, up to
+    which the caller has reserved sequence numbers. Returns the events of
+    the issues, which the caller records. """
+    events = []
+    for issue in copied:
+        seq += 1
+        del issue['_id']
+        issue.update(scan_id=scan_id, session_id=session_ids.get(issue['session_id']), seq=seq)
+        if carried_over:
+            issue['issue'] = dict(issue['issue'], CarriedOver=issue['issue'].get('CarriedOver') or carried_over)
+        events.append(new_event(scan_id, seq, 'issue', session=issue['session_id'],
+                                issue=issue['issue'], template=issue.get('template')))
+    for i in range(0, len(copied), 500):
+        issues.insert(copied[i:i + 500])
+    return events
+
+def run_coalesced_scan(scan):
+    """ Queue a coalesced scan to run on its own. """
+    scans.update({'id': scan['id']}, {'$unset': {'coalesced': 1}})
+    queue_scan(scan, scan['coalesced']['priority'])
+
+def release_followers(scan_id, state):
+    """ Finish the scans that were coalesced with a scan that has ended,
+    or run them on their own when it was stopped. """
+    scan = scans.find_one({'id': scan_id}, {'followers': True})
+    for follower_id in (scan or {}).get('followers', []):
+        try:
+            if state == 'STOPPED':
+                follower = scans.find_one({'id': follower_id, 'state': {'$in': ['CREATED', 'QUEUED']}},
+                                          {'id': True, 'coalesced': True, 'configuration.target': True, 'meta.user': True})
+                if follower:
+                    run_coalesced_scan(follower)
+            else:
+                adopt_scan_results(follower_id, scan_id)
+        except Exception as e:
+            logger.exception("(Ignored) failure while releasing scan %s coalesced with %s" % (follower_id, scan_id))
+
+#
+# A campaign scans every site of a group with each of its plans. All its
+# scans are created up front and queued at most max_running at a time.
+# The campaign counts how its scans ended:
+#
+#  { 'id': '...', 'group': 'mozilla', 'user': 'bob@example.org',
+#    'state': 'STARTED', 'priority': 'scheduled', 'max_running': 10,
+#    'total': 2500, 'ended': { 'FINISHED': 120, 'FAILED': 2 } }
+#
+# A campaign is FINISHED when all its scans have ended, or STOPPED when it
+# was stopped.
+#
+
+CAMPAIGN_RUNNING_STATES = ('QUEUED', 'STARTED', 'STOPPING')
+
+@celery.task(ignore_result=True)
+def advance_campaign(campaign_id):
+    """ Queue scans of the campaign until max_running of them are running. """
+    campaign = campaigns.find_one({'id': campaign_id})
+    if not campaign or campaign['state'] != 'STARTED':
+        return
+    running = scans.find({'campaign': campaign_id, 'state': {'$in': list(CAMPAIGN_RUNNING_STATES)}}).count()
+    free = campaign['max_running'] - running
+    if free <= 0:
+        return
+    waiting = scans.find({'campaign': campaign_id, 'state': 'CREATED'},
+                         {'id': True, 'configuration.target': True, 'meta.user': True}).limit(free)
+    for scan in list(waiting):
+        queue_scan(scan, campaign['priority'])
+
+def campaign_scans_ended(campaign_id, state, n=1):
+    """ Count scans of the campaign that ended and queue the next ones. """
+    campaign = campaigns.find_and_modify({'id': campaign_id}, {'$inc': {'ended.' + state: n}}, new=True)
+    if not campaign:
+        return
+    if sum(campaign['ended'].values()) >= campaign['total']:
+        for current, final in (('STARTED', 'FINISHED'), ('STOPPING', 'STOPPED')):
+            campaigns.update({'id': campaign_id, 'state': current},
+                             {'$set': {'state': final, 'finished': datetime.datetime.utcnow()}})
+    else:
+        advance_campaign(campaign_id)
+
+@celery.task(ignore_result=True)
+def stop_campaign(campaign_id):
+    """ Stop the scans of a campaign that is STOPPING. Scans that have not
+    been queued yet are stopped right away, the others like any scan. """
+    waiting = [scan['id'] for scan in scans.find({'campaign': campaign_id, 'state': 'CREATED'}, {'id': True})]
+    stopped = 0
+    for i in range(0, len(waiting), 500):
+        result = scans.update({'id': {'$in': waiting[i:i + 500]}, 'state': 'CREATED'},
+                              {'$set': {'state': 'STOPPED', 'finished': datetime.datetime.utcnow()}}, multi=True)
+        stopped += result['n']
+    for scan_id in waiting:
+        refresh_latest_scan(scan_id)
+    for scan in scans.find({'campaign': campaign_id, 'state': {'$in': ['QUEUED', 'STARTED']}}, {'id': True}):
+        scans.update({'id': scan['id']}, {'$set': {'state': 'STOPPING'}})
+        record_event(scan['id'], 'scan-state', state='STOPPING')
+        refresh_latest_scan(scan['id'])
+        scan_stop.apply_async([scan['id']], queue='state')
+    if stopped:
+        campaign_scans_ended(campaign_id, 'STOPPED', stopped)
+
+#
+# Sites are scanned with a plan on a schedule, every interval seconds from
+# the creation of the schedule or at the times of a cron expression
+# (minute, hour, day of month, month and day of week, in UTC):
+#
+#  { 'id': '...', 'target': 'http://www.mozilla.com', 'plan': 'basic',
+#    'user': 'bob@example.org', 'interval': None, 'cron': '0 0 * * *',
+#    'jitter': None, 'enabled': True, 'smart_rescan': None, 'slot': ..., 'next_run': ...,
+#    'last_run': ..., 'last_scan': '...', 'missed': 0, 'skipped': 0 }
+#
+# The slot is the planned time of the next run. It runs at next_run, which
+# is the slot plus an offset that is derived from the id of the schedule,
+# so that schedules with the same slots are spread evenly over the jitter.
+# Runs that were missed, because the state worker was not running, are
+# coalesced into one. A run is skipped when the previous scan of the site
+# with the plan is still queued or running.
+#
+
+def parse_cron(expression):
+    """ Parse a cron expression into a crontab. Raises ValueError when
+    the expression is not valid. """
+    fields = expression.split()
+    if len(fields) != 5:
+        raise ValueError("A cron expression has five fields, not %d" % len(fields))
+    minute, hour, day_of_month, month_of_year, day_of_week = fields
+    # Sunday is both 0 and 7 in cron, but only 0 in a crontab
+    day_of_week = set(day % 7 for day in crontab_parser(8).parse(day_of_week))
+    return crontab(minute=minute, hour=hour, day_of_week=day_of_week,
+                   day_of_month=day_of_month, month_of_year=month_of_year)
+
+def next_cron_time(cron, after):
+    """ Return the first time after the given time that the crontab
+    matches, or None if it never does. """
+    day = after.replace(second=0, microsecond=0) + datetime.timedelta(minutes=1)
+    # The 29th of February on a given weekday can take 28 years to come around
+    for _ in range(366 * 28):
+        if day.month in cron.month_of_year and day.day in cron.day_of_month and day.isoweekday() % 7 in cron.day_of_week:
+            for hour in sorted(cron.hour):
+                for minute in sorted(cron.minute):
+                    t = day.replace(hour=hour, minute=minute)
+                    if t >= day:
+                        return t
+        day = (day + datetime.timedelta(days=1)).replace(hour=0, minute=0)
+    return None
+
+def schedule_offset(schedule):
+    """ Return how long after their slots the runs of the schedule start. """
+    jitter = schedule.get('jitter')
+    if jitter is None:
+        jitter = schedules_policy()['jitter']
+    if schedule.get('interval'):
+        jitter = min(jitter, schedule['interval'])
+    # Less than a second of jitter, also from the configuration, is none
+    jitter = int(jitter)
+    if jitter < 1:
+        return datetime.timedelta(0)
+    return datetime.timedelta(seconds=int(hashlib.sha1(schedule['id']).hexdigest(), 16) % jitter)
+
+def next_slot(schedule, after):
+    """ Return the first slot of the schedule after the given time. """
+    if schedule.get('cron'):
+        return next_cron_time(parse_cron(schedule['cron']), after)
+    interval = datetime.timedelta(seconds=schedule['interval'])
+    elapsed = after - schedule['created']
+    runs = int((elapsed.days * 86400 + elapsed.seconds) // schedule['interval']) + 1
+    return schedule['created'] + runs * interval
+
+def schedule_next_run(schedule, now):
+    """ Return the next slot and the time of the next run of the schedule
+    after the given time. """
+    offset = schedule_offset(schedule)
+    slot = next_slot(schedule, now - offset)
+    return slot, (slot + offset if slot else None)
+
+@celery.task(ignore_result=True)
+def run_scan_schedules():
+    """ Start the scans of the schedules that are due. """
+    now = datetime.datetime.utcnow()
+    for schedule in list(scan_schedules.find({'enabled': True, 'next_run': {'$lte': now}}).sort('next_run', 1)):
+        try:
+            run_scan_schedule(schedule, now)
+        except Exception as e:
+            logger.exception("(Ignored) failure while running schedule %s" % schedule['id'])
+
+def run_scan_schedule(schedule, now):
+    slot, next_run = schedule_next_run(schedule, now)
+    missed = 0
+    s = next_slot(schedule, schedule['slot'])
+    while s is not None and slot is not None and s < slot and missed < 1000:
+        missed += 1
+        s = next_slot(schedule, s)
+    claimed = scan_schedules.find_and_modify({'id': schedule['id'], 'next_run': schedule['next_run']},
+                                             {'$set': {'slot': slot, 'next_run': next_run},
+                                              '$inc': {'missed': missed}})
+    if not claimed:
+        return
+    running = scans.find_one({'configuration.target': schedule['target'], 'plan.name': schedule['plan'],
+                              'state': {'$in': ['QUEUED', 'STARTED', 'STOPPING']}}, {'id': True})
+    if running:
+        logger.info("Skipping schedule %s, scan %s is still running" % (schedule['id'], running['id']))
+        scan_schedules.update({'id': schedule['id']}, {'$inc': {'skipped': 1}})
+        return
+    plan = plans.find_one({'name': schedule['plan']})
+    if not plan:
+        logger.error("Cannot find plan %s of schedule %s" % (schedule['plan'], schedule['id']))
+        return
+    scan = new_scan(plan, plan_sessions(plan), {'target': schedule['target']}, schedule['user'], now)
+    scan['meta']['schedule'] = schedule['id']
+    if schedule.get('smart_rescan') is not None:
+        scan['smart_rescan'] = bool(schedule['smart_rescan'])
+    scans.insert(scan)
+    update_latest_scan(scan)
+    queue_scan(scan, 'scheduled')
+    scan_schedules.update({'id': schedule['id']}, {'$set': {'last_run': now, 'last_scan': scan['id']}})
+
 @celery.task
 def scan_start(scan_id, t):
     scans.update({"id": scan_id},
                  {"$set": {"state": "STARTED",
                            "started": datetime.datetime.utcfromtimestamp(t)}})
+    record_event(scan_id, 'scan-state', state='STARTED')
+    refresh_latest_scan(scan_id)
 
 @celery.task
 def scan_finish(scan_id, state, t, failure=None):
@@ -108,6 +1368,55 @@ def scan_finish(scan_id, state, t, failure=None):
                 s['state'] = 'CANCELLED'
                 scans.update({"id": scan_id, "sessions.id": s['id']},
                              {"$set": {"sessions.$.state": "CANCELLED"}})
+                record_event(scan_id, 'session-state', session=s['id'], state='CANCELLED')
+
+        record_event(scan_id, 'scan-state', state=state)
+        refresh_latest_scan(scan_id)
+
+        #
+        # Find out what changed since the previous scan
+        #
+
+        if state == 'FINISHED':
+            try:
+                diff_scan(scan_id)
+            except Exception as e:
+                logger.exception("(Ignored) failure while comparing scan %s with the previous scan" % scan_id)
+
+        #
+        # Count the issues in the daily rollups
+        #
+
+        if state == 'FINISHED':
+            try:
+                update_rollups(scans.find_one({'id': scan_id}))
+            except Exception as e:
+                logger.exception("(Ignored) failure while updating rollups for scan %s" % scan_id)
+
+        #
+        # Scans that were coalesced with this scan get its results
+        #
+
+        release_followers(scan_id, state)
+
+        #
+        # Count the scan in its campaign, which can then queue its next scan
+        #
+
+        if scan.get('campaign') and scan['state'] not in TERMINAL_STATES:
+            try:
+                campaign_scans_ended(scan['campaign'], state)
+            except Exception as e:
+                logger.exception("(Ignored) failure while updating campaign %s" % scan['campaign'])
+
+        #
+        # The scan no longer takes a slot, so the scheduler can release the next one
+        #
+
+        try:
+            dispatch_scans()
+        except Exception as e:
+            logger.exception("(Ignored) failure while releasing queued scans")
 
     except Exception as e:
 
@@ -117,6 +1426,7 @@ def scan_finish(scan_id, state, t, failure=None):
             scans.update({"id": scan_id},
                          {"$set": {"state": "FAILED",
                                    "finished": datetime.datetime.utcnow()}})
+            record_event(scan_id, 'scan-state', state='FAILED')
         except Exception as e:
             logger.exception("Error when marking scan as FAILED")
 
@@ -149,9 +1459,26 @@ def scan_stop(scan_id):
         for session in scan['sessions']:
             if session['state'] in ('QUEUED', 'STARTED'):
                 scans.update({"id": scan_id, "sessions.id": session['id']}, {"$set": {"sessions.$.state": "STOPPED", "sessions.$.finished": datetime.datetime.utcnow()}})
+                record_event(scan_id, 'session-state', session=session['id'], state='STOPPED')
             if '_task' in session:
                 revoke(session['_task'], terminate=True, signal='SIGUSR1')
 
+        record_event(scan_id, 'scan-state', state='STOPPED')
+        refresh_latest_scan(scan_id)
+
+        release_followers(scan_id, 'STOPPED')
+
+        if scan.get('campaign') and scan['state'] not in TERMINAL_STATES:
+            try:
+                campaign_scans_ended(scan['campaign'], 'STOPPED')
+            except Exception as e:
+                logger.exception("(Ignored) failure while updating campaign %s" % scan['campaign'])
+
+        try:
+            dispatch_scans()
+        except Exception as e:
+            logger.exception("(Ignored) failure while releasing queued scans")
+
     except Exception as e:
 
         logger.exception("Error while processing task. Marking scan as FAILED.")
@@ -159,6 +1486,7 @@ def scan_stop(scan_id):
         try:
             if scan:
                 scans.update({"id": scan_id}, {"$set": {"state": "FAILED", "finished": datetime.datetime.utcnow()}})
+                record_event(scan_id, 'scan-state', state='FAILED')
         except Exception as e:
             logger.exception("Error when marking scan as FAILED")
 
@@ -167,12 +1495,14 @@ def session_queue(scan_id, session_id, t):
     scans.update({"id": scan_id, "sessions.id": session_id},
                  {"$set": {"sessions.$.state": "QUEUED",
                            "sessions.$.queued": datetime.datetime.utcfromtimestamp(t)}})
+    record_event(scan_id, 'session-state', session=session_id, state='QUEUED')
 
 @celery.task
 def session_start(scan_id, session_id, t):
     scans.update({"id": scan_id, "sessions.id": session_id},
                  {"$set": {"sessions.$.state": "STARTED",
                            "sessions.$.started": datetime.datetime.utcfromtimestamp(t)}})
+    record_event(scan_id, 'session-state', session=session_id, state='STARTED')
 
 @celery.task
 def session_set_task_id(scan_id, session_id, task_id):
@@ -180,9 +1510,84 @@ def session_set_task_id(scan_id, session_id, task_id):
                  {"$set": {"sessions.$._task": task_id}})
 
 @celery.task
-def session_report_issue(scan_id, session_id, issue):
+def session_set_timings(scan_id, session_id, timings):
     scans.update({"id": scan_id, "sessions.id": session_id},
-                 {"$push": {"sessions.$.issues": issue}})
+                 {"$set": {"sessions.$.timings": timings}})
+
+@celery.task
+def session_record_run(plugin, state, duration, issue_count, rss):
+    record_plugin_run(plugin, state, duration, issue_count, rss)
+
+@celery.task
+def session_report_issue(scan_id, session_id, issue):
+    severity = issue.get('Severity', '').lower()
+    fields = {'configuration.target': True, 'plan.name': True, 'sessions.id': True, 'sessions.plugin': True}
+    if severity in SEVERITIES:
+        scan = scans.find_and_modify({"id": scan_id}, {"$inc": {"issues." + severity: 1}}, fields=fields)
+    else:
+        scan = scans.find_one({"id": scan_id}, fields)
+    if not scan:
+        logger.error("Cannot find scan %s" % scan_id)
+        return
+    plugin = find_session(scan, session_id)['plugin']
+    fingerprint = fingerprint_issue(plugin, issue)
+    template, issue = intern_issue(plugin, issue)
+    seq = record_event(scan_id, 'issue', session=session_id, issue=issue, template=template)
+    add_issue(scan_id, session_id, issue, template, fingerprint, seq, scan['configuration']['target'], scan['plan']['name'])
+
+#
+# The inputs of a plugin are the response headers of the target that it
+# looks at, see AbstractPlugin.inputs(). A smart rescan keeps a fingerprint
+# of them in each session:
+#
+#  { 'id': '...', 'state': 'FINISHED', 'fingerprint': '...',
+#    'carried_over': '<id of the previous scan>', ... }
+#
+# When the session of the same plugin in the previous scan has the same
+# fingerprint, the plugin is not run and the issues of that session are
+# copied with CarriedOver set to the id of the scan that found them.
+#
+
+def input_fingerprint(plugin, configuration, response):
+    """ Return the fingerprint of what the plugin looks at in the response. """
+    headers = dict((name, response.headers.get(name)) for name in plugin['inputs'])
+    return hashlib.sha1(json.dumps([plugin['class'], plugin['version'], configuration,
+                                    response.url, response.status, headers], sort_keys=True)).hexdigest()
+
+@celery.task
+def session_carry_over(scan_id, session_id, fingerprint):
+    """ Record the input fingerprint of the session. When the previous scan
+    has a finished session with the same fingerprint, finish the session
+    with its issues. Returns whether they were carried over. """
+    scans.update({"id": scan_id, "sessions.id": session_id}, {"$set": {"sessions.$.fingerprint": fingerprint}})
+    scan = scans.find_one({'id': scan_id}, {'configuration.target': True, 'plan.name': True})
+    latest = latest_scans.find_one({'target': scan['configuration']['target'], 'plan': scan['plan']['name']})
+    if not latest or not latest.get('finished'):
+        return False
+    previous = scans.find_one({'id': latest['finished']['id'], 'compacted': {'$exists': False}}, {'id': True, 'sessions': True})
+    matches = [s for s in (previous or {}).get('sessions', []) if s.get('fingerprint') == fingerprint and s['state'] == 'FINISHED']
+    if not matches:
+        return False
+    copied = list(issues.find({'scan_id': previous['id'], 'session_id': matches[0]['id']}).sort('seq', 1))
+    counts = {}
+    for issue in copied:
+        severity = (issue.get('severity') or '').lower()
+        if severity in SEVERITIES:
+            counts['issues.' + severity] = counts.get('issues.' + severity, 0) + 1
+    now = datetime.datetime.utcnow()
+    reserved = scans.find_and_modify({"id": scan_id, "sessions.id": session_id},
+                                     {"$set": {"sessions.$.state": "FINISHED",
+                                               "sessions.$.started": now,
+                                               "sessions.$.finished": now,
+                                               "sessions.$.carried_over": previous['id']},
+                                      "$inc": dict(counts, seq=len(copied))},
+                                     fields={'seq': True}, new=True)
+    events = copy_issues(scan_id, copied, {matches[0]['id']: session_id}, reserved['seq'] - len(copied), previous['id'])
+    for i in range(0, len(events), 500):
+        scan_events.insert(events[i:i + 500])
+    record_event(scan_id, 'session-state', session=session_id, state='FINISHED')
+    refresh_latest_scan(scan_id)
+    return True
 
 @celery.task
 def session_finish(scan_id, session_id, state, t, failure=None):
@@ -195,6 +1600,8 @@ def session_finish(scan_id, session_id, state, t, failure=None):
         scans.update({"id": scan_id, "sessions.id": session_id},
                      {"$set": {"sessions.$.state": state,
                                "sessions.$.finished": datetime.datetime.utcfromtimestamp(t)}})
+    record_event(scan_id, 'session-state', session=session_id, state=state)
+    refresh_latest_scan(scan_id)
 
 
 
@@ -351,11 +1758,49 @@ def find_session(scan, session_id):
         if session['id'] == session_id:
             return session
 
+# The phases of a plugin session that are timed, each as the name of the
+# phase and the timestamps it starts and ends with. The timestamps come
+# from run_plugin and from the finish message of the plugin runner.
+SESSION_PHASES = (('broker_wait', 'queued', 'received'),
+                  ('api_fetch', 'received', 'fetched'),
+                  ('spawn', 'spawning', 'spawned'),
+                  ('import', 'spawned', 'imported'),
+                  ('configure', 'imported', 'configured'),
+                  ('first_issue', 'started', 'first_issue'),
+                  ('run', 'started', 'finished'))
+
+def session_timings(timestamps, persist):
+    """ Turn the timestamps of a plugin session into the durations of its phases
+    in seconds. Phases of which a timestamp is missing are left out. """
+    timings = {'persist': round(persist, 3)}
+    for phase, start, end in SESSION_PHASES:
+        if timestamps.get(start) is not None and timestamps.get(end) is not None:
+            timings[phase] = round(max(0.0, timestamps[end] - timestamps[start]), 3)
+    return timings
+
 @celery.task
-def run_plugin(scan_id, session_id):
+def run_plugin(scan_id, session_id, queued=None):
 
     logger.debug("This is run_plugin " + str(scan_id) + " " + str(session_id))
 
+    #
+    # Keep track of where the time of this session goes. The time spent
+    # waiting on the state worker to persist the session is added up.
+    #
+
+    timestamps = {'queued': queued, 'received': time.time()}
+    persisted = [0.0]
+
+    session = None
+    issue_count = 0
+
+    def persist(task, args):
+        start = time.time()
+        try:
+            send_task(task, args, queue='state').get()
+        finally:
+            persisted[0] += time.time() - start
+
     try:
 
         #
@@ -364,6 +1809,7 @@ def run_plugin(scan_id, session_id):
         #
 
         scan = get_scan(cfg['api']['url'], scan_id)
+        timestamps['fetched'] = time.time()
         if not scan:
             logger.error("Cannot load scan %s" % scan_id)
             return
@@ -393,9 +1839,7 @@ def run_plugin(scan_id, session_id):
         # Move the session in the STARTED state
         #
 
-        send_task("minion.backend.tasks.session_start",
-                  [scan_id, session_id, time.time()],
-                  queue='state').get()
+        persist("minion.backend.tasks.session_start", [scan_id, session_id, time.time()])
 
         finished = None
 
@@ -423,6 +1867,7 @@ def run_plugin(scan_id, session_id):
                       "-p", session['plugin']['class'],
                       "-s", session_id ]
 
+        timestamps['spawning'] = time.time()
         p = subprocess.Popen(arguments, bufsize=1, stdout=subprocess.PIPE, close_fds=True)
 
         signal.signal(signal.SIGUSR1, make_signal_handler(p))
@@ -448,9 +1893,8 @@ def run_plugin(scan_id, session_id):
 
                 # Issue: persist it
                 if msg['msg'] == 'issue':
-                    send_task("minion.backend.tasks.session_report_issue",
-                              args=[scan_id, session_id, msg['data']],
-                              queue='state').get()
+                    issue_count += 1
+                    persist("minion.backend.tasks.session_report_issue", [scan_id, session_id, msg['data']])
 
                 # Progress: update the progress
                 if msg['msg'] == 'progress':
@@ -459,15 +1903,19 @@ def run_plugin(scan_id, session_id):
                 # Finish: update the session state, wait for the plugin runner to finish, return the state
                 if msg['msg'] == 'finish':
                     finished = msg['data']['state']
+                    timestamps.update(msg['data'].get('timestamps', {}))
                     if msg['data']['state'] in ('FINISHED', 'FAILED', 'STOPPED', 'TERMINATED', 'TIMEOUT', 'ABORTED'):
-                        send_task("minion.backend.tasks.session_finish",
-                                  [scan['id'], session['id'], msg['data']['state'], time.time()],
-                                  queue='state').get()
+                        persist("minion.backend.tasks.session_finish",
+                                [scan['id'], session['id'], msg['data']['state'], time.time()])
 
             except Queue.Empty:
                 pass
 
-        return_code = p.wait()
+        # Reap the plugin runner ourselves to find out how much memory it
+        # used. ru_maxrss is in kilobytes.
+        pid, status, rusage = os.wait4(p.pid, 0)
+        p.returncode = -os.WTERMSIG(status) if os.WIFSIGNALED(status) else os.WEXITSTATUS(status)
+        ended = time.time()
 
         signal.signal(signal.SIGUSR1, signal.SIG_DFL)
 
@@ -475,9 +1923,16 @@ def run_plugin(scan_id, session_id):
             failure = { "hostname": socket.gethostname(),
                         "message": "The plugin did not finish correctly",
                         "exception": None }
-            send_task("minion.backend.tasks.session_finish",
-                      [scan['id'], session['id'], 'FAILED', time.time(), failure],
-                      queue='state').get()
+            persist("minion.backend.tasks.session_finish",
+                    [scan['id'], session['id'], 'FAILED', time.time(), failure])
+
+        send_task("minion.backend.tasks.session_set_timings",
+                  [scan_id, session_id, session_timings(timestamps, persisted[0])],
+                  queue='state').get()
+
+        send_task("minion.backend.tasks.session_record_run",
+                  [session['plugin'], finished or 'FAILED', ended - timestamps['spawning'], issue_count, rusage.ru_maxrss * 1024],
+                  queue='state')
 
         return finished
 
@@ -498,6 +1953,10 @@ def run_plugin(scan_id, session_id):
             send_task("minion.backend.tasks.session_finish",
                       [scan_id, session_id, "FAILED", time.time(), failure],
                       queue='state').get()
+            if session:
+                send_task("minion.backend.tasks.session_record_run",
+                          [session['plugin'], "FAILED", None, issue_count, None],
+                          queue='state')
         except Exception as e:
             logger.exception("Error when marking scan as FAILED")
 
@@ -523,7 +1982,7 @@ def get_scan(api_url, scan_id):
 def queue_for_session(session, cfg):
     queue = 'plugin'
     if 'plugin_worker_queues' in cfg:
-        weight = session['plugin']['weight']
+        weight = session.get('weight') or session['plugin']['weight']
         if weight in ('heavy', 'light'):
             queue = cfg['plugin_worker_queues'][weight]
     return queue
@@ -592,6 +2051,11 @@ def scan(scan_id):
         # Run each plugin session
         #
 
+        smart_rescan = scan.get('smart_rescan')
+        if smart_rescan is None:
+            smart_rescan = rescan_policy()['smart']
+        response = None
+
         for session in scan['sessions']:
 
             #
@@ -604,6 +2068,27 @@ def scan(scan_id):
                       [scan['id'], session['id'], time.time()],
                       queue='state').get()
 
+            #
+            # In a smart rescan, plugins whose inputs have not changed are not run again
+            #
+
+            if smart_rescan and session['plugin'].get('inputs') is not None:
+                if response is None:
+                    try:
+                        response = minion.curly.get(target, connect_timeout=5, timeout=15)
+                    except minion.curly.CurlyError as e:
+                        logger.info("Cannot fetch %s, running all plugins of scan %s: %s" % (target, scan_id, e.message))
+                        response = False
+                if response:
+                    fingerprint = input_fingerprint(session['plugin'], session['configuration'], response)
+                    carried_over = send_task("minion.backend.tasks.session_carry_over",
+                                             [scan_id, session['id'], fingerprint],
+                                             queue='state').get()
+                    if carried_over:
+                        logger.info("Scan %s carried over the issues of plugin %s" % (scan['id'], session['plugin']['class']))
+                        session['state'] = 'FINISHED'
+                        continue
+
             #
             # Execute the plugin. The plugin worker will set the session state and issues.
             #
@@ -612,7 +2097,7 @@ def scan(scan_id):
 
             queue = queue_for_session(session, cfg)
             result = send_task("minion.backend.tasks.run_plugin",
-                               [scan_id, session['id']],
+                               [scan_id, session['id'], time.time()],
                                queue=queue)
 
             #scans.update({"id": scan_id, "sessions.id": session['id']}, {"$set": {"sessions.$._task": result.id}})
@@ -1,31 +1,66 @@
 #!/usr/bin/env python
 
 import calendar
+import collections
+import datetime
 import functools
-import importlib
-import inspect
+import hashlib
 import json
-import pkgutil
 import operator
 
-from flask import abort, Flask, jsonify, request, session
-from pymongo import MongoClient
+from flask import abort, Flask, jsonify, request, session, Response
+from flask import json as flask_json
+from pymongo import ASCENDING, DESCENDING
 
 from minion.backend.app import app
 import minion.backend.utils as backend_utils
+from minion.backend.metrics import InstrumentedMongoClient, MetricsMiddleware
 import minion.backend.tasks as tasks
-from minion.plugins.base import AbstractPlugin
+from minion.backend.registry import PluginRegistry
 
 backend_config = backend_utils.backend_config()
 
-mongo_client = MongoClient(host=backend_config['mongodb']['host'], port=backend_config['mongodb']['port'])
+mongo_client = InstrumentedMongoClient(host=backend_config['mongodb']['host'], port=backend_config['mongodb']['port'])
+access = mongo_client.minion.access
 invites = mongo_client.minion.invites
+campaigns = mongo_client.minion.campaigns
+issues = mongo_client.minion.issues
 groups = mongo_client.minion.groups
+host_limits = mongo_client.minion.host_limits
+latest_scans = mongo_client.minion.latest_scans
 plans = mongo_client.minion.plans
+plugin_stats = mongo_client.minion.plugin_stats
+request_metrics = mongo_client.minion.request_metrics
+rollups = mongo_client.minion.rollups
 scans = mongo_client.minion.scans
+scan_diffs = mongo_client.minion.scan_diffs
+scan_events = mongo_client.minion.scan_events
+scan_schedules = mongo_client.minion.scan_schedules
 sites = mongo_client.minion.sites
 users = mongo_client.minion.users
 
+for collection in (groups, scans, sites, users):
+    collection.ensure_index([('created', ASCENDING), ('id', ASCENDING)])
+invites.ensure_index([('sent_on', ASCENDING), ('id', ASCENDING)])
+plans.ensure_index([('created', ASCENDING), ('name', ASCENDING)])
+access.ensure_index('email', unique=True)
+campaigns.ensure_index('id', unique=True)
+scan_schedules.ensure_index('id', unique=True)
+host_limits.ensure_index('host', unique=True)
+request_metrics.ensure_index([('endpoint', ASCENDING), ('method', ASCENDING), ('status', ASCENDING)], unique=True)
+
+#
+# Every request is measured, see minion.backend.metrics. Requests that take
+# longer than api.slow_request_threshold seconds are logged.
+#
+
+app.wsgi_app = MetricsMiddleware(app.wsgi_app, request_metrics,
+                                 backend_config['api'].get('slow_request_threshold', 1.0))
+
+@app.before_request
+def name_request():
+    request.environ['minion.endpoint'] = request.endpoint
+
 def api_guard(*decor_args):
     """ Decorate a view function to be protected by requiring
     a secret key in X-Minion-Backend-Key header for the decorated
@@ -62,45 +97,61 @@ def api_guard(*decor_args):
         return decorator
 
 #
-# Build the plugin registry
-#
-
-plugins = {}
-
-def load_plugin():
-    """ Load plugins if they are subclass of AbstractPlugin and
-    are not known base subclasses such as BlockingPlugin. """
-
-    DEFAULT_BASE_CLASSES = ('AbstractPlugin', 'BlockingPlugin', 'ExternalProcessPlugin')
-    candidates = {}
-    base_package = importlib.import_module('minion.plugins')
-    prefix = base_package.__name__ + "."
-    for importer, package, ispkg in pkgutil.iter_modules(base_package.__path__, prefix):
-        module = __import__(package, fromlist=['plugins'])
-        for name in dir(module):
-            obj = getattr(module, name)
-            if inspect.isclass(obj) and issubclass(obj, AbstractPlugin) and name not in DEFAULT_BASE_CLASSES:
-                app.logger.info("Found %s" % str(obj))
-                plugin_name = module.__name__ + '.' + obj.__name__
-                candidates[plugin_name] = obj
-
-    for plugin_name, plugin_obj in candidates.iteritems():
-        try:
-            _register_plugin(plugin_name, plugin_obj)
-        except ImportError as e:
-            app.logger.error("Unable to import %s" % plugin_name)
-            pass
-
-def _register_plugin(plugin_name, plugin_class):
-    plugins[plugin_name] = {
-        'clazz': plugin_class,
-        'descriptor': {
-            'class': plugin_name,
-            'name': plugin_class.name(),
-            'version': plugin_class.version(),
-            'weight': plugin_class.weight()
-        }
-    }
+# The plugin registry. Plugins are only looked up when they are first
+# needed and their descriptors are cached in a manifest file.
+#
+
+plugins = PluginRegistry(backend_config.get('plugins', {}).get('manifest'))
+
+#
+# The access collection holds, for each user, the sites and the plans
+# that the user can see through group membership:
+#
+#  { 'email': 'bob@example.org',
+#    'sites': ['http://www.mozilla.com'],
+#    'plans': ['basic'] }
+#
+# It is derived from the groups and sites collections and must be
+# updated by every change to group membership, group sites or site plans.
+#
+
+def update_access(emails):
+    """ Recompute the access documents of the given users. """
+    emails = list(set(emails))
+    if not emails:
+        return
+    user_sites = dict((email, set()) for email in emails)
+    for group in groups.find({'users': {'$in': emails}}, {'users': True, 'sites': True}):
+        for email in group['users']:
+            if email in user_sites:
+                user_sites[email].update(group['sites'])
+    site_plans = {}
+    all_sites = set().union(*user_sites.values())
+    for site in sites.find({'url': {'$in': list(all_sites)}}, {'url': True, 'plans': True}):
+        site_plans[site['url']] = site.get('plans', [])
+    for email, sitez in user_sites.iteritems():
+        planz = set()
+        for url in sitez:
+            planz.update(site_plans.get(url, []))
+        access.update({'email': email},
+                      {'$set': {'sites': sorted(sitez), 'plans': sorted(planz)}},
+                      upsert=True)
+
+def find_access(email):
+    """ Return the access document of the user, creating it if it
+    does not exist yet. """
+    doc = access.find_one({'email': email})
+    if doc is None:
+        update_access([email])
+        doc = access.find_one({'email': email})
+    return doc
+
+def find_users_for_sites(urls):
+    """ Find the users that have access to any of the given sites. """
+    emails = set()
+    for group in groups.find({'sites': {'$in': list(urls)}}, {'users': True}):
+        emails.update(group['users'])
+    return emails
 
 def _check_required_fields(expected, fields):
     if isinstance(fields, dict):
@@ -119,4 +170,187 @@ def sanitize_session(session):
 def sanitize_time(t):
     return calendar.timegm(t.utctimetuple())
 
-load_plugin()
+#
+# Keyset pagination for list endpoints. A page is requested with
+#
+#  ?limit=<n>&after=<cursor>&fields=<field>,<field>
+#
+# The cursor is the "next" value returned with the previous page. It is
+# the time (in milliseconds) and key of the last document on that page.
+#
+
+def requested_fields():
+    """ Return the set of fields asked for with ?fields= or None, also
+    when no field names were given. """
+    fields = request.args.get('fields')
+    if fields:
+        return set(field.strip() for field in fields.split(',') if field.strip()) or None
+
+def _encode_page_cursor(t, key):
+    return "%d,%s" % (calendar.timegm(t.utctimetuple()) * 1000 + t.microsecond // 1000, key)
+
+def _decode_page_cursor(cursor):
+    t, key = cursor.split(',', 1)
+    t = int(t)
+    return datetime.datetime.utcfromtimestamp(t // 1000) + datetime.timedelta(milliseconds=t % 1000), key
+
+class Page(object):
+    """ Iterates the documents of a page as they are read from the
+    cursor. The cursor of the next page is known once the page has been
+    iterated and is None when there are no more documents. """
+
+    def __init__(self, cursor, key, time_key, limit, fields):
+        self._cursor = cursor
+        self._key = key
+        self._time_key = time_key
+        self._limit = limit
+        self._fields = fields
+        self._count = 0
+        self.next_cursor = None
+
+    def __iter__(self):
+        return self
+
+    def next(self):
+        document = self._cursor.next()
+        self._count += 1
+        if self._limit and self._count == self._limit:
+            self.next_cursor = _encode_page_cursor(document[self._time_key], document[self._key])
+        if self._fields is not None:
+            for field in (self._key, self._time_key):
+                if field not in self._fields:
+                    document.pop(field, None)
+        return document
+
+def iter_page(collection, query=None, key='id', time_key='created', descending=False, limit=None, fields=None):
+    """ Find a page of documents ordered by (time_key, key), starting
+    after the ?after= cursor and holding at most ?limit= documents. If
+    fields is given then only those fields are loaded from the database.
+    Returns a Page that reads the documents while it is iterated. Raises
+    ValueError when the request arguments are not valid. """
+    query = dict(query or {})
+    op, direction = ('$lt', DESCENDING) if descending else ('$gt', ASCENDING)
+    after = request.args.get('after')
+    if after:
+        t, k = _decode_page_cursor(after)
+        query['$or'] = [{time_key: {op: t}}, {time_key: t, key: {op: k}}]
+    limit = int(request.args.get('limit', limit or 0))
+    if limit < 0:
+        raise ValueError("Invalid limit %d" % limit)
+    projection = None
+    if fields is not None:
+        projection = dict((field, True) for field in set(fields) | set([key, time_key]))
+        projection['_id'] = False
+    cursor = collection.find(query, projection).sort([(time_key, direction), (key, direction)])
+    if limit:
+        cursor = cursor.limit(limit)
+    return Page(cursor, key, time_key, limit, fields)
+
+def find_page(collection, query=None, key='id', time_key='created', descending=False, limit=None, fields=None):
+    """ Like iter_page but loads the whole page. Returns the documents
+    and the cursor of the next page. """
+    page = iter_page(collection, query, key, time_key, descending, limit, fields)
+    documents = list(page)
+    return documents, page.next_cursor
+
+#
+# Streaming responses for endpoints that return large documents. The
+# JSON is encoded and sent in chunks instead of being built as one
+# string. Values that are iterators, like generators and Mongo cursors,
+# are encoded one item at a time as a JSON list, also when they are
+# nested in dicts and lists, so documents do not have to be loaded all
+# at once either. Values that are callables are called and sent last,
+# after the iterators whose results they depend on.
+#
+# Machine consumers can ask for newline delimited JSON instead with
+#
+#  ?format=ndjson  or  Accept: application/x-ndjson
+#
+# in which case every record is sent as a JSON document on its own line.
+#
+
+_encoder = flask_json.JSONEncoder(separators=(',', ':'))
+
+def _iterencode(value):
+    if isinstance(value, collections.Iterator):
+        yield '['
+        for i, item in enumerate(value):
+            if i:
+                yield ','
+            for chunk in _encoder.iterencode(item):
+                yield chunk
+        yield ']'
+    elif isinstance(value, dict):
+        yield '{'
+        for i, (name, item) in enumerate(value.iteritems()):
+            yield (',' if i else '') + _encoder.encode(name) + ':'
+            for chunk in _iterencode(item):
+                yield chunk
+        yield '}'
+    elif isinstance(value, (list, tuple)):
+        yield '['
+        for i, item in enumerate(value):
+            if i:
+                yield ','
+            for chunk in _iterencode(item):
+                yield chunk
+        yield ']'
+    else:
+        for chunk in _encoder.iterencode(value):
+            yield chunk
+
+def wants_ndjson():
+    """ Return True if the client asked for newline delimited JSON. """
+    if request.args.get('format') == 'ndjson':
+        return True
+    return request.accept_mimetypes.best == 'application/x-ndjson'
+
+def stream_json(**fields):
+    """ Like jsonify but streams the response. """
+    def generate():
+        yield '{'
+        ordered = sorted(fields.iteritems(), key=lambda field: callable(field[1]))
+        for i, (name, value) in enumerate(ordered):
+            yield (',' if i else '') + _encoder.encode(name) + ':'
+            for chunk in _iterencode(value() if callable(value) else value):
+                yield chunk
+        yield '}'
+    return Response(generate(), mimetype='application/json')
+
+def stream_ndjson(records):
+    """ Stream the records as newline delimited JSON. """
+    def generate():
+        for record in records:
+            yield _encoder.encode(record) + '\n'
+    return Response(generate(), mimetype='application/x-ndjson')
+
+#
+# Conditional requests. Responses carry a strong ETag and a client that
+# sends it back in If-None-Match gets a 304 Not Modified without a body.
+# The ETag is derived from a revision of the document when there is one,
+# or else from a hash of the response body.
+#
+
+def set_cache_headers(response, etag, cache_control='no-cache'):
+    """ Add the ETag and Cache-Control headers to the response. Unlike
+    make_conditional() this does not read the body, so that streamed
+    responses stay streamed. """
+    response.set_etag(etag)
+    response.headers['Cache-Control'] = cache_control
+    return response
+
+def not_modified(etag, cache_control='no-cache'):
+    """ Return a 304 response if the client already has the version with
+    the given ETag, or None. This allows to skip loading the document. """
+    if etag in request.if_none_match:
+        return set_cache_headers(Response(status=304), etag, cache_control)
+
+def conditional(response, etag, cache_control='no-cache'):
+    """ Add the ETag and Cache-Control headers to the response, or return
+    a 304 instead if the client already has this version. """
+    return not_modified(etag, cache_control) or set_cache_headers(response, etag, cache_control)
+
+def conditional_jsonify(**fields):
+    """ Like jsonify but with an ETag that is a hash of the body. """
+    response = jsonify(**fields)
+    return conditional(response, hashlib.sha1(response.data).hexdigest())
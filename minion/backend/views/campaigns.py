@@ -0,0 +1,171 @@
+#!/usr/bin/env python
+
+import calendar
+import datetime
+import uuid
+from flask import jsonify, request
+
+import minion.backend.tasks as tasks
+from minion.backend.app import app
+from minion.backend.views.base import api_guard, backend_config, campaigns, groups, plans, scans, sites, users
+from minion.backend.tasks import new_scan, plan_sessions
+from minion.backend.views.scans import SCAN_BATCH_LIMIT, SCAN_INSERT_SIZE
+
+# How many scans of a campaign run at the same time, unless the campaign says otherwise
+CAMPAIGN_MAX_RUNNING = backend_config['api'].get('campaign_max_running', 10)
+
+def sanitize_campaign(campaign):
+    for field in ('_id', 'ended'):
+        if field in campaign:
+            del campaign[field]
+    for field in ('created', 'finished'):
+        if campaign.get(field) is not None:
+            campaign[field] = calendar.timegm(campaign[field].utctimetuple())
+    return campaign
+
+def campaign_progress(campaign):
+    ended = campaign.get('ended', {})
+    running = scans.find({'campaign': campaign['id'], 'state': {'$in': list(tasks.CAMPAIGN_RUNNING_STATES)}}).count()
+    done = ended.get('FINISHED', 0)
+    failed = ended.get('FAILED', 0) + ended.get('ABORTED', 0)
+    stopped = ended.get('STOPPED', 0)
+    return {'total': campaign['total'],
+            'done': done,
+            'failed': failed,
+            'stopped': stopped,
+            'running': running,
+            'remaining': campaign['total'] - done - failed - stopped}
+
+#
+# Scan every site of a group with each of the plans of the site:
+#
+#  POST /campaigns
+#
+#  { "group": "mozilla",
+#    "user": "bob@example.org",
+#    "max_running": 10,
+#    "priority": "scheduled" }
+#
+# All scans are created right away and started at most max_running at a
+# time, which defaults to api.campaign_max_running. Users that are not
+# administrators must be members of the group. Returns the campaign:
+#
+#  { "success": true,
+#    "campaign": { "id": "b263bdc6-8692-4ace-aa8b-922b9ec0fc37",
+#                  "group": "mozilla",
+#                  "state": "STARTED",
+#                  "total": 250,
+#                  ... } }
+#
+# Or returns an error:
+#
+#  { "success": false, "reason": "invalid-campaign" }
+#  { "success": false, "reason": "unknown-priority" }
+#  { "success": false, "reason": "no-such-user" }
+#  { "success": false, "reason": "no-such-group" }
+#  { "success": false, "reason": "nothing-to-scan" }
+#  { "success": false, "reason": "campaign-too-large" }
+#
+
+@app.route('/campaigns', methods=['POST'])
+@api_guard('application/json')
+def create_campaign():
+    config = request.json
+    if not isinstance(config, dict):
+        return jsonify(success=False, reason='invalid-campaign')
+    max_running = config.get('max_running', CAMPAIGN_MAX_RUNNING)
+    if not isinstance(max_running, int) or isinstance(max_running, bool) or max_running < 1:
+        return jsonify(success=False, reason='invalid-campaign')
+    priority = config.get('priority', 'scheduled')
+    if priority not in tasks.SCAN_PRIORITIES:
+        return jsonify(success=False, reason='unknown-priority')
+    user = users.find_one({'email': config.get('user')})
+    if not user:
+        return jsonify(success=False, reason='no-such-user')
+    group = groups.find_one({'name': config.get('group')})
+    if not group or (user['role'] == 'user' and user['email'] not in group.get('users', [])):
+        return jsonify(success=False, reason='no-such-group')
+
+    # Every site of the group is scanned with each of its plans
+    targets = []
+    for site in sites.find({'url': {'$in': group.get('sites', [])}}, {'url': True, 'plans': True}).sort('url', 1):
+        for plan_name in site.get('plans', []):
+            targets.append((site['url'], plan_name))
+    found = dict((plan['name'], plan) for plan in plans.find({'name': {'$in': list(set(p for _, p in targets))}}))
+    targets = [(url, plan_name) for url, plan_name in targets if plan_name in found]
+    if not targets:
+        return jsonify(success=False, reason='nothing-to-scan')
+    if len(targets) > SCAN_BATCH_LIMIT:
+        return jsonify(success=False, reason='campaign-too-large')
+    sessions = dict((name, plan_sessions(plan)) for name, plan in found.iteritems())
+
+    now = datetime.datetime.utcnow()
+    campaign = { "id": str(uuid.uuid4()),
+                 "group": group['name'],
+                 "user": user['email'],
+                 "state": "STARTED",
+                 "priority": priority,
+                 "max_running": max_running,
+                 "total": len(targets),
+                 "ended": {},
+                 "created": now,
+                 "finished": None }
+    campaign_scans = []
+    for url, plan_name in targets:
+        scan = new_scan(found[plan_name], sessions[plan_name], {'target': url}, user['email'], now)
+        scan['campaign'] = campaign['id']
+        campaign_scans.append(scan)
+    for i in range(0, len(campaign_scans), SCAN_INSERT_SIZE):
+        scans.insert(campaign_scans[i:i + SCAN_INSERT_SIZE])
+    tasks.update_latest_scans(campaign_scans)
+    campaigns.insert(campaign)
+    tasks.advance_campaign.apply_async([campaign['id']], queue='state')
+    return jsonify(success=True, campaign=sanitize_campaign(campaign))
+
+#
+# Return a campaign and how far it got:
+#
+#  GET /campaigns/<campaign_id>
+#
+#  { "success": true,
+#    "campaign": { "id": "b263bdc6-8692-4ace-aa8b-922b9ec0fc37",
+#                  "state": "STARTED",
+#                  ...
+#                  "progress": { "total": 250, "done": 120, "failed": 2, "stopped": 0,
+#                                "running": 10, "remaining": 128 } } }
+#
+# Scans that failed or were aborted count as failed.
+#
+
+@app.route('/campaigns/<campaign_id>', methods=['GET'])
+@api_guard
+def get_campaign(campaign_id):
+    campaign = campaigns.find_one({'id': campaign_id})
+    if not campaign:
+        return jsonify(success=False, reason='no-such-campaign')
+    campaign['progress'] = campaign_progress(campaign)
+    return jsonify(success=True, campaign=sanitize_campaign(campaign))
+
+#
+# Stop a campaign
+#
+#  PUT /campaigns/<campaign_id>/control
+#
+# The body is STOP. Scans that have not started yet are not started and
+# the running ones are stopped. The campaign is STOPPING until all its
+# scans have ended and STOPPED after.
+#
+
+@app.route('/campaigns/<campaign_id>/control', methods=['PUT'])
+@api_guard
+def put_campaign_control(campaign_id):
+    campaign = campaigns.find_one({'id': campaign_id})
+    if not campaign:
+        return jsonify(success=False, error='no-such-campaign')
+    if request.data != 'STOP':
+        return jsonify(success=False, error='unknown-state')
+    if campaign['state'] != 'STARTED':
+        return jsonify(success=False, error='invalid-state-transition')
+    campaigns.update({'id': campaign_id, 'state': 'STARTED'}, {'$set': {'state': 'STOPPING'}})
+    tasks.stop_campaign.apply_async([campaign_id], queue='state')
+    return jsonify(success=True)
@@ -8,7 +8,7 @@ from flask import jsonify, request
 import minion.backend.utils as backend_utils
 import minion.backend.tasks as tasks
 from minion.backend.app import app
-from minion.backend.views.base import _check_required_fields, api_guard, groups, users, sites
+from minion.backend.views.base import _check_required_fields, api_guard, find_page, groups, requested_fields, update_access, users, sites
 
 def _check_group_exists(group_name):
     return groups.find_one({'name': group_name}) is not None
@@ -23,8 +23,10 @@ def sanitize_group(group):
 # Retrieve all groups in minion
 #
 #  GET /groups
+#  GET /groups?limit=100&after=<next>&fields=name,sites
 #
-# Returns a list of groups
+# Returns a list of groups. When a limit is given, next is the cursor
+# to pass as after to get the following page.
 #
 #  [{ 'id': 'b263bdc6-8692-4ace-aa8b-922b9ec0fc37',
 #     'created': 7261728192,
@@ -36,7 +38,11 @@ def sanitize_group(group):
 @app.route('/groups', methods=['GET'])
 @api_guard
 def list_groups():
-    return jsonify(success=True, groups=[sanitize_group(group) for group in groups.find()])
+    try:
+        page, next_cursor = find_page(groups, fields=requested_fields())
+    except ValueError:
+        return jsonify(success=False, reason='invalid-page')
+    return jsonify(success=True, groups=[sanitize_group(group) for group in page], next=next_cursor)
 
 #
 # Expects a partially filled out site as POST data:
@@ -91,6 +97,7 @@ def create_group():
                   'users': group.get('users', []),
                   'created': datetime.datetime.utcnow() }
     groups.insert(new_group)
+    update_access(new_group['users'])
     return jsonify(success=True, group=sanitize_group(new_group))
 
 @app.route('/groups/<group_name>', methods=['GET'])
@@ -114,6 +121,7 @@ def delete_group(group_name):
     if not group:
         return jsonify(success=False, reason='no-such-group')
     groups.remove({'name': group_name})
+    update_access(group['users'])
     return jsonify(success=True)
 
 #
@@ -150,6 +158,8 @@ def patch_group(group_name):
         if isinstance(user, unicode) or isinstance(user, str):
             groups.update({'name':group_name},{'$pull': {'users': user}})
     # Return the modified group
+    old_users = group['users']
     group = groups.find_one({'name': group_name})
+    update_access(old_users + group['users'])
     return jsonify(success=True, group=sanitize_group(group))
 
@@ -9,7 +9,7 @@ from flask import jsonify, request
 import minion.backend.utils as backend_utils
 import minion.backend.tasks as tasks
 from minion.backend.app import app
-from minion.backend.views.base import api_guard, backend_config, invites, users, groups, sites
+from minion.backend.views.base import api_guard, backend_config, find_page, invites, requested_fields, users, groups, sites
 from minion.backend.views.users import _find_groups_for_user, _find_sites_for_user, update_group_association, remove_group_association
 
 def send_email(action_type, data, extra_data=None):
@@ -54,13 +54,6 @@ def notify_on_action(action_type, invite_data):
         "subject": subject}
     return email_data
 
-def search(model, filters=None):
-    if filters:
-        filters = {field: value for field, value in filters.iteritems() if value is not None}
-        return model.find(filters)
-    else:
-        return model.find()
-
 def sanitize_invite(invite):
     if invite.get('_id'):
         del invite['_id']
@@ -149,8 +142,11 @@ def create_invites():
 # GET /invites
 # GET /invites?sender=<sender_email>
 # GET /invites?recipient=<recipient_email>
+# GET /invites?limit=100&after=<next>&fields=recipient,status
 #
 # Returns a list of invites based on filters. Default to no filter.
+# Invites are ordered by sent_on. When a limit is given, next is the
+# cursor to pass as after to get the following page.
 # [{'id': 7be9f3b0-ca70-45df-a78a-fc86e541b5d6,
 #   'recipient': 'recipient@example.org',
 #   'recipient_name': 'recipient',
@@ -168,8 +164,12 @@ def create_invites():
 def get_invites():
     recipient = request.args.get('recipient', None)
     sender = request.args.get('sender', None)
-    results = search(invites, filters={'sender': sender, 'recipient': recipient})
-    return jsonify(success=True, invites=sanitize_invites(results))
+    filters = {field: value for field, value in {'sender': sender, 'recipient': recipient}.iteritems() if value is not None}
+    try:
+        results, next_cursor = find_page(invites, filters, time_key='sent_on', fields=requested_fields())
+    except ValueError:
+        return jsonify(success=False, reason='invalid-page')
+    return jsonify(success=True, invites=sanitize_invites(results), next=next_cursor)
 
 # 
 # GET an invitation record given the invitation id
@@ -1,7 +1,8 @@
 #!/usr/bin/env python
 
-from flask import jsonify, request
-from minion.backend.views.base import api_guard, groups, sites, scans, sanitize_time
+from flask import request
+from minion.backend.views.base import (api_guard, groups, issues, latest_scans, sites, scans, sanitize_time,
+                                       stream_json, stream_ndjson, wants_ndjson)
 from minion.backend.app import app
 
 #
@@ -22,6 +23,9 @@ from minion.backend.app import app
 #      { site: "", scan_id: "", issue_id: "" }
 #    ] }
 #
+# The response is streamed. With ?format=ndjson each issue hit is
+# returned on its own line instead.
+#
 # Examples:
 #
 #
@@ -30,27 +34,30 @@ from minion.backend.app import app
 #   GET /issues?group_name=miniminion&plan_name=miniminion&issue_code=SD-0
 #
 
-#
-# TODO This is all really bad. We get away with it because mongo is so fast but we
-# obviously need to make some big changes in the data model.
-#
-
 @app.route('/issues', methods=['GET'])
 @api_guard
 def get_issues():
     issue_codes = request.args.getlist('issue_code')
 
-    issues = []
-
     group = groups.find_one({'name': request.args.get('group_name')})
+    sitez, scanz, issuez = [], {}, {}
     if group is not None:
-        for target in group['sites']:
-            scan = scans.find_one({"plan.name": request.args.get('plan_name'),
-                                   "configuration.target": target,
-                                   "state": "FINISHED",
-                                   "sessions.issues.Code": {"$in": issue_codes}},
-                                  {"id": 1, "created": 1, "started": 1, "finished": 1,
-                                   "configuration.target": 1, "sessions.issues.$": 1})
+        sitez = group['sites']
+        # Only look at the most recent finished scan of each site
+        scan_ids = [l['finished']['id'] for l in latest_scans.find({"target": {"$in": sitez},
+                                                                     "plan": request.args.get('plan_name'),
+                                                                     "finished": {"$exists": True}})]
+        for i in issues.find({"scan_id": {"$in": scan_ids}, "code": {"$in": issue_codes}},
+                             {"scan_id": 1, "session_id": 1, "seq": 1, "issue": 1}):
+            issuez.setdefault(i["scan_id"], []).append(i)
+        for scan in scans.find({"id": {"$in": issuez.keys()}},
+                               {"id": 1, "created": 1, "started": 1, "finished": 1,
+                                "configuration.target": 1, "sessions.id": 1, "sessions.plugin.class": 1}):
+            scanz[scan["configuration"]["target"]] = scan
+
+    def hits():
+        for target in sitez:
+            scan = scanz.get(target)
             if scan:
                 hit = {"site": {"url": scan["configuration"]["target"]},
                        "scan": {"id": scan["id"],
@@ -58,12 +65,16 @@ def get_issues():
                                 "started": sanitize_time(scan["started"]),
                                 "finished": sanitize_time(scan["finished"]),
                                 "sessions": []}}
+                found = sorted(issuez[scan["id"]], key=lambda i: i["seq"])
                 for session in scan["sessions"]:
                     s = {"plugin": {"class": session["plugin"]["class"]}, "issues": []}
-                    for issue in session['issues']:
-                        if issue['Code'] in issue_codes:
+                    for i in found:
+                        if i["session_id"] == session["id"]:
+                            issue = i["issue"]
                             s["issues"].append({"summary": issue["Summary"], "id": issue["Id"], "code": issue["Code"]})
                     hit["scan"]["sessions"].append(s)
-                issues.append(hit)
+                yield hit
 
-    return jsonify(success=True, issues=issues)
+    if wants_ndjson():
+        return stream_ndjson(hits())
+    return stream_json(success=True, issues=hits())
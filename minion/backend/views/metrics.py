@@ -0,0 +1,22 @@
+#!/usr/bin/env python
+from flask import Response
+
+from minion.backend.app import app
+from minion.backend.metrics import render_metrics
+from minion.backend.views.base import api_guard, request_metrics
+
+
+#
+# Return the request metrics of the API in the Prometheus text format
+#
+#  GET /metrics
+#
+# For every endpoint, method and status there is a latency histogram and
+# counters for the database operations made, the time spent in them and
+# the size of the responses.
+#
+
+@app.route("/metrics")
+@api_guard
+def get_metrics():
+    return Response(render_metrics(request_metrics), mimetype='text/plain; version=0.0.4')
@@ -3,7 +3,6 @@
 import calendar
 import datetime
 import functools
-import importlib
 import uuid
 
 from flask import jsonify, request
@@ -11,38 +10,17 @@ from flask import jsonify, request
 import minion.backend.utils as backend_utils
 import minion.backend.tasks as tasks
 from minion.backend.app import app
-from minion.backend.views.base import api_guard, plans, plugins, users, sites, groups
+from minion.backend.views.base import (api_guard, conditional, conditional_jsonify, find_access, find_page,
+                                       plans, plugins, requested_fields, users, sites, groups)
 
-def _plan_description(plan):
-    return {
-        'description': plan['description'],
-        'name': plan['name'],
-        'workflow': plan['workflow'],
-        'created' : plan['created'] }
+PLAN_DESCRIPTION_FIELDS = ('description', 'name', 'workflow', 'created')
 
 def get_plan_by_plan_name(plan_name):
     return plans.find_one({'name': plan_name})
 
-def get_sanitized_plans():
-    return [sanitize_plan(_plan_description(plan)) for plan in plans.find()]
-
 def _check_plan_by_email(email, plan_name):
-    plan = plans.find_one({'name': plan_name})
-    if not plan:
-        return False
-    sitez = sites.find({'plans': plan_name})
-    if sitez.count():
-        matches = 0
-        for site in sitez:
-            groupz = groups.find({'users': email, 'sites': site['url']})
-            if groupz.count():
-                matches += 1
-        return matches
-
-def get_plans_by_email(email):
-    plans = get_sanitized_plans()
-    matched_plans = [plan for plan in plans if _check_plan_by_email(email, plan["name"])]
-    return matched_plans
+    """ Check whether the plan is used by a site that the user can access. """
+    return plan_name in find_access(email)['plans']
 
 def permission(view):
     @functools.wraps(view)
@@ -56,7 +34,7 @@ def permission(view):
                 plan_name = request.view_args['plan_name']
                 if not _check_plan_by_email(email, plan_name):
                     return jsonify(success=False, reason="Plan does not exist.")
-        return view(*args, **kwargs) # if groupz.count is not zero, or user is admin
+        return view(*args, **kwargs) # if the user can access the plan, or user is admin
     return has_permission
 
 def sanitize_plan(plan):
@@ -67,15 +45,6 @@ def sanitize_plan(plan):
             plan[field] = calendar.timegm(plan[field].utctimetuple())
     return plan
 
-def _split_plugin_class_name(plugin_class_name):
-    e = plugin_class_name.split(".")
-    return '.'.join(e[:-1]), e[-1]
-
-def _import_plugin(plugin_class_name):
-    package_name, class_name = _split_plugin_class_name(plugin_class_name)
-    plugin_module = importlib.import_module(package_name, class_name)
-    return getattr(plugin_module, class_name)
-
 def _check_plan_workflow(workflow):
     """ Ensure plan workflow contain valid structure. """
     if not all(isinstance(plugin, dict) for plugin in workflow):
@@ -90,12 +59,18 @@ def _check_plan_workflow(workflow):
             return False
         if not isinstance(plugin['configuration'], dict):
             return False
-        try:
-            _import_plugin(plugin['plugin_name'])
-        except (AttributeError, ImportError):
+        if plugin['plugin_name'] not in plugins:
+            return False
+        if plugin.get('weight') not in (None, 'heavy', 'light'):
             return False
     return True
 
+def _plan_etag(plan):
+    """ The revision of a plan is incremented on every update. The
+    creation time tells plans apart that were deleted and created again
+    with the same name. """
+    return "%s-%d-%d" % (plan['name'], calendar.timegm(plan['created'].utctimetuple()), plan.get('revision', 0))
+
 def _check_plan_exists(plan_name):
     return plans.find_one({'name': plan_name}) is not None
 
@@ -106,13 +81,21 @@ def _check_plan_exists(plan_name):
 # limited to a specific user.
 #
 #  GET /plans
+#  GET /plans?limit=100&after=<next>&fields=name
 #
 # Returns an array of plan:
 #
 #  { "success": true,
 #    "plans": [ { "description": "Run an nmap scan",
 #                 "name": "nmap" },
-#               ... ] }
+#               ... ],
+#    "next": null }
+#
+# Plans are ordered by creation time and name. When a limit is given,
+# next is the cursor to pass as after to get the following page.
+#
+# The response has an ETag, so clients that poll can send it back
+# in If-None-Match and get a 304 Not Modified if nothing changed.
 #
 
 @app.route("/plans", methods=['GET'])
@@ -127,14 +110,23 @@ def get_plans():
             # Fill in the details of the plugin
             for step in plan['workflow']:
                 plugin = plugins.get(step['plugin_name'])
-            return jsonify(success=True, plans=[sanitize_plan(plan)])
+            return conditional_jsonify(success=True, plans=[sanitize_plan(plan)])
     else:
+        fields = requested_fields() or set(PLAN_DESCRIPTION_FIELDS)
+        try:
+            page, next_cursor = find_page(plans, key='name', fields=fields | set(['name']))
+        except ValueError:
+            return jsonify(success=False, reason='invalid-page')
         email = request.args.get('email')
         if email:
-            plans = get_plans_by_email(email)
-        else:
-            plans = get_sanitized_plans()
-        return jsonify(success=True, plans=plans)
+            allowed = find_access(email)['plans']
+            page = [plan for plan in page if plan['name'] in allowed]
+        planz = []
+        for plan in page:
+            if 'name' not in fields:
+                del plan['name']
+            planz.append(sanitize_plan(plan))
+        return conditional_jsonify(success=True, plans=planz, next=next_cursor)
 
 #
 # Delete an existing plan
@@ -154,6 +146,10 @@ def delete_plan(plan_name):
 #
 # Create a new plan
 #
+# A step in the workflow can have a "weight" of "heavy" or "light" to
+# choose the plugin worker queue its sessions run on. Otherwise this is
+# decided by the runtime statistics of the plugin.
+#
 
 @app.route("/plans", methods=['POST'])
 @api_guard('application/json')
@@ -171,7 +167,8 @@ def create_plan():
     new_plan = { 'name': plan['name'],
                  'description': plan['description'],
                  'workflow': plan['workflow'],
-                 'created': datetime.datetime.utcnow() }
+                 'created': datetime.datetime.utcnow(),
+                 'revision': 0 }
     plans.insert(new_plan)
 
     # Return the new plan
@@ -200,7 +197,7 @@ def update_plan(plan_name):
         changes['description'] = new_plan['description']
     if 'workflow' in new_plan:
         changes['workflow'] = new_plan['workflow']
-    plans.update({'name': plan_name}, {'$set': changes})
+    plans.update({'name': plan_name}, {'$set': changes, '$inc': {'revision': 1}})
     # Return the plan
     plan = plans.find_one({"name": plan_name})
     return jsonify(success=True, plan=sanitize_plan(plan))
@@ -223,6 +220,8 @@ def update_plan(plan_name):
 #                                           "weight": "light",
 #                                           "name": "NMAP" } } ] }
 #
+# The response has an ETag that changes when the plan is updated.
+#
 
 @app.route("/plans/<plan_name>", methods=['GET'])
 @api_guard
@@ -230,9 +229,10 @@ def update_plan(plan_name):
 def get_plan(plan_name):
     plan = get_plan_by_plan_name(plan_name)
     if plan:
+        etag = _plan_etag(plan)
         # Fill in the details of the plugin
         for step in plan['workflow']:
             plugin = plugins.get(step['plugin_name'])
-        return jsonify(success=True, plan=sanitize_plan(plan))
+        return conditional(jsonify(success=True, plan=sanitize_plan(plan)), etag)
     else:
         return jsonify(success=False, reason="Plan does not exist")
@@ -1,8 +1,9 @@
 #!/usr/bin/env python
-from flask import jsonify
+from flask import jsonify, request
 
 from minion.backend.app import app
-from minion.backend.views.base import api_guard, plugins
+import minion.backend.tasks as tasks
+from minion.backend.views.base import api_guard, conditional, not_modified, plugin_stats, plugins
 
 
 # API Methods to manage plugins
@@ -12,9 +13,32 @@ from minion.backend.views.base import api_guard, plugins
 #
 #  GET /plugins
 #
+# The ETag of the response changes when the installed plugins change.
+#
 
 @app.route("/plugins")
 @api_guard
 def get_plugins():
-    return jsonify(success=True, plugins=[plugin['descriptor'] for plugin in plugins.values()])
+    etag = plugins.revision()
+    return not_modified(etag) or conditional(jsonify(success=True, plugins=plugins.descriptors()), etag)
 
+#
+# Return runtime statistics of the plugins, per plugin class and version
+#
+#  GET /plugins/stats
+#  GET /plugins/stats?class=minion.plugins.basic.HSTSPlugin
+#
+# Each entry has the number of runs, the runs per session state, the
+# estimated p50/p95/p99 and mean duration in seconds, the failure and
+# abort rates, the issues reported per run and the average peak memory
+# (rss) of the plugin runner in bytes.
+#
+
+@app.route("/plugins/stats")
+@api_guard
+def get_plugin_stats():
+    query = {}
+    if request.args.get('class'):
+        query['class'] = request.args['class']
+    stats = [tasks.summarize_plugin_stats(s) for s in plugin_stats.find(query).sort([('class', 1), ('version', 1)])]
+    return jsonify(success=True, stats=stats)
@@ -6,15 +6,45 @@ import importlib
 import uuid
 
 from flask import jsonify, request
+from pymongo import ASCENDING
 
 import minion.backend.utils as backend_utils
 import minion.backend.tasks as tasks
 from minion.backend.app import app
-from minion.backend.views.base import api_guard, scans, sites, users
+from minion.backend.views.base import (api_guard, groups, iter_page, issues, latest_scans, requested_fields, rollups, scans,
+                                       sites, stream_json, stream_ndjson, users, wants_ndjson)
 from minion.backend.views.users import _find_sites_for_user, _find_sites_for_user_by_group_name
 from minion.backend.views.scans import sanitize_scan, summarize_scan
 
+# Fields needed to summarize a scan
+HISTORY_FIELDS = ('id', 'meta', 'state', 'configuration', 'plan', 'created', 'queued', 'finished',
+                  'sessions.id', 'sessions.plugin', 'sessions.state', 'issues')
+
+def _find_sites_by_url(urls):
+    """ Load the sites with the given urls in one query. """
+    return dict((site['url'], site) for site in sites.find({'url': {'$in': urls}}))
+
+def _find_latest_scans(urls):
+    """ Load the latest scan summaries for the given sites, keyed
+    by (target, plan). """
+    return dict(((l['target'], l['plan']), l) for l in latest_scans.find({'target': {'$in': urls}}))
+
+def _site_list(user_email, group_name):
+    if group_name:
+        return _find_sites_for_user_by_group_name(user_email, group_name)
+    return _find_sites_for_user(user_email)
+
+def _stream_report(report, **fields):
+    """ Stream the report, or just its entries as newline delimited
+    JSON when that was asked for. """
+    if wants_ndjson():
+        return stream_ndjson(report)
+    return stream_json(success=True, report=report, **fields)
+
 # API Methods to return reports
+#
+# Reports are streamed. With ?format=ndjson each entry of the report
+# is returned on its own line instead.
 
 #
 # Returns a scan history report, which is simply a list of all
@@ -22,22 +52,35 @@ from minion.backend.views.scans import sanitize_scan, summarize_scan
 #
 # If the user is specified then only scans are returned that
 # the user can see.
+#
+# The report returns 100 scans unless a limit is given. Older scans
+# are returned by passing the returned next cursor as after. The
+# fields of the scan summaries can be selected with fields:
+#
+#  GET /reports/history?limit=100&after=<next>&fields=id,state,issues
 
 @app.route('/reports/history', methods=['GET'])
 @api_guard
 def get_reports_history():
-    history = []
+    query = {}
     user_email = request.args.get('user')
     if user_email is not None:
         user = users.find_one({'email': user_email})
         if user is None:
             return jsonify(success=False, reason='no-such-user')
-        for s in scans.find({'configuration.target': {'$in': _find_sites_for_user(user_email)}}).sort("created", -1).limit(100):
-            history.append(summarize_scan(sanitize_scan(s)))
-    else:
-        for s in scans.find({}).sort("created", -1).limit(100):
-            history.append(summarize_scan(sanitize_scan(s)))
-    return jsonify(success=True, report=history)
+        query['configuration.target'] = {'$in': _find_sites_for_user(user_email)}
+    try:
+        page = iter_page(scans, query, descending=True, limit=100, fields=HISTORY_FIELDS)
+    except ValueError:
+        return jsonify(success=False, reason='invalid-page')
+    fields = requested_fields()
+    def history():
+        for s in page:
+            summary = summarize_scan(sanitize_scan(s))
+            if fields:
+                summary = dict((k, v) for k, v in summary.iteritems() if k in fields)
+            yield summary
+    return _stream_report(history(), next=lambda: page.next_cursor)
 
 #
 # Returns a status report that lists each site and attached plans
@@ -57,30 +100,28 @@ def get_reports_history():
 @app.route('/reports/status', methods=['GET'])
 @api_guard
 def get_reports_sites():
-    result = []
     group_name = request.args.get('group_name')
     user_email = request.args.get('user')
-    if user_email is not None:
-        # User specified, so return recent scans for each site/plan that the user can see
-        user = users.find_one({'email': user_email})
-        if user is None:
-            return jsonify(success=False, reason='no-such-user')
-        if group_name:
-            site_list = _find_sites_for_user_by_group_name(user_email, group_name)
-        else:
-            site_list = _find_sites_for_user(user_email)
+    if user_email is None:
+        return _stream_report(iter([]))
+    # User specified, so return recent scans for each site/plan that the user can see
+    user = users.find_one({'email': user_email})
+    if user is None:
+        return jsonify(success=False, reason='no-such-user')
+    site_list = _site_list(user_email, group_name)
+    sitez = _find_sites_by_url(site_list)
+    latest = _find_latest_scans(site_list)
+    def report():
         for site_url in sorted(site_list):
-            site = sites.find_one({'url': site_url})
+            site = sitez.get(site_url)
             if site is not None:
                 for plan_name in site['plans']:
-                    l = list(scans.find({'configuration.target':site['url'], 'plan.name': plan_name}).sort("created", -1).limit(1))
-                    if len(l) == 1:
-                        scan = summarize_scan(sanitize_scan(l[0]))
-                        s = {v: scan.get(v) for v in ('id', 'created', 'state', 'issues')}
-                        result.append({'target': site_url, 'plan': plan_name, 'scan': scan})
+                    l = latest.get((site_url, plan_name))
+                    if l is not None:
+                        yield {'target': site_url, 'plan': plan_name, 'scan': sanitize_scan(l['scan'])}
                     else:
-                        result.append({'target': site_url, 'plan': plan_name, 'scan': None})
-    return jsonify(success=True, report=result)
+                        yield {'target': site_url, 'plan': plan_name, 'scan': None}
+    return _stream_report(report())
 
 #
 # Returns a status report that lists each site and attached plans
@@ -98,30 +139,126 @@ def get_reports_sites():
 @app.route('/reports/issues', methods=['GET'])
 @api_guard
 def get_reports_issues():
-    result = []
     group_name = request.args.get('group_name')
     user_email = request.args.get('user')
-    if user_email is not None:
-        # User specified, so return recent scans for each site/plan that the user can see
-        user = users.find_one({'email': user_email})
-        if user is None:
-            return jsonify(success=False, reason='no-such-user')
-        if group_name:
-            site_list = _find_sites_for_user_by_group_name(user_email, group_name)
-        else:
-            site_list = _find_sites_for_user(user_email)
-
+    if user_email is None:
+        return _stream_report(iter([]))
+    # User specified, so return recent scans for each site/plan that the user can see
+    user = users.find_one({'email': user_email})
+    if user is None:
+        return jsonify(success=False, reason='no-such-user')
+    site_list = _site_list(user_email, group_name)
+    sitez = _find_sites_by_url(site_list)
+    latest = _find_latest_scans(site_list)
+    def report():
         for site_url in sorted(site_list):
             r = {'target': site_url, 'issues': []}
-            site = sites.find_one({'url': site_url})
+            site = sitez.get(site_url)
             if site is not None:
                 for plan_name in site['plans']:
-                    for s in scans.find({'configuration.target':site['url'], 'plan.name': plan_name}).sort("created", -1).limit(1):
-                        for session in s['sessions']:
-                            for issue in session['issues']:
-                                r['issues'].append({'severity': issue['Severity'],
-                                                    'summary': issue['Summary'],
-                                                    'scan': { 'id': s['id'] },
-                                                    'id': issue['Id']})
-            result.append(r)
-    return jsonify(success=True, report=result)
+                    l = latest.get((site_url, plan_name))
+                    if l is not None:
+                        scan_id = l['scan']['id']
+                        for i in issues.find({'scan_id': scan_id}, {'issue': 1}).sort('seq', ASCENDING):
+                            issue = i['issue']
+                            r['issues'].append({'severity': issue['Severity'],
+                                                'summary': issue['Summary'],
+                                                'scan': { 'id': scan_id },
+                                                'id': issue['Id']})
+            yield r
+    return _stream_report(report())
+
+def _find_trend(scope, keys, first_day, last_day):
+    """ Return the rollups of the keys for each day from first_day to
+    last_day, summed over the keys. A key without rollup on a day has
+    the same rollup as the day before. Site rollups are per site and plan,
+    so there sites is the number of different sites that have one. """
+    days = []
+    day = first_day
+    while day <= last_day:
+        days.append(day.strftime('%Y-%m-%d'))
+        day += datetime.timedelta(days=1)
+    trend = dict((d, {'day': d, 'issues': dict((s, 0) for s in tasks.SEVERITIES), 'codes': {}, 'sites': 0}) for d in days)
+    site_urls = dict((d, set()) for d in days)
+    first = tasks.find_rollups(scope, keys, days[0])
+    later = {}
+    for r in rollups.find({'scope': scope, 'key': {'$in': keys}, 'day': {'$gt': days[0], '$lte': days[-1]}}):
+        later.setdefault(r['key'], {})[r['day']] = r
+    for key in keys:
+        current = first.get(key)
+        for d in days:
+            current = later.get(key, {}).get(d, current)
+            if current is not None:
+                for name, n in current['issues'].iteritems():
+                    trend[d]['issues'][name] = trend[d]['issues'].get(name, 0) + n
+                for name, n in current['codes'].iteritems():
+                    code = tasks.rollup_code(name)
+                    trend[d]['codes'][code] = trend[d]['codes'].get(code, 0) + n
+                if scope == 'site':
+                    site_urls[d].add(key.split(' ', 1)[0])
+                else:
+                    trend[d]['sites'] += current['sites']
+    for d in days:
+        trend[d]['codes'] = dict((code, n) for code, n in trend[d]['codes'].iteritems() if n)
+        if scope == 'site':
+            trend[d]['sites'] = len(site_urls[d])
+    return [trend[d] for d in days]
+
+#
+# Returns the daily issue counts of a site, a group or of all sites:
+#
+#  GET /reports/trends?site=http://www.mozilla.com&plan_name=basic&days=30
+#  GET /reports/trends?group_name=mozilla&days=30
+#  GET /reports/trends?days=30
+#
+# Without a plan_name the counts of all plans of the site are added up.
+# The trend of a group is that of the sites that are in the group now.
+# For each day, issues holds the issues by severity found by the last
+# finished scans of the sites, codes holds for each issue code how many
+# of those scans found that code and sites holds the number of sites.
+#
+# If the user is specified then only sites and groups that the user can
+# see are allowed, and the report of all sites is not.
+#
+#  { 'report':
+#       [{ 'day': '2013-06-01',
+#          'issues': { 'high': 3, 'medium': 0, 'low': 12, 'info': 40 },
+#          'codes': { 'XFO-2': 2 },
+#          'sites': 6 }],
+#    'success': True }
+
+@app.route('/reports/trends', methods=['GET'])
+@api_guard
+def get_reports_trends():
+    try:
+        days = int(request.args.get('days', 30))
+    except ValueError:
+        return jsonify(success=False, reason='invalid-days')
+    if days < 1 or days > 366:
+        return jsonify(success=False, reason='invalid-days')
+    site_url = request.args.get('site')
+    group_name = request.args.get('group_name')
+    user_email = request.args.get('user')
+    if user_email is not None:
+        if users.find_one({'email': user_email}) is None:
+            return jsonify(success=False, reason='no-such-user')
+        if site_url is None and group_name is None:
+            return jsonify(success=False, reason='not-found')
+    if site_url is not None:
+        site = sites.find_one({'url': site_url})
+        if site is None or (user_email is not None and site_url not in _find_sites_for_user(user_email)):
+            return jsonify(success=False, reason='no-such-site')
+        plan_names = [request.args['plan_name']] if request.args.get('plan_name') else site['plans']
+        scope, keys = 'site', ["%s %s" % (site_url, plan_name) for plan_name in plan_names]
+    elif group_name is not None:
+        group = groups.find_one({'name': group_name})
+        if group is None or (user_email is not None and user_email not in group['users']):
+            return jsonify(success=False, reason='no-such-group')
+        scope, keys = 'site', ["%s %s" % (site['url'], plan_name)
+                               for site in sites.find({'url': {'$in': group['sites']}}, {'url': True, 'plans': True})
+                               for plan_name in site['plans']]
+    else:
+        scope, keys = 'global', ['']
+    last_day = datetime.datetime.utcnow().date()
+    first_day = last_day - datetime.timedelta(days=days - 1)
+    return jsonify(success=True, report=_find_trend(scope, keys, first_day, last_day))
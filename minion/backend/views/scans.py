@@ -3,15 +3,36 @@
 import calendar
 import datetime
 import functools
-import uuid
-from flask import jsonify, request
+import json
+from flask import jsonify, request, Response
+from pymongo import ASCENDING
 
 import minion.backend.utils as backend_utils
 import minion.backend.tasks as tasks
 from minion.backend.app import app
-from minion.backend.views.base import api_guard, groups, plans, plugins, scans, sanitize_session, users, sites
+from minion.backend.tasks import TERMINAL_STATES, expand_issue, new_scan, plan_sessions, summarize_scan
+from minion.backend.views.base import (api_guard, backend_config, conditional, find_access, groups, issues, latest_scans,
+                                       not_modified, plans, scans, scan_diffs, scan_events, sanitize_session, sanitize_time, set_cache_headers,
+                                       stream_json, stream_ndjson, users, sites, wants_ndjson)
 from minion.backend.views.plans import sanitize_plan
 
+TERMINAL_CACHE_CONTROL = 'private, max-age=86400'
+
+# The most scans that can be created with one request
+SCAN_BATCH_LIMIT = backend_config['api'].get('scan_batch_limit', 20000)
+
+# Scans are inserted this many at a time, to stay below the message size
+SCAN_INSERT_SIZE = 500
+
+# How long clients wait before they ask for more events, in milliseconds.
+# Requests for events do not wait, so this sets how often every watching
+# client looks for new events.
+EVENT_RETRY = backend_config['api'].get('event_retry', 1000)
+
+# Events are numbered before they are written, so for a moment a later
+# event can be visible while an earlier one is not yet.
+EVENT_GAP_TIMEOUT = datetime.timedelta(seconds=10)
+
 def permission(view):
     @functools.wraps(view)
     def has_permission(*args, **kwargs):
@@ -20,12 +41,11 @@ def permission(view):
             user = users.find_one({'email': email})
             if not user:
                 return jsonify(success=False, reason='user-does-not-exist')
-            scan = scans.find_one({"id": kwargs['scan_id']})
+            scan = scans.find_one({"id": kwargs['scan_id']}, {'configuration.target': True})
             if user['role'] == 'user':
-                groupz = groups.find({'users': email, 'sites': scan['configuration']['target']})
-                if not groupz.count():
+                if scan['configuration']['target'] not in find_access(email)['sites']:
                     return jsonify(success=False, reason='not-found')
-        return view(*args, **kwargs) # if groupz.count is not zero, or user is admin
+        return view(*args, **kwargs) # if the user can access the site, or user is admin
     return has_permission
 
 def sanitize_scan(scan):
@@ -36,52 +56,230 @@ def sanitize_scan(scan):
     for field in ('created', 'queued', 'started', 'finished'):
         if scan.get(field) is not None:
             scan[field] = calendar.timegm(scan[field].utctimetuple())
+    if scan.get('schedule'):
+        schedule = scan['schedule']
+        for field in ('rank', 'tag'):
+            schedule.pop(field, None)
+        for field in ('dispatched', 'eta'):
+            if schedule.get(field) is not None:
+                schedule[field] = calendar.timegm(schedule[field].utctimetuple())
     if 'sessions' in scan:
         for session in scan['sessions']:
             sanitize_session(session)
     return scan
 
-def summarize_scan(scan):
-    def _count_issues(scan, severity):
-        count = 0
-        for session in scan['sessions']:
-            for issue in session['issues']:
-                if issue['Severity'] == severity:
-                    count += 1
-        return count
-    summary = { 'id': scan['id'],
-                'meta': scan['meta'],
-                'state': scan['state'],
-                'configuration': scan['configuration'],
-                'plan': scan['plan'],
-                'sessions': [ ],
-                'created': scan.get('created'),
-                'queued': scan.get('queued'),
-                'finished': scan.get('finished'),
-                'issues': { 'high': _count_issues(scan, 'High'),
-                            'low': _count_issues(scan, 'Low'),
-                            'medium': _count_issues(scan, 'Medium'),
-                            'info': _count_issues(scan, 'Info') } }
+def describe_schedule(scan):
+    """ Add the queue position and the estimated start time to a scan that
+    is waiting for the scheduler. """
+    position = tasks.queue_position(scan)
+    if position is not None:
+        scan['schedule']['position'] = position
+        scan['schedule']['eta'] = tasks.estimate_start(position)
+
+def find_issues(scan_id):
+    """ Return the issues of the scan in the order they were reported. """
+    return issues.find({'scan_id': scan_id}, {'session_id': True, 'template': True, 'issue': True}).sort('seq', ASCENDING)
+
+def session_issues(scan_id, session_id):
+    """ Iterate the issues of a session in the order they were reported. """
+    for issue in issues.find({'scan_id': scan_id, 'session_id': session_id},
+                             {'template': True, 'issue': True}).sort('seq', ASCENDING):
+        yield expand_issue(issue.get('template'), issue['issue'])
+
+def load_issues(scan):
+    """ Put the issues of the scan back in its sessions. The issues are
+    only read from the database while the response is sent. """
     for session in scan['sessions']:
-        summary['sessions'].append({ 'plugin': session['plugin'],
-                                     'id': session['id'],
-                                     'state': session['state'] })
-    return summary
+        session['issues'] = session_issues(scan['id'], session['id'])
+    return scan
+
+def find_events(scan_id, since):
+    """ Return the events of the scan after the since sequence number.
+    Stops at a missing sequence number, unless the events after it are
+    old enough to know that it will not show up anymore. """
+    events = []
+    for event in scan_events.find({'scan_id': scan_id, 'seq': {'$gt': since}}).sort('seq', ASCENDING):
+        if event['seq'] != since + 1 and event['created'] > datetime.datetime.utcnow() - EVENT_GAP_TIMEOUT:
+            break
+        since = event['seq']
+        events.append(event)
+    return events
+
+def sanitize_event(event):
+    if event.get('_id'):
+        del event['_id']
+    if event['type'] == 'issue':
+        event['issue'] = expand_issue(event.pop('template', None), event['issue'])
+    event['created'] = sanitize_time(event['created'])
+    return event
+
+def _find_scan_changes(scan_id, since):
+    """ Return the scan with only the sessions that changed after the
+    since sequence number, and in those only the issues reported since. """
+    # The events are read first so that the state of the sessions is never
+    # older than the returned seq. At worst a change is returned twice.
+    events = find_events(scan_id, since)
+    scan = scans.find_one({"id": scan_id})
+    if not scan:
+        return None
+    changes = {}
+    for event in events:
+        if 'session' in event:
+            issues = changes.setdefault(event['session'], [])
+            if event['type'] == 'issue':
+                issues.append(expand_issue(event.get('template'), event['issue']))
+    sessions = []
+    for session in scan['sessions']:
+        if session['id'] in changes:
+            session['issues'] = changes[session['id']]
+            sessions.append(session)
+    scan['sessions'] = sessions
+    scan['seq'] = events[-1]['seq'] if events else since
+    return scan
+
+def _scan_records(scan):
+    """ Split a scan in records for a newline delimited response: the
+    scan without issues, followed by each issue and its session id. """
+    yield {'scan': scan}
+    for issue in find_issues(scan['id']):
+        yield {'session': issue['session_id'], 'issue': expand_issue(issue.get('template'), issue['issue'])}
 
 # API Methods to manage scans
 
 #
-# Return a scan. Returns the full scan including all issues.
+# Return a scan. Returns the full scan including all issues. The
+# response is streamed. With ?format=ndjson the first line holds
+# the scan without issues and every following line holds an issue:
+#
+#  {"scan": {"id": ..., "sessions": [...]}}
+#  {"session": "<session id>", "issue": {...}}
+#
+# Scans that are finished, failed, aborted or stopped have an ETag and
+# can be cached, other scans are sent with Cache-Control: no-cache.
+#
+# Old scans that have been compacted have compacted set and no longer
+# have their issues, only the counts and the codes in issue_codes.
+#
+# Clients that poll a scan can ask for just what changed since the last
+# time with the seq of the scan they got then:
+#
+#  GET /scans/<scan_id>?since=<seq>
+#
+# This returns the scan with only the sessions whose state changed, with
+# only the issues that were reported after that. The returned seq is
+# the one to pass the next time.
 #
 
 @app.route("/scans/<scan_id>")
 @api_guard
 @permission
 def get_scan(scan_id):
+    since = request.args.get('since')
+    if since is not None:
+        try:
+            scan = _find_scan_changes(scan_id, int(since))
+        except ValueError:
+            return jsonify(success=False, reason='invalid-since')
+        if not scan:
+            return jsonify(success=False, reason='not-found')
+        response = jsonify(success=True, scan=sanitize_scan(scan))
+        response.headers['Cache-Control'] = 'no-cache'
+        return response
+    ndjson = wants_ndjson()
+    etag = None
+    state = scans.find_one({"id": scan_id}, {'state': True, 'compacted': True})
+    if state and state['state'] in TERMINAL_STATES:
+        etag = "%s-%s%s%s" % (scan_id, state['state'], '-compacted' if state.get('compacted') else '',
+                              '-ndjson' if ndjson else '')
+        response = not_modified(etag, TERMINAL_CACHE_CONTROL)
+        if response:
+            return response
     scan = scans.find_one({"id": scan_id})
     if not scan:
         return jsonify(success=False, reason='not-found')
-    return jsonify(success=True, scan=sanitize_scan(scan))
+    describe_schedule(scan)
+    scan = sanitize_scan(scan)
+    if ndjson:
+        response = stream_ndjson(_scan_records(scan))
+    else:
+        response = stream_json(success=True, scan=load_issues(scan))
+    if etag and scan['state'] in TERMINAL_STATES:
+        # The 304 was handled above, before the scan was loaded
+        return set_cache_headers(response, etag, TERMINAL_CACHE_CONTROL)
+    response.headers['Cache-Control'] = 'no-cache'
+    return response
+
+#
+# Follow a scan as server-sent events. Every state change of the scan or
+# its sessions and every reported issue is sent as an event when it
+# happens:
+#
+#  GET /scans/<scan_id>/events?since=<seq>
+#
+#  id: 12
+#  event: issue
+#  data: {"seq": 12, "type": "issue", "session": "...", "issue": {...}, ...}
+#
+# Events are sent after the since sequence number or the Last-Event-ID
+# header. Without either, only new events are sent. The response holds
+# the events that are there and ends right away, so that it never holds
+# an API worker while it waits. Clients ask again after event_retry
+# milliseconds (default 1000) with the id of the last event they got,
+# which is what EventSource does by itself. The response has no events
+# once the scan has finished, failed, aborted or stopped and all its
+# events were sent.
+#
+
+@app.route("/scans/<scan_id>/events")
+@api_guard
+@permission
+def get_scan_events(scan_id):
+    scan = scans.find_one({"id": scan_id}, {'state': True, 'seq': True})
+    if not scan:
+        return jsonify(success=False, reason='not-found')
+    try:
+        since = int(request.args.get('since', request.headers.get('Last-Event-ID', scan.get('seq', 0))))
+    except ValueError:
+        return jsonify(success=False, reason='invalid-since')
+    events = find_events(scan_id, since)
+    body = ["retry: %d\n\n" % EVENT_RETRY]
+    for event in events:
+        body.append("id: %d\nevent: %s\ndata: %s\n\n" % (event['seq'], event['type'], json.dumps(sanitize_event(event))))
+    return Response(''.join(body), mimetype='text/event-stream', headers={'Cache-Control': 'no-cache'})
+
+#
+# Return what changed since the previous finished scan of the same site
+# and plan. The issues are compared by their fingerprint:
+#
+#  GET /scans/<scan_id>/diff
+#
+#  { "success": true,
+#    "diff": { "scan": "<scan_id>",
+#              "previous": "<scan_id>",
+#              "new": [ { "fingerprint": "...", "id": "...", "session": "...",
+#                         "code": "XFO-2", "severity": "High", "summary": "..." } ],
+#              "fixed": [...],
+#              "unchanged": [...] } }
+#
+# The fixed issues are those of the previous scan. The diff is made when
+# the scan has finished, so other scans do not have one.
+#
+
+@app.route("/scans/<scan_id>/diff")
+@api_guard
+@permission
+def get_scan_diff(scan_id):
+    diff = scan_diffs.find_one({"scan_id": scan_id})
+    if not diff:
+        if scans.find_one({"id": scan_id}, {'id': True}) is None:
+            return jsonify(success=False, reason='not-found')
+        return jsonify(success=False, reason='no-diff')
+    return conditional(jsonify(success=True, diff={'scan': diff['scan_id'],
+                                                   'previous': diff['previous'],
+                                                   'new': diff['new'],
+                                                   'fixed': diff['fixed'],
+                                                   'unchanged': diff['unchanged']}),
+                       scan_id + '-diff', TERMINAL_CACHE_CONTROL)
 
 #
 # Return a scan summary. Returns just the basic info about a scan
@@ -105,9 +303,14 @@ def get_scan_summary(scan_id):
 #      "plan": "tickle",
 #      "configuration": {
 #        "target": "http://foo"
-#      }
+#      },
+#      "smart_rescan": true
 #   }
 #
+# A smart rescan does not run the plugins whose inputs have not changed
+# since the previous finished scan, but carries their issues over. Without
+# smart_rescan, the rescan.smart setting of the backend decides.
+#
 
 @app.route("/scans", methods=["POST"])
 @api_guard('application/json')
@@ -119,38 +322,98 @@ def post_scan_create():
     plan = plans.find_one({"name": configuration['plan']})
     if not plan:
         return jsonify(success=False)
-    # Merge the configuration
-    # Create a scan object
-    now = datetime.datetime.utcnow()
-    scan = { "id": str(uuid.uuid4()),
-             "state": "CREATED",
-             "created": now,
-             "queued": None,
-             "started": None,
-             "finished": None,
-             "plan": { "name": plan['name'], "revision": 0 },
-             "configuration": configuration['configuration'],
-             "sessions": [],
-             "meta": { "user": configuration['user'], "tags": [] } }
-    for step in plan['workflow']:
-        session_configuration = step['configuration']
-        session_configuration.update(configuration['configuration'])
-        session = { "id": str(uuid.uuid4()),
-                    "state": "CREATED",
-                    "plugin": plugins[step['plugin_name']]['descriptor'],
-                    "configuration": session_configuration, # TODO Do recursive merging here, not just at the top level
-                    "description": step["description"],
-                    "artifacts": {},
-                    "issues": [],
-                    "created": now,
-                    "queued": None,
-                    "started": None,
-                    "finished": None,
-                    "progress": None }
-        scan['sessions'].append(session)
+    # Create a scan object, merging the configuration into that of the sessions
+    scan = new_scan(plan, plan_sessions(plan), configuration['configuration'], configuration['user'],
+                    datetime.datetime.utcnow())
+    if configuration.get('smart_rescan') is not None:
+        scan['smart_rescan'] = bool(configuration['smart_rescan'])
     scans.insert(scan)
+    tasks.update_latest_scan(scan)
+    for session in scan['sessions']:
+        session['issues'] = []
     return jsonify(success=True, scan=sanitize_scan(scan))
 
+#
+# Create many scans at once, and optionally start them:
+#
+#  POST /scans/batch
+#
+#  { "user": "bob@example.org",
+#    "scans": [ { "plan": "basic", "configuration": { "target": "http://a.example.com" } },
+#               { "plan": "basic", "configuration": { "target": "http://b.example.com" } } ],
+#    "start": true,
+#    "priority": "scheduled" }
+#
+# Every plan is looked up once and the scans are inserted together. Users
+# that are not administrators can only scan their own sites. Only the
+# last scan of every site and plan is recorded as its latest scan.
+# Started scans are handed to the scheduler in chunks of 500. Returns the
+# ids of the scans in the order they were given:
+#
+#  { "success": true, "scans": ["b263bdc6-8692-4ace-aa8b-922b9ec0fc37", ...] }
+#
+# Or returns an error, in which case no scans were created:
+#
+#  { "success": false, "reason": "invalid-batch" }
+#  { "success": false, "reason": "batch-too-large" }
+#  { "success": false, "reason": "no-such-user" }
+#  { "success": false, "reason": "unknown-plan", "plan": "basic" }
+#  { "success": false, "reason": "not-found", "target": "http://a.example.com" }
+#  { "success": false, "reason": "unknown-priority" }
+#
+
+@app.route("/scans/batch", methods=["POST"])
+@api_guard('application/json')
+def post_scan_batch():
+    batch = request.json
+    if not isinstance(batch, dict) or not isinstance(batch.get('scans'), list):
+        return jsonify(success=False, reason='invalid-batch')
+    for config in batch['scans']:
+        if not (isinstance(config, dict) and isinstance(config.get('configuration'), dict)
+                and isinstance(config['configuration'].get('target'), basestring)):
+            return jsonify(success=False, reason='invalid-batch')
+    if len(batch['scans']) > SCAN_BATCH_LIMIT:
+        return jsonify(success=False, reason='batch-too-large')
+    priority = batch.get('priority', 'interactive')
+    if priority not in tasks.SCAN_PRIORITIES:
+        return jsonify(success=False, reason='unknown-priority')
+    user = users.find_one({'email': batch.get('user')})
+    if not user:
+        return jsonify(success=False, reason='no-such-user')
+    targets = set(config['configuration']['target'] for config in batch['scans'])
+    if user['role'] == 'user':
+        denied = sorted(targets - set(find_access(user['email'])['sites']))
+        if denied:
+            return jsonify(success=False, reason='not-found', target=denied[0])
+    plan_names = set(config.get('plan') for config in batch['scans'])
+    found = dict((plan['name'], plan) for plan in plans.find({'name': {'$in': list(plan_names)}}))
+    unknown = plan_names - set(found)
+    if unknown:
+        return jsonify(success=False, reason='unknown-plan', plan=unknown.pop())
+    sessions = dict((name, plan_sessions(plan)) for name, plan in found.iteritems())
+
+    now = datetime.datetime.utcnow()
+    batch_scans = [new_scan(found[config['plan']], sessions[config['plan']], config['configuration'], user['email'], now)
+                   for config in batch['scans']]
+    if batch.get('start'):
+        tenants = tasks.scan_tenants(targets, user['email'])
+        for scan in batch_scans:
+            scan.update(state='QUEUED', queued=now, seq=1,
+                        schedule=tasks.new_schedule(tenants[scan['configuration']['target']], priority))
+    for i in range(0, len(batch_scans), SCAN_INSERT_SIZE):
+        scans.insert(batch_scans[i:i + SCAN_INSERT_SIZE])
+        if batch.get('start'):
+            scan_events.insert([tasks.new_event(scan['id'], 1, 'scan-state', state='QUEUED')
+                                for scan in batch_scans[i:i + SCAN_INSERT_SIZE]])
+    tasks.update_latest_scans(batch_scans)
+    if batch.get('start'):
+        # Scheduled in chunks, so that the state worker gets to other
+        # tasks in between
+        for i in range(0, len(batch_scans), SCAN_INSERT_SIZE):
+            tasks.schedule_scans.apply_async([[scan['id'] for scan in batch_scans[i:i + SCAN_INSERT_SIZE]]],
+                                             queue='state')
+    return jsonify(success=True, scans=[scan['id'] for scan in batch_scans])
+
 @app.route("/scans", methods=["GET"])
 @permission
 def get_scans():
@@ -159,10 +422,39 @@ def get_scans():
     site = sites.find_one({'id': request.args.get('site_id')})
     if not site:
         return jsonify(success=False, reason='no-such-site')
+    # The most recent scan is kept in the latest_scans collection
+    if limit == 1:
+        latest = latest_scans.find_one({"target": site['url'], "plan": request.args.get("plan_name")})
+        if not latest:
+            return jsonify(success=True, scans=[])
+        return jsonify(success=True, scans=[sanitize_scan(latest['scan'])])
     scanz = scans.find({"plan.name": request.args.get("plan_name"),
                         "configuration.target": site['url']}).sort("created", -1).limit(limit)
     return jsonify(success=True, scans=[summarize_scan(sanitize_scan(s)) for s in scanz])
 
+#
+# Start or stop a scan
+#
+#  PUT /scans/<scan_id>/control
+#  PUT /scans/<scan_id>/control?priority=scheduled
+#  PUT /scans/<scan_id>/control?coalesce=true
+#
+# The body is START or STOP. A started scan is QUEUED until the scheduler
+# releases it. Interactive scans, the default, go before scheduled ones.
+# While a scan waits, its schedule has its position in the queue and the
+# estimated time it starts.
+#
+# With coalesce=true, or when the backend coalesces scans by default, a
+# scan with the same plan and configuration as a scan that is already
+# queued or running does not run itself. It waits for that scan and gets
+# a copy of its results, and coalesced names that scan.
+#
+# The scans of a campaign are started by the campaign and cannot be
+# started on their own:
+#
+#  { "success": false, "error": "campaign-scan" }
+#
+
 @app.route("/scans/<scan_id>/control", methods=["PUT"])
 @api_guard
 @permission
@@ -179,11 +471,24 @@ def put_scan_control(scan_id):
     if state == 'START':
         if scan['state'] != 'CREATED':
             return jsonify(success=False, error='invalid-state-transition')
-        # Queue the scan to start
-        scans.update({"id": scan_id}, {"$set": {"state": "QUEUED", "queued": datetime.datetime.utcnow()}})
-        tasks.scan.apply_async([scan['id']], countdown=3, queue='scan')
+        if scan.get('campaign'):
+            return jsonify(success=False, error='campaign-scan')
+        priority = request.args.get('priority', 'interactive')
+        if priority not in tasks.SCAN_PRIORITIES:
+            return jsonify(success=False, error='unknown-priority')
+        coalesce = request.args.get('coalesce')
+        if coalesce is None:
+            coalesce = tasks.coalescing_policy()['enabled']
+        else:
+            coalesce = coalesce.lower() in ('1', 'true', 'yes')
+        # Queue the scan, the scheduler starts it when there is room
+        if not (coalesce and tasks.coalesce_scan(scan, priority)):
+            if not tasks.queue_scan(scan, priority):
+                return jsonify(success=False, error='invalid-state-transition')
     # Handle stop
     if state == 'STOP':
         scans.update({"id": scan_id}, {"$set": {"state": "STOPPING", "queued": datetime.datetime.utcnow()}})
+        tasks.record_event(scan_id, 'scan-state', state='STOPPING')
+        tasks.refresh_latest_scan(scan_id)
         tasks.scan_stop.apply_async([scan['id']], queue='state')
     return jsonify(success=True)
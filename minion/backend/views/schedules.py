@@ -0,0 +1,193 @@
+#!/usr/bin/env python
+
+import calendar
+import datetime
+import uuid
+from flask import jsonify, request
+
+import minion.backend.tasks as tasks
+from minion.backend.app import app
+from minion.backend.views.base import api_guard, find_access, plans, scan_schedules, sites, users
+
+# The shortest and the longest interval between two runs of a schedule.
+# The jitter is at most as long as the longest interval.
+MIN_SCHEDULE_INTERVAL = 300
+MAX_SCHEDULE_INTERVAL = 366 * 86400
+
+def sanitize_schedule(schedule):
+    if '_id' in schedule:
+        del schedule['_id']
+    for field in ('created', 'slot', 'next_run', 'last_run'):
+        if schedule.get(field) is not None:
+            schedule[field] = calendar.timegm(schedule[field].utctimetuple())
+    return schedule
+
+def _is_number(value):
+    return isinstance(value, (int, long, float)) and not isinstance(value, bool)
+
+def _check_timing(schedule):
+    """ A schedule runs either every interval seconds or at the times of a
+    cron expression, and has an optional jitter of whole seconds. """
+    interval, cron, jitter = schedule.get('interval'), schedule.get('cron'), schedule.get('jitter')
+    if (interval is None) == (cron is None):
+        return False
+    if interval is not None and not (_is_number(interval) and MIN_SCHEDULE_INTERVAL <= interval <= MAX_SCHEDULE_INTERVAL):
+        return False
+    if cron is not None:
+        if not isinstance(cron, basestring):
+            return False
+        try:
+            if tasks.next_cron_time(tasks.parse_cron(cron), datetime.datetime.utcnow()) is None:
+                return False
+        except ValueError:
+            return False
+    if jitter is not None and not (isinstance(jitter, (int, long)) and not isinstance(jitter, bool)
+                                   and 0 <= jitter <= MAX_SCHEDULE_INTERVAL):
+        return False
+    return True
+
+#
+# Scan a site with a plan on a schedule:
+#
+#  POST /schedules
+#
+#  { "target": "https://www.mozilla.com",
+#    "plan": "basic",
+#    "user": "bob@example.org",
+#    "cron": "0 0 * * *",
+#    "jitter": 3600,
+#    "smart_rescan": true }
+#
+# Either cron, a cron expression in UTC, or interval, in seconds from 300
+# up to a year, tells when the site is scanned. The scans start up to
+# jitter whole seconds after their planned time, by default the
+# schedules.jitter of the backend, so that sites that are scanned at the
+# same time are not all scanned at once. Runs are skipped while the
+# previous scan of the site with the plan is still running. The scans are
+# smart rescans when smart_rescan is set, see POST /scans. Users that are
+# not administrators can only schedule scans of their own sites. Returns
+# the schedule:
+#
+#  { "success": true,
+#    "schedule": { "id": "b263bdc6-8692-4ace-aa8b-922b9ec0fc37",
+#                  "target": "https://www.mozilla.com",
+#                  "plan": "basic",
+#                  "enabled": true,
+#                  "next_run": 1381795200,
+#                  ... } }
+#
+# Or returns an error:
+#
+#  { "success": false, "reason": "invalid-schedule" }
+#  { "success": false, "reason": "no-such-user" }
+#  { "success": false, "reason": "no-such-site" }
+#  { "success": false, "reason": "no-such-plan" }
+#
+
+@app.route('/schedules', methods=['POST'])
+@api_guard('application/json')
+def create_schedule():
+    config = request.json
+    if not isinstance(config, dict) or not _check_timing(config):
+        return jsonify(success=False, reason='invalid-schedule')
+    user = users.find_one({'email': config.get('user')})
+    if not user:
+        return jsonify(success=False, reason='no-such-user')
+    site = sites.find_one({'url': config.get('target')})
+    if not site or (user['role'] == 'user' and site['url'] not in find_access(user['email'])['sites']):
+        return jsonify(success=False, reason='no-such-site')
+    if config.get('plan') not in site.get('plans', []) or not plans.find_one({'name': config['plan']}):
+        return jsonify(success=False, reason='no-such-plan')
+    schedule = { "id": str(uuid.uuid4()),
+                 "target": site['url'],
+                 "plan": config['plan'],
+                 "user": user['email'],
+                 "interval": config.get('interval'),
+                 "cron": config.get('cron'),
+                 "jitter": config.get('jitter'),
+                 "enabled": config.get('enabled', True) is not False,
+                 "smart_rescan": config.get('smart_rescan'),
+                 "created": datetime.datetime.utcnow(),
+                 "last_run": None,
+                 "last_scan": None,
+                 "missed": 0,
+                 "skipped": 0 }
+    schedule['slot'], schedule['next_run'] = tasks.schedule_next_run(schedule, schedule['created'])
+    scan_schedules.insert(schedule)
+    return jsonify(success=True, schedule=sanitize_schedule(schedule))
+
+#
+# Change when a schedule runs, or disable or enable it, or change whether
+# its scans are smart rescans:
+#
+#  POST /schedules/<schedule_id>
+#
+#  { "interval": 86400, "enabled": false }
+#
+# Setting interval replaces the cron expression and the other way around.
+# Returns the schedule, or an error:
+#
+#  { "success": false, "reason": "no-such-schedule" }
+#  { "success": false, "reason": "invalid-schedule" }
+#
+
+@app.route('/schedules/<schedule_id>', methods=['POST'])
+@api_guard('application/json')
+def update_schedule(schedule_id):
+    schedule = scan_schedules.find_one({'id': schedule_id})
+    if not schedule:
+        return jsonify(success=False, reason='no-such-schedule')
+    changes = request.json
+    if not isinstance(changes, dict):
+        return jsonify(success=False, reason='invalid-schedule')
+    if 'interval' in changes:
+        schedule.update(interval=changes['interval'], cron=None)
+    if 'cron' in changes:
+        schedule.update(cron=changes['cron'], interval=None)
+    if 'jitter' in changes:
+        schedule['jitter'] = changes['jitter']
+    if 'enabled' in changes:
+        schedule['enabled'] = changes['enabled'] is not False
+    if 'smart_rescan' in changes:
+        schedule['smart_rescan'] = changes['smart_rescan']
+    if not _check_timing(schedule):
+        return jsonify(success=False, reason='invalid-schedule')
+    schedule['slot'], schedule['next_run'] = tasks.schedule_next_run(schedule, datetime.datetime.utcnow())
+    scan_schedules.update({'id': schedule_id},
+                          {'$set': dict((field, schedule[field]) for field in
+                                        ('interval', 'cron', 'jitter', 'enabled', 'smart_rescan', 'slot', 'next_run'))})
+    return jsonify(success=True, schedule=sanitize_schedule(schedule))
+
+#
+# Return the schedules, optionally of one site or plan:
+#
+#  GET /schedules
+#  GET /schedules?target=https://www.mozilla.com&plan=basic
+#
+#  { "success": true, "schedules": [{ "id": "b263bdc6-8692-4ace-aa8b-922b9ec0fc37", ... }] }
+#
+
+@app.route('/schedules', methods=['GET'])
+@api_guard
+def list_schedules():
+    query = {}
+    for field in ('target', 'plan'):
+        if request.args.get(field):
+            query[field] = request.args.get(field)
+    schedules = scan_schedules.find(query).sort([('target', 1), ('plan', 1)])
+    return jsonify(success=True, schedules=[sanitize_schedule(schedule) for schedule in schedules])
+
+#
+# Delete a schedule. Scans that it started are kept.
+#
+#  DELETE /schedules/<schedule_id>
+#
+
+@app.route('/schedules/<schedule_id>', methods=['DELETE'])
+@api_guard
+def delete_schedule(schedule_id):
+    schedule = scan_schedules.find_one({'id': schedule_id})
+    if not schedule:
+        return jsonify(success=False, reason='no-such-schedule')
+    scan_schedules.remove({'id': schedule_id})
+    return jsonify(success=True)
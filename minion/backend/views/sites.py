@@ -3,11 +3,14 @@
 import calendar
 import datetime
 import re
+import urlparse
 import uuid
 from flask import jsonify, request
 
 from minion.backend.app import app
-from minion.backend.views.base import _check_required_fields, api_guard, groups, sites
+from minion.backend.views.base import (_check_required_fields, api_guard, find_page, find_users_for_sites, groups,
+                                       host_limits, requested_fields, sites, update_access)
+from minion.limiter import HOST_LIMIT_FIELDS
 from minion.backend.views.groups import _check_group_exists
 from minion.backend.views.plans import _check_plan_exists
 
@@ -21,10 +24,55 @@ def _check_site_url(url):
 #            return False
 #    return True
 
+def _check_politeness(politeness):
+    """ The politeness of a site is None or has a positive rate, and a
+    burst and concurrency of at least one request. A burst below one would
+    never allow a request. """
+    if politeness is None:
+        return True
+    if not isinstance(politeness, dict) or not set(politeness).issubset(HOST_LIMIT_FIELDS):
+        return False
+    for field, value in politeness.iteritems():
+        if isinstance(value, bool):
+            return False
+        if field == 'rate' and not (isinstance(value, (int, long, float)) and value > 0):
+            return False
+        if field != 'rate' and not (isinstance(value, (int, long)) and value >= 1):
+            return False
+    return True
+
+def _update_host_limits(site, politeness):
+    """ Limit the requests to the host of the site. Every site keeps its own
+    limits in the document of the host and the host is limited by the
+    strictest of them. Limits that no site gives are the defaults of the
+    plugin workers. """
+    host = urlparse.urlparse(site['url']).hostname
+    if politeness:
+        host_limits.update({'host': host}, {'$set': {'sites.' + site['id']: politeness}}, upsert=True)
+    else:
+        host_limits.update({'host': host}, {'$unset': {'sites.' + site['id']: 1}})
+    doc = host_limits.find_one({'host': host})
+    if doc is None:
+        return
+    limits = {}
+    for field in HOST_LIMIT_FIELDS:
+        values = [l[field] for l in doc.get('sites', {}).values() if l.get(field) is not None]
+        limits[field] = min(values) if values else None
+    host_limits.update({'host': host}, {'$set': limits, '$inc': {'version': 1}})
+
 def _find_groups_for_site(site):
     """Find all the groups the site is part of"""
     return [g['name'] for g in groups.find({"sites":site})]
 
+def _find_groups_for_sites(urls):
+    """Find the groups of all the given sites with a single query"""
+    site_groups = dict((url, []) for url in urls)
+    for g in groups.find({'sites': {'$in': urls}}, {'name': True, 'sites': True}):
+        for url in set(g['sites']):
+            if url in site_groups:
+                site_groups[url].append(g['name'])
+    return site_groups
+
 def sanitize_site(site):
     if '_id' in site:
         del site['_id']
@@ -70,7 +118,15 @@ def get_site(site_id):
 #
 #  { 'url': 'https://www.mozilla.com',
 #    'plans': ['basic', 'nmap'],
-#    'groups': ['mozilla', 'key-initiatives'] }
+#    'groups': ['mozilla', 'key-initiatives'],
+#    'politeness': { 'rate': 2, 'burst': 5, 'concurrency': 1 } }
+#
+# The optional politeness limits the requests plugins make to the host of
+# the site: rate requests per second with bursts of burst requests and at
+# most concurrency requests at a time. The rate is a positive number, burst
+# and concurrency are whole numbers of at least 1. Limits that are left out
+# are the defaults of the plugin workers. When sites share a host, the host
+# gets the lowest limits of those sites.
 #
 # Returns the full site record including the generated id:
 #
@@ -78,12 +134,14 @@ def get_site(site_id):
 #    'site': { 'id': 'b263bdc6-8692-4ace-aa8b-922b9ec0fc37',
 #              'url': 'https://www.mozilla.com',
 #              'plans': ['basic', 'nmap'],
-#              'groups': ['mozilla', 'key-initiatives'] } }
+#              'groups': ['mozilla', 'key-initiatives'],
+#              'politeness': { 'rate': 2, 'burst': 5, 'concurrency': 1 } } }
 #
 # Or returns an error:
 #
 #  { 'success': False, 'reason': 'site-already-exists' }
 #  { 'success': False, 'reason': 'Group xyz does not exist' }
+#  { 'success': False, 'reason': 'invalid-politeness' }
 #
 
 @app.route('/sites', methods=['POST'])
@@ -101,12 +159,15 @@ def create_site():
     for plan_name in site.get('plans', []):
         if not _check_plan_exists(plan_name):
             return jsonify(success=False, reason='unknown-plan')
+    if not _check_politeness(site.get('politeness')):
+        return jsonify(success=False, reason='invalid-politeness')
     if sites.find_one({'url': site['url']}) is not None:
         return jsonify(success=False, reason='site-already-exists')
     # Create the site
     new_site = { 'id': str(uuid.uuid4()),
                  'url':  site['url'],
                  'plans': site.get('plans', []),
+                 'politeness': site.get('politeness'),
                  'created': datetime.datetime.utcnow()}
 
     if site.get('verification',{}).get('enabled',False):
@@ -115,10 +176,14 @@ def create_site():
         new_site['verification'] = {'enabled': False, 'value': None}
 
     sites.insert(new_site)
+    if new_site['politeness']:
+        _update_host_limits(new_site, new_site['politeness'])
     # Add the site to the groups - group membership is stored in the group object, not in the site
     for group_name in site.get('groups', []):
         # No need to check if the site is already in the group as we just added the site
         groups.update({'name':group_name},{'$addToSet': {'sites': site['url']}})
+    if site.get('groups'):
+        update_access(find_users_for_sites([site['url']]))
     new_site['groups'] = site.get('groups', [])
     # Return the new site
     return jsonify(success=True, site=sanitize_site(new_site))
@@ -149,6 +214,9 @@ def create_site():
 #  { 'success': False, 'reason': 'no-such-site' }
 #  { 'success': False, 'reason': 'unknown-group' }
 #  { 'success': False, 'reason': 'unknown-plan' }
+#  { 'success': False, 'reason': 'invalid-politeness' }
+#
+# The politeness of the site can be changed, or removed with null.
 #
 
 @app.route('/sites/<site_id>', methods=['POST'])
@@ -160,12 +228,15 @@ def update_site(site_id):
     if not site:
         return jsonify(success=False, reason='no-such-site')
     site['groups'] = _find_groups_for_site(site['url'])
+    old_users = find_users_for_sites([site['url']])
     for group in new_site.get('groups', []):
         if not _check_group_exists(group):
             return jsonify(success=False, reason='unknown-group')
     for plan_name in new_site.get('plans', []):
         if not _check_plan_exists(plan_name):
             return jsonify(success=False, reason='unknown-plan')
+    if not _check_politeness(new_site.get('politeness')):
+        return jsonify(success=False, reason='invalid-politeness')
     if 'groups' in new_site:
         # Add new groups
         for group_name in new_site.get('groups', []):
@@ -180,6 +251,13 @@ def update_site(site_id):
         # Update the site. At this point we can only update plans.
         sites.update({'id': site_id}, {'$set': {'plans': new_site.get('plans')}})
 
+    if 'groups' in new_site or 'plans' in new_site:
+        update_access(old_users | find_users_for_sites([site['url']]))
+
+    if 'politeness' in new_site:
+        sites.update({'id': site_id}, {'$set': {'politeness': new_site['politeness']}})
+        _update_host_limits(site, new_site['politeness'])
+
     new_verification = new_site['verification']
     old_verification = site.get('verification')
     # if site doesn't have 'verification', do us a favor, update the document as it is outdated!
@@ -205,8 +283,11 @@ def update_site(site_id):
 #
 #  GET /sites
 #  GET /sites?url=http://www.mozilla.com
+#  GET /sites?limit=100&after=<next>&fields=url,plans
 #
-# Returns a list of sites found, even if there is one result:
+# Returns a list of sites found, even if there is one result. When a
+# limit is given, next is the cursor to pass as after to get the
+# following page.
 #
 #  [{ 'id': 'b263bdc6-8692-4ace-aa8b-922b9ec0fc37',
 #     'url': 'https://www.mozilla.com',
@@ -221,7 +302,18 @@ def get_sites():
     url = request.args.get('url')
     if url:
         query['url'] = url
-    sitez = [sanitize_site(site) for site in sites.find(query)]
-    for site in sitez:
-        site['groups'] = _find_groups_for_site(site['url'])
-    return jsonify(success=True, sites=sitez)
+    fields = requested_fields()
+    try:
+        page, next_cursor = find_page(sites, query, fields=fields and fields | set(['url']))
+    except ValueError:
+        return jsonify(success=False, reason='invalid-page')
+    site_groups = {}
+    if fields is None or 'groups' in fields:
+        site_groups = _find_groups_for_sites([site['url'] for site in page])
+    sitez = []
+    for site in page:
+        site_url = site['url'] if fields is None or 'url' in fields else site.pop('url')
+        if fields is None or 'groups' in fields:
+            site['groups'] = site_groups[site_url]
+        sitez.append(sanitize_site(site))
+    return jsonify(success=True, sites=sitez, next=next_cursor)
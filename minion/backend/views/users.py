@@ -6,7 +6,7 @@ import uuid
 from flask import jsonify, request
 
 from minion.backend.app import app
-from minion.backend.views.base import api_guard, groups, sites, users
+from minion.backend.views.base import access, api_guard, find_access, find_page, groups, requested_fields, sites, update_access, users
 from minion.backend.views.groups import _check_group_exists
 
 def _find_groups_for_user(email):
@@ -23,11 +23,20 @@ def _find_sites_for_user_by_group_name(email, group_name):
 
 def _find_sites_for_user(email):
     """Find all sites that the user has access to"""
-    sitez = set()
-    for g in groups.find({"users":email}):
-        for s in g['sites']:
-            sitez.add(s)
-    return list(sitez)
+    return find_access(email)['sites']
+
+def _find_groups_and_sites_for_users(emails):
+    """ Find the groups and sites of all the given users with a single
+    query. Returns two dicts that map each email to its group names and
+    to its site urls. """
+    user_groups = dict((email, []) for email in emails)
+    user_sites = dict((email, set()) for email in emails)
+    for g in groups.find({'users': {'$in': emails}}, {'name': True, 'users': True, 'sites': True}):
+        for email in set(g['users']):
+            if email in user_groups:
+                user_groups[email].append(g['name'])
+                user_sites[email].update(g['sites'])
+    return user_groups, dict((email, list(sitez)) for email, sitez in user_sites.iteritems())
 
 def update_group_association(old_email, new_email):
     """ Update all associations with the old email
@@ -37,6 +46,8 @@ def update_group_association(old_email, new_email):
         {'$set': {'users.$': new_email}},
         upsert=False,
         multi=True)
+    update_access([new_email])
+    access.remove({'email': old_email})
 
 def remove_group_association(email):
     """ Remove all associations with the recipient.
@@ -53,6 +64,7 @@ def remove_group_association(email):
         {'$pull': {'users': email}},
         upsert=False,
         multi=True)
+    update_access([email])
 
 def sanitize_user(user):
     if '_id' in user:
@@ -147,6 +159,7 @@ def create_user():
     # Add the user to the groups - group membership is stored in the group objet, not in the user
     for group_name in user.get('groups', []):
         groups.update({'name':group_name},{'$addToSet': {'users': user['email']}})
+    update_access([user['email']])
     new_user['groups'] = user.get('groups', [])
     return jsonify(success=True, user=sanitize_user(new_user))
 
@@ -198,6 +211,7 @@ def update_user(user_email):
         for group_name in old_user['groups']:
             if group_name not in new_user.get('groups', []):
                 groups.update({'name':group_name},{'$pull': {'users': user_email}})
+        update_access([user_email])
     # Modify the user
     changes = {}
     if 'name' in new_user:
@@ -220,8 +234,10 @@ def update_user(user_email):
 # Retrieve all users in minion
 #
 #  GET /users
+#  GET /users?limit=100&after=<next>&fields=email,groups
 #
-# Returns a list of users
+# Returns a list of users. When a limit is given, next is the cursor
+# to pass as after to get the following page.
 #
 #  [{ 'id': 'b263bdc6-8692-4ace-aa8b-922b9ec0fc37',
 #     'email': 'someone@somedomain',
@@ -234,12 +250,23 @@ def update_user(user_email):
 @app.route('/users', methods=['GET'])
 @api_guard
 def list_users():
+    fields = requested_fields()
+    try:
+        page, next_cursor = find_page(users, fields=fields and fields | set(['email']))
+    except ValueError:
+        return jsonify(success=False, reason='invalid-page')
+    user_groups, user_sites = {}, {}
+    if fields is None or 'groups' in fields or 'sites' in fields:
+        user_groups, user_sites = _find_groups_and_sites_for_users([user['email'] for user in page])
     userz = []
-    for user in users.find():
-        user['groups'] = _find_groups_for_user(user['email'])
-        user['sites'] = _find_sites_for_user(user['email'])
+    for user in page:
+        email = user['email'] if fields is None or 'email' in fields else user.pop('email')
+        if fields is None or 'groups' in fields:
+            user['groups'] = user_groups[email]
+        if fields is None or 'sites' in fields:
+            user['sites'] = user_sites[email]
         userz.append(sanitize_user(user))
-    return jsonify(success=True, users=userz)
+    return jsonify(success=True, users=userz, next=next_cursor)
 
 #
 # Delete a user
@@ -257,4 +284,5 @@ def delete_user(user_email):
     users.remove({'email': user_email})
     # Remove user group membership
     remove_group_association(user_email)
+    access.remove({'email': user_email})
     return jsonify(success=True)
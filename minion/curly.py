@@ -8,6 +8,8 @@ import urlparse
 
 import pycurl
 
+from minion.limiter import LimitTimeout, host_limiter
+
 CURL_ERRORS = {
     'default': 
         {
@@ -39,6 +41,18 @@ class CurlyError(Exception):
         self.issue['Severity'] = 'Error'
         self.message = self.issue['Summary']
 
+class HostLimitError(CurlyError):
+    """ Raised when a request gave up waiting for its turn to the host. """
+    def __init__(self, host):
+        self.id = None
+        self.host = host
+        self.issue = {'Summary': 'Request to the site was not sent',
+                      'Description': "Minion gave up waiting for its turn to send a request to %s. \
+Other scans of the same host used all the requests that its politeness settings allow." % host,
+                      'Solution': 'Scan the site again later, or raise the politeness limits of the site.',
+                      'Severity': 'Error'}
+        self.message = self.issue['Summary']
+
 class BadResponseError(Exception):
     def __init__(self, message=None, status_code=None):
         if message is None and status_code is not None:
@@ -103,10 +117,21 @@ def _get(c, url, headers={}, connect_timeout=None, timeout=None):
     if len(headers):
         c.setopt(c.HTTPHEADER, ["%s: %s" % (name,value) for name,value in headers.items()])
     try:
-        c.perform()
+        # Wait for our turn if requests to this host are limited. The
+        # request has to end before its slot is given to another one.
+        limiter = host_limiter()
+        if limiter:
+            if timeout is None:
+                c.setopt(pycurl.TIMEOUT, limiter.limits['lease'])
+            with limiter.request(url, timeout):
+                c.perform()
+        else:
+            c.perform()
         return http_response
     except pycurl.error as e:
         raise CurlyError(e[0])
+    except LimitTimeout as e:
+        raise HostLimitError(e.host)
 
 def get(url, headers={}, connect_timeout=None, timeout=None):
     c = pycurl.Curl()
@@ -0,0 +1,148 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import contextlib
+import logging
+import random
+import time
+import urlparse
+import uuid
+
+from pymongo import MongoClient
+from pymongo.errors import DuplicateKeyError, PyMongoError
+
+from minion.backend.utils import backend_config
+
+#
+# Requests to the same host are limited by a token bucket, which allows
+# rate requests per second with bursts of burst requests, and by a cap of
+# concurrency requests at a time. The state is kept in the host_limits
+# collection so that it is shared by all plugin runners on all workers.
+# The defaults are configured in backend.json:
+#
+#  "politeness": {
+#    "enabled": true,
+#    "rate": 10,
+#    "burst": 10,
+#    "concurrency": 4,
+#    "lease": 120,
+#    "wait": 300
+#  }
+#
+# Sites can have their own rate, burst and concurrency, which the API
+# stores in the document of their host. A request holds its slot for at
+# most lease seconds, or for its own timeout when that is longer, so that
+# runners that die do not keep slots taken. Requests that have waited
+# wait seconds for a slot fail with LimitTimeout.
+#
+
+DEFAULT_LIMITS = {
+    'enabled': True,
+    'rate': 10.0,
+    'burst': 10,
+    'concurrency': 4,
+    'lease': 120,
+    'wait': 300
+}
+
+HOST_LIMIT_FIELDS = ('rate', 'burst', 'concurrency')
+
+class LimitTimeout(Exception):
+    def __init__(self, host):
+        self.host = host
+        self.message = "Gave up waiting for a free request slot for %s" % host
+        super(LimitTimeout, self).__init__(self.message)
+
+class HostLimiter(object):
+
+    """
+    Limit the requests to hosts. Every change to the document of a host is
+    made conditional on its version, so concurrent limiters retry instead
+    of overwriting each other.
+    """
+
+    def __init__(self, collection, limits=None):
+        self.collection = collection
+        self.limits = dict(DEFAULT_LIMITS)
+        self.limits.update(limits or {})
+
+    def _host_limits(self, doc):
+        limits = dict(self.limits)
+        for field in HOST_LIMIT_FIELDS:
+            if doc.get(field) is not None:
+                limits[field] = doc[field]
+        return limits
+
+    def acquire(self, host, duration=None):
+        """ Wait until a request to the host is allowed. Returns the lease
+        to release when the request is done. The lease lasts at least
+        duration seconds. """
+        lease = str(uuid.uuid4())
+        deadline = time.time() + self.limits['wait']
+        while True:
+            doc = self.collection.find_one({'host': host})
+            if doc is None:
+                try:
+                    self.collection.insert({'host': host, 'version': 0, 'leases': []})
+                except DuplicateKeyError:
+                    pass
+                continue
+            limits = self._host_limits(doc)
+            now = time.time()
+            if doc.get('updated') is None:
+                tokens = limits['burst']
+            else:
+                tokens = min(limits['burst'], doc['tokens'] + (now - doc['updated']) * limits['rate'])
+            leases = [l for l in doc.get('leases', []) if l['expires'] > now]
+            if tokens >= 1 and len(leases) < limits['concurrency']:
+                leases.append({'id': lease, 'expires': now + max(limits['lease'], duration or 0)})
+                result = self.collection.update({'host': host, 'version': doc.get('version')},
+                                                {'$set': {'tokens': tokens - 1, 'updated': now, 'leases': leases},
+                                                 '$inc': {'version': 1}})
+                if result['n']:
+                    return lease
+                # Someone else changed the host, try again after a moment
+                time.sleep(random.uniform(0, 0.05))
+                continue
+            wait = (1 - tokens) / limits['rate'] if tokens < 1 else 0.25
+            if now + wait > deadline:
+                raise LimitTimeout(host)
+            time.sleep(wait)
+
+    def release(self, host, lease):
+        self.collection.update({'host': host}, {'$pull': {'leases': {'id': lease}}, '$inc': {'version': 1}})
+
+    @contextlib.contextmanager
+    def request(self, url, duration=None):
+        host = urlparse.urlparse(url).hostname
+        lease = self.acquire(host, duration)
+        try:
+            yield
+        finally:
+            self.release(host, lease)
+
+def host_collection(cfg):
+    mongodb = MongoClient(host=cfg['mongodb']['host'], port=cfg['mongodb']['port'])
+    collection = mongodb.minion.host_limits
+    collection.ensure_index('host', unique=True)
+    return collection
+
+# The limiter of this process, False when requests are not limited
+_limiter = None
+
+def host_limiter():
+    """ Return the limiter shared by all requests made by this process, or
+    None if requests are not limited or the database cannot be reached. """
+    global _limiter
+    if _limiter is None:
+        cfg = backend_config()
+        limits = dict(DEFAULT_LIMITS)
+        limits.update(cfg.get('politeness') or {})
+        _limiter = False
+        if limits['enabled'] and cfg.get('mongodb'):
+            try:
+                _limiter = HostLimiter(host_collection(cfg), limits)
+            except PyMongoError:
+                logging.exception("Cannot reach the database, requests to hosts are not limited")
+    return _limiter or None
@@ -78,6 +78,14 @@ class AbstractPlugin:
     def weight(cls):
         return getattr(cls, "PLUGIN_WEIGHT", "heavy")
 
+    # The response headers of the target that are all the plugin looks at,
+    # or None if it looks at more. Smart rescans do not run plugins whose
+    # inputs have not changed.
+
+    @classmethod
+    def inputs(cls):
+        return getattr(cls, "PLUGIN_INPUTS", None)
+
     zope.interface.implements(IPlugin, IPluginRunnerCallbacks)
 
     # Plugins can finish in three states: succesfully, stopped and failed.
@@ -96,6 +96,7 @@ class XFrameOptionsPlugin(BlockingPlugin):
 
     PLUGIN_NAME = "XFrameOptions"
     PLUGIN_WEIGHT = "light"
+    PLUGIN_INPUTS = ["x-frame-options"]
 
     FURTHER_INFO = [ {
         "URL": "https://developer.mozilla.org/en-US/docs/HTTP/X-Frame-Options",
@@ -204,6 +205,7 @@ class HSTSPlugin(BlockingPlugin):
 
     PLUGIN_NAME = "HSTS"
     PLUGIN_WEIGHT = "light"
+    PLUGIN_INPUTS = ["strict-transport-security"]
 
     FURTHER_INFO = [ {
         "URL": "https://developer.mozilla.org/en-US/docs/Security/HTTP_Strict_Transport_Security",
@@ -298,6 +300,7 @@ class XContentTypeOptionsPlugin(BlockingPlugin):
 
     PLUGIN_NAME = "XContentTypeOptions"
     PLUGIN_WEIGHT = "light"
+    PLUGIN_INPUTS = ["x-content-type-options"]
 
     FURTHER_INFO = [ {
         "URL": "http://msdn.microsoft.com/en-us/library/ie/gg622941%28v=vs.85%29.aspx",
@@ -361,6 +364,7 @@ class XXSSProtectionPlugin(BlockingPlugin):
 
     PLUGIN_NAME = "XXSSProtection"
     PLUGIN_WEIGHT = "light"
+    PLUGIN_INPUTS = ["x-xss-protection"]
 
     FURTHER_INFO = [ {
         "URL": "http://blogs.msdn.com/b/ie/archive/2008/07/02/ie8-security-part-iv-the-xss-filter.aspx",
@@ -439,6 +443,7 @@ class ServerDetailsPlugin(BlockingPlugin):
 
     PLUGIN_NAME = "ServerDetails"
     PLUGIN_WEIGHT = "light"
+    PLUGIN_INPUTS = ["server", "x-powered-by", "x-aspnet-version", "x-aspnetmvc-version", "x-backend-server"]
 
     FURTHER_INFO = [
         {
@@ -625,6 +630,8 @@ class CSPPlugin(BlockingPlugin):
 
     PLUGIN_NAME = "CSP"
     PLUGIN_WEIGHT = "light"
+    PLUGIN_INPUTS = ["content-security-policy", "content-security-policy-report-only",
+                     "x-content-security-policy", "x-content-security-policy-report-only"]
 
     FURTHER_INFO = [
         {
@@ -22,9 +22,25 @@ plugins_requires = [
 tests_requires = [
     'nose',
     'mock',
+    'mongomock==3.19.0',
     'pyopenssl==0.13.1',
 ]
 
+# Plugins are registered in the minion.plugins entry point group. The
+# backend uses this to find plugins without importing them.
+plugin_entry_points = [
+    '%s = %s:%s' % (module + '.' + name, module, name) for module, name in (
+        ('minion.plugins.basic', 'AlivePlugin'),
+        ('minion.plugins.basic', 'XFrameOptionsPlugin'),
+        ('minion.plugins.basic', 'HSTSPlugin'),
+        ('minion.plugins.basic', 'XContentTypeOptionsPlugin'),
+        ('minion.plugins.basic', 'XXSSProtectionPlugin'),
+        ('minion.plugins.basic', 'ServerDetailsPlugin'),
+        ('minion.plugins.basic', 'RobotsPlugin'),
+        ('minion.plugins.basic', 'CSPPlugin'),
+    )
+]
+
 setup(name="minion-backend",
       version="0.1",
       description="Minion Backend",
@@ -36,9 +52,11 @@ setup(name="minion-backend",
       include_package_data=True,
       install_requires = install_requires + tests_requires + plugins_requires,
       tests_require = tests_requires,
+      entry_points = {'minion.plugins': plugin_entry_points},
       scripts=['scripts/minion-backend-api',
                'scripts/minion-create-plan',
                'scripts/minion-db-init',
+               'scripts/minion-db-backfill',
                'scripts/minion-create-user',
                'scripts/minion-plugin-worker',
                'scripts/minion-scan',
@@ -152,26 +152,34 @@ class Sites(Resource):
         super(Sites, self).__init__()
         self.api = self.domain + "/sites"
 
-    def get(self, url=None):
+    def get(self, url=None, limit=None, after=None, fields=None):
         params = {}
         if url:
             params["url"] = url
+        if limit:
+            params["limit"] = limit
+        if after:
+            params["after"] = after
+        if fields:
+            params["fields"] = ",".join(fields)
         return self.session.get(self.api, params=params)
 
 class Site(Resource):
-    def __init__(self, url, groups=None, plans=None):
+    def __init__(self, url, groups=None, plans=None, politeness=None):
         super(Site, self).__init__()
         self.api = self.domain + "/sites"
 
         self.url = url
         self.groups = groups or []
         self.plans = plans or []
+        self.politeness = politeness
 
     def create(self, verify=False, value=None):
         return self.session.post(self.api,
             data=json.dumps({"url": self.url,
                 "groups": self.groups,
                 "plans": self.plans,
+                "politeness": self.politeness,
                 "verification": {"enabled": verify, "value": None},
             }),
             headers=self.json_header)
@@ -258,8 +266,9 @@ class Plan(Resource):
         return self.session.post(self.api,
             data=json.dumps(self.plan), headers=self.json_header)
 
-    def get(self, plan_name):
-        return self.session.get(self.api + "/" + plan_name)
+    def get(self, plan_name, etag=None):
+        headers = {"if-none-match": etag} if etag else None
+        return self.session.get(self.api + "/" + plan_name, headers=headers)
 
     def update(self, plan_name, new_plan):
         self.plan = new_plan
@@ -274,14 +283,24 @@ class Scans(Resource):
         super(Scans, self).__init__()
         self.api = self.domain + "/scans"
 
-    def get(self, limit=None, site_id=None):
+    def get(self, limit=None, site_id=None, plan_name=None):
         params = {}
         if limit:
             params["limit"] = limit
         if site_id:
             params["site_id"] = site_id
+        if plan_name:
+            params["plan_name"] = plan_name
         return self.session.get(self.api, params=params)
 
+    def create_batch(self, email, plan_name, targets, start=False, priority=None):
+        batch = {"user": email,
+                 "scans": [{"plan": plan_name, "configuration": {"target": target}} for target in targets],
+                 "start": start}
+        if priority:
+            batch["priority"] = priority
+        return self.session.post(self.api + "/batch", data=json.dumps(batch), headers=self.json_header)
+
 class Scan(Resource):
     def __init__(self, email, plan_name, configuration):
         super(Scan, self).__init__()
@@ -290,40 +309,102 @@ class Scan(Resource):
         self.email = email
         self.plan_name = plan_name
 
-    def create(self):
-        return self.session.post(self.api,
-            data=json.dumps({
-                "user": self.email,
+    def create(self, smart_rescan=None):
+        scan = {"user": self.email,
                 "configuration": self.configuration,
-                "plan": self.plan_name
-            }),
-            headers=self.json_header)
+                "plan": self.plan_name}
+        if smart_rescan is not None:
+            scan["smart_rescan"] = smart_rescan
+        return self.session.post(self.api, data=json.dumps(scan), headers=self.json_header)
 
-    def get_scan_details(self, scan_id, email=None):
+    def get_scan_details(self, scan_id, email=None, format=None, since=None):
         return self.session.get(self.api + "/" + scan_id,
+            params={"email": email, "format": format, "since": since})
+
+    def get_events(self, scan_id, since=None, email=None):
+        return self.session.get(self.api + "/" + scan_id + "/events",
+            params={"since": since, "email": email})
+
+    def get_diff(self, scan_id, email=None):
+        return self.session.get(self.api + "/" + scan_id + "/diff",
             params={"email": email})
 
     def get_summary(self, scan_id, email=None):
         return self.session.get(self.api + "/" + scan_id + "/summary",
             params={"email": email})
 
-    def start(self, scan_id, email=None):
-        return self._update(scan_id, "START", email=email)
+    def start(self, scan_id, email=None, priority=None, coalesce=None):
+        return self._update(scan_id, "START", email=email, priority=priority, coalesce=coalesce)
 
     def stop(self, scan_id, email=None):
         return self._update(scan_id, "STOP", email=email)
 
-    def _update(self, scan_id, state, email=None):
+    def _update(self, scan_id, state, email=None, priority=None, coalesce=None):
         return self.session.put(self.api + "/" + scan_id + "/control",
-            data=state, params={"email": email})
+            data=state, params={"email": email, "priority": priority, "coalesce": coalesce})
+
+class Campaign(Resource):
+    def __init__(self, email, group_name, max_running=None, priority=None):
+        super(Campaign, self).__init__()
+        self.api = self.domain + "/campaigns"
+        self.email = email
+        self.group_name = group_name
+        self.max_running = max_running
+        self.priority = priority
+
+    def create(self):
+        data = {"user": self.email, "group": self.group_name}
+        if self.max_running is not None:
+            data["max_running"] = self.max_running
+        if self.priority:
+            data["priority"] = self.priority
+        return self.session.post(self.api, data=json.dumps(data), headers=self.json_header)
+
+    def get(self, campaign_id):
+        return self.session.get(self.api + "/" + campaign_id)
+
+    def stop(self, campaign_id):
+        return self.session.put(self.api + "/" + campaign_id + "/control", data="STOP")
+
+class Schedule(Resource):
+    def __init__(self, email, target, plan_name, interval=None, cron=None, jitter=None):
+        super(Schedule, self).__init__()
+        self.api = self.domain + "/schedules"
+        self.email = email
+        self.target = target
+        self.plan_name = plan_name
+        self.interval = interval
+        self.cron = cron
+        self.jitter = jitter
+
+    def create(self):
+        data = {"user": self.email, "target": self.target, "plan": self.plan_name}
+        for field in ("interval", "cron", "jitter"):
+            if getattr(self, field) is not None:
+                data[field] = getattr(self, field)
+        return self.session.post(self.api, data=json.dumps(data), headers=self.json_header)
+
+    def get(self, target=None, plan_name=None):
+        return self.session.get(self.api, params={"target": target, "plan": plan_name})
+
+    def update(self, schedule_id, **changes):
+        return self.session.post(self.api + "/" + schedule_id, data=json.dumps(changes), headers=self.json_header)
+
+    def delete(self, schedule_id):
+        return self.session.delete(self.api + "/" + schedule_id)
 
 class Plugins(Resource):
     def __init__(self):
         super(Plugins, self).__init__()
         self.api = self.domain + "/plugins"
 
-    def get(self):
-        return self.session.get(self.api)
+    def get(self, etag=None):
+        headers = {"if-none-match": etag} if etag else None
+        return self.session.get(self.api, headers=headers)
+
+    def get_stats(self, plugin_class=None):
+        params = {'class': plugin_class} if plugin_class else {}
+        return self.session.get(self.api + "/stats", params=params)
 
 class Reports(Resource):
     def __init__(self):
@@ -352,6 +433,11 @@ class Reports(Resource):
                 params["group_name"] = group_name
         return self.session.get(self.api + "/issues", params=params)
 
+    def get_trends(self, site=None, plan_name=None, group_name=None, days=None, user=None):
+        params = {"site": site, "plan_name": plan_name, "group_name": group_name,
+                  "days": days, "user": user}
+        return self.session.get(self.api + "/trends", params=params)
+
 class TestAPIBaseClass(unittest.TestCase):
     def setUp(self):
         self.mongodb = MongoClient()
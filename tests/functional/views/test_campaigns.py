@@ -0,0 +1,70 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+from base import (TestAPIBaseClass, User, Site, Group, Plan, Campaign, Scan, Scans)
+
+class TestCampaignAPIs(TestAPIBaseClass):
+    TEST_PLAN = {
+        "name": "test-plan",
+        "description": "Plan that runs HelloWorldPlugin",
+        "workflow": [
+            {
+                "plugin_name": "minion.plugins.test.HelloWorldPlugin",
+                "description": "",
+                "configuration": {}
+            }
+        ]
+    }
+
+    def setUp(self):
+        super(TestCampaignAPIs, self).setUp()
+        self.plan = Plan(self.TEST_PLAN)
+        self.plan.create()
+        self.user = User(self.email)
+        self.user.create()
+        self.urls = ["http://localhost:%d" % port for port in range(1234, 1237)]
+        self.site_ids = [Site(url, plans=[self.TEST_PLAN["name"]]).create().json()["site"]["id"] for url in self.urls]
+        self.group = Group(self.group_name, sites=self.urls, users=[self.user.email])
+        self.group.create()
+
+    def test_create_and_stop_campaign(self):
+        campaign = Campaign(self.user.email, self.group_name, max_running=1)
+        res = campaign.create()
+        self.assertEqual(res.json()["success"], True)
+        campaign_id = res.json()["campaign"]["id"]
+        self.assertEqual(res.json()["campaign"]["total"], 3)
+        self.assertEqual(res.json()["campaign"]["max_running"], 1)
+
+        res = campaign.get(campaign_id)
+        progress = res.json()["campaign"]["progress"]
+        self.assertEqual(progress["total"], 3)
+        self.assertTrue(progress["running"] <= 1)
+
+        res = campaign.stop(campaign_id)
+        self.assertEqual(res.json()["success"], True)
+        res = campaign.stop(campaign_id)
+        self.assertEqual(res.json()["error"], "invalid-state-transition")
+
+    def test_campaign_scans_cannot_be_started(self):
+        res = Campaign(self.user.email, self.group_name, max_running=1).create()
+        self.assertEqual(res.json()["success"], True)
+        for site_id in self.site_ids:
+            scan = Scans().get(site_id=site_id, plan_name=self.TEST_PLAN["name"]).json()["scans"][0]
+            res = Scan(self.user.email, self.TEST_PLAN["name"], {}).start(scan["id"])
+            self.assertEqual(res.json()["success"], False)
+            if scan["state"] == "CREATED":
+                self.assertEqual(res.json()["error"], "campaign-scan")
+
+    def test_create_campaign_errors(self):
+        res = Campaign(self.user.email, "no-such-group").create()
+        self.assertEqual(res.json()["reason"], "no-such-group")
+        res = Campaign(self.user.email, self.group_name, priority="urgent").create()
+        self.assertEqual(res.json()["reason"], "unknown-priority")
+        res = Campaign(self.user.email, self.group_name, max_running=0).create()
+        self.assertEqual(res.json()["reason"], "invalid-campaign")
+        res = Campaign("nobody@example.org", self.group_name).create()
+        self.assertEqual(res.json()["reason"], "no-such-user")
+        User("eve@example.org").create()
+        res = Campaign("eve@example.org", self.group_name).create()
+        self.assertEqual(res.json()["reason"], "no-such-group")
@@ -147,3 +147,20 @@ class TestPlanAPIs(TestAPIBaseClass):
         _res2_plan = {key:value for key,value in res2.json()["plan"].items() 
                 if key in ("name", "description", "workflow")}
         self.assertEqual(_res2_plan, _new_plan)
+
+    def test_get_plan_with_etag(self):
+        plan = Plan(self.TEST_PLAN)
+        plan.create()
+        res1 = plan.get(self.TEST_PLAN["name"])
+        etag = res1.headers["etag"]
+
+        res2 = plan.get(self.TEST_PLAN["name"], etag=etag)
+        self.assertEqual(res2.status_code, 304)
+
+        # an update changes the etag
+        new_plan = dict(self.TEST_PLAN, description="Changed Test")
+        plan.update(self.TEST_PLAN["name"], new_plan)
+        res3 = plan.get(self.TEST_PLAN["name"], etag=etag)
+        self.assertEqual(res3.status_code, 200)
+        self.assertEqual(res3.json()["plan"]["description"], "Changed Test")
+        self.assertNotEqual(res3.headers["etag"], etag)
@@ -2,7 +2,9 @@
 # License, v. 2.0. If a copy of the MPL was not distributed with this
 # file, You can obtain one at http://mozilla.org/MPL/2.0/.
 
-from base import (TestAPIBaseClass, Plugins)
+import time
+
+from base import (TestAPIBaseClass, Plan, Plugins, Scan, Site, User)
 
 class TestPluginAPIs(TestAPIBaseClass):
 
@@ -25,6 +27,44 @@ class TestPluginAPIs(TestAPIBaseClass):
         # check following keys are returned for each plugin
         for plugin in resp.json()['plugins']:
             self.assertEqual(set(plugin.keys()),
-                set(["class", "name", "version", "weight"]),
-                msg={"Plugin {name} should have class,name,version,weight defined.".format(
+                set(["class", "name", "version", "weight", "inputs"]),
+                msg={"Plugin {name} should have class,name,version,weight,inputs defined.".format(
                         name=plugin["name"])})        
+
+    def test_get_plugins_with_etag(self):
+        resp = Plugins().get()
+        resp2 = Plugins().get(etag=resp.headers["etag"])
+        self.assertEqual(resp2.status_code, 304)
+
+    def test_get_plugin_stats(self):
+        plan = Plan({"name": "test-plan",
+                     "description": "Plan that runs HelloWorldPlugin",
+                     "workflow": [{"plugin_name": "minion.plugins.test.HelloWorldPlugin",
+                                   "description": "",
+                                   "configuration": {}}]})
+        plan.create()
+        User(self.email).create()
+        Site(self.target_url, plans=["test-plan"]).create()
+
+        # Nothing has run yet
+        resp = Plugins().get_stats(plugin_class="minion.plugins.test.HelloWorldPlugin")
+        self.assertEqual(resp.json()["success"], True)
+        self.assertEqual(resp.json()["stats"], [])
+
+        scan = Scan(self.email, "test-plan", {"target": self.target_url})
+        scan_id = scan.create().json()["scan"]["id"]
+        scan.start(scan_id)
+        time.sleep(6)
+
+        resp = Plugins().get_stats(plugin_class="minion.plugins.test.HelloWorldPlugin")
+        self.assertEqual(resp.json()["success"], True)
+        self.assertEqual(len(resp.json()["stats"]), 1)
+        stats = resp.json()["stats"][0]
+        self.assertEqual(stats["class"], "minion.plugins.test.HelloWorldPlugin")
+        self.assertEqual(stats["runs"], 1)
+        self.assertEqual(stats["states"], {"FINISHED": 1})
+        self.assertEqual(stats["failure_rate"], 0)
+        self.assertEqual(stats["issues_per_run"], 1)
+        self.assertEqual(set(stats["duration"].keys()), set(["mean", "p50", "p95", "p99"]))
+        self.assertTrue(stats["duration"]["mean"] >= 0)
+        self.assertTrue(stats["duration"]["p50"] <= stats["duration"]["p95"] <= stats["duration"]["p99"])
@@ -2,9 +2,10 @@
 # License, v. 2.0. If a copy of the MPL was not distributed with this
 # file, You can obtain one at http://mozilla.org/MPL/2.0/.
 
+import json
 import time
 
-from base import (TestAPIBaseClass, User, Site, Group, Plan, Scan, Scans, Reports)
+from base import (TestAPIBaseClass, User, Site, Sites, Group, Plan, Scan, Scans, Reports)
 
 class TestScanAPIs(TestAPIBaseClass):
     TEST_PLAN = {
@@ -40,7 +41,8 @@ class TestScanAPIs(TestAPIBaseClass):
         expected_top_keys = ('success', 'scan',)
         self.assertEqual(res.json()["success"], True)
         expected_scan_keys = set(['id', 'state', 'created', 'queued', 'started', \
-                'finished', 'plan', 'configuration', 'sessions', 'meta'])
+                'finished', 'plan', 'configuration', 'sessions', 'meta', 'seq', \
+                'issues', 'schedule', 'configuration_hash'])
         self.assertEqual(set(res.json()["scan"].keys()), expected_scan_keys)
 
         meta = res.json()['scan']['meta']
@@ -54,7 +56,7 @@ class TestScanAPIs(TestAPIBaseClass):
         scan = res.json()['scan']
         expected_session_keys = ['id', 'state', 'plugin', 'configuration', \
                 'description', 'artifacts', 'issues', 'created', 'started', \
-                'queued', 'finished', 'progress']
+                'queued', 'finished', 'progress', 'weight']
         for session in scan['sessions']:
             self.assertEqual(set(session.keys()), set(expected_session_keys))
             self.assertEqual(session['configuration']['target'], self.target_url)
@@ -62,6 +64,7 @@ class TestScanAPIs(TestAPIBaseClass):
             self.assertEqual(session['state'], 'CREATED')
             self.assertEqual(session['artifacts'], {})
             self.assertEqual(session['issues'], [])
+            self.assertTrue(session['weight'] in ('heavy', 'light'))
             for name in ('queued', 'started', 'finished', 'progress'):
                 self.assertEqual(session[name], None)
 
@@ -78,6 +81,21 @@ class TestScanAPIs(TestAPIBaseClass):
         res3 = scan.get_scan_details(scan_id, email=self.user.email)
         self.assertEqual(res3.json(), res2.json())
 
+    def test_get_scan_details_as_ndjson(self):
+        scan = Scan(self.user.email, self.TEST_PLAN["name"], {"target": self.target_url})
+        res1 = scan.create()
+        scan_id = res1.json()['scan']['id']
+
+        res2 = scan.get_scan_details(scan_id, format="ndjson")
+        self.assertEqual(res2.headers["content-type"], "application/x-ndjson")
+        # the scan has no issues yet, so there is only the scan line
+        lines = res2.text.splitlines()
+        self.assertEqual(len(lines), 1)
+        scan_line = json.loads(lines[0])["scan"]
+        self.assertEqual(scan_line["id"], scan_id)
+        self.assertEqual([s["id"] for s in scan_line["sessions"]],
+                         [s["id"] for s in res1.json()["scan"]["sessions"]])
+
     # bug #140 and bug #146
     def test_get_scan_details_filter_with_nonexistent_user(self):
         # If we give a non-existent user in the request argument, it will return user not found
@@ -105,6 +123,31 @@ class TestScanAPIs(TestAPIBaseClass):
         self.assertEqual(res2.json()["success"], False)
         self.assertEqual(res2.json()["reason"], "not-found")
 
+    def test_get_scan_details_after_leaving_group(self):
+        # Access is revoked as soon as the user is removed from the group
+        scan = Scan(self.user.email, self.TEST_PLAN["name"], {"target": self.target_url})
+        scan_id = scan.create().json()['scan']['id']
+        res1 = scan.get_scan_details(scan_id, email=self.user.email)
+        self.assertEqual(res1.json()["success"], True)
+
+        self.group.update(remove_users=[self.user.email])
+        res2 = scan.get_scan_details(scan_id, email=self.user.email)
+        self.assertEqual(res2.json()["success"], False)
+        self.assertEqual(res2.json()["reason"], "not-found")
+
+    def test_get_latest_scan(self):
+        site_id = Sites().get(url=self.target_url).json()['sites'][0]['id']
+        scan = Scan(self.user.email, self.TEST_PLAN["name"], {"target": self.target_url})
+        scan.create()
+        scan_id = scan.create().json()['scan']['id']
+
+        # the most recent scan is served from the latest_scans collection
+        res = Scans().get(limit=1, site_id=site_id, plan_name=self.TEST_PLAN["name"])
+        self.assertEqual(res.json()["success"], True)
+        self.assertEqual(len(res.json()["scans"]), 1)
+        self.assertEqual(res.json()["scans"][0]["id"], scan_id)
+        self.assertEqual(res.json()["scans"][0]["state"], "CREATED")
+
     def test_scan(self):
         """
         This is a comprehensive test that runs through the following
@@ -132,6 +175,7 @@ class TestScanAPIs(TestAPIBaseClass):
 
         # PUT /scans/<scan_id>/control
         # Start the scan now.
+        self.assertEqual(scan.start(scan_id, priority='bogus').json()['error'], 'unknown-priority')
         res2 = scan.start(scan_id)
         self.assertEqual(res2.json()['success'], True)
 
@@ -157,6 +201,9 @@ class TestScanAPIs(TestAPIBaseClass):
         # bug #106 include scan creator in the output
         self.assertEqual(res5.json()['summary']['meta'], 
             {'user': self.email, 'tags': []})
+        # the scan keeps a count of its issues
+        self.assertEqual(res5.json()['summary']['issues'],
+            {'high': 0, 'medium': 0, 'low': 0, 'info': 1})
 
         # GET /reports/history
         res6 = Reports().get_history()
@@ -187,3 +234,150 @@ class TestScanAPIs(TestAPIBaseClass):
         self.assertEqual('Info', issues[0]['severity'])
         self.assertEqual(issues[0]["severity"], "Info")
         self.assertEqual(res8.json()['report'][0]['target'], self.target_url)
+
+    def test_get_scan_events(self):
+        scan = Scan(self.user.email, self.TEST_PLAN["name"], {"target": self.target_url})
+        res1 = scan.create()
+        scan_id = res1.json()['scan']['id']
+        scan.start(scan_id)
+
+        # Each request returns the events so far, ask again until the scan has finished
+        events = []
+        for _ in range(60):
+            time.sleep(1)
+            res2 = scan.get_events(scan_id, since=events[-1]["seq"] if events else 0)
+            self.assertEqual(res2.headers["content-type"], "text/event-stream")
+            events += [json.loads(line[5:]) for line in res2.text.splitlines() if line.startswith("data:")]
+            if events and events[-1]["type"] == "scan-state" and events[-1]["state"] == "FINISHED":
+                break
+        self.assertEqual([e["seq"] for e in events], range(1, len(events) + 1))
+        self.assertEqual((events[0]["type"], events[0]["state"]), ("scan-state", "QUEUED"))
+        self.assertEqual((events[-1]["type"], events[-1]["state"]), ("scan-state", "FINISHED"))
+        issues = [e["issue"] for e in events if e["type"] == "issue"]
+        self.assertEqual([i["Summary"] for i in issues], ["Hello World"])
+
+        # A finished scan has no more events
+        res3 = scan.get_events(scan_id, since=events[-1]["seq"])
+        self.assertEqual([line for line in res3.text.splitlines() if line.startswith("data:")], [])
+
+    def test_get_scan_changes(self):
+        scan = Scan(self.user.email, self.TEST_PLAN["name"], {"target": self.target_url})
+        res1 = scan.create()
+        scan_id = res1.json()['scan']['id']
+        self.assertEqual(res1.json()['scan']['seq'], 0)
+
+        # Nothing has happened yet
+        res2 = scan.get_scan_details(scan_id, since=0)
+        self.assertEqual(res2.json()['scan']['sessions'], [])
+        self.assertEqual(res2.json()['scan']['seq'], 0)
+
+        scan.start(scan_id)
+        time.sleep(6)
+
+        res3 = scan.get_scan_details(scan_id, since=0)
+        self.assertEqual(res3.json()['scan']['state'], 'FINISHED')
+        sessions = res3.json()['scan']['sessions']
+        self.assertEqual(len(sessions), 1)
+        self.assertEqual(sessions[0]['state'], 'FINISHED')
+        self.assertEqual([i['Summary'] for i in sessions[0]['issues']], ['Hello World'])
+
+        res4 = scan.get_scan_details(scan_id, since=res3.json()['scan']['seq'])
+        self.assertEqual(res4.json()['scan']['sessions'], [])
+        self.assertEqual(res4.json()['scan']['seq'], res3.json()['scan']['seq'])
+
+    def test_get_scan_diff(self):
+        scan = Scan(self.user.email, self.TEST_PLAN["name"], {"target": self.target_url})
+        scan_ids = []
+        for i in range(2):
+            scan_id = scan.create().json()['scan']['id']
+            scan.start(scan_id)
+            time.sleep(6)
+            scan_ids.append(scan_id)
+
+        # The first scan has nothing to compare with
+        res1 = scan.get_diff(scan_ids[0])
+        self.assertEqual(res1.json()['diff']['previous'], None)
+        self.assertEqual([i['summary'] for i in res1.json()['diff']['new']], ['Hello World'])
+
+        # HelloWorldPlugin reports the same issue every time
+        res2 = scan.get_diff(scan_ids[1])
+        self.assertEqual(res2.json()['diff']['previous'], scan_ids[0])
+        self.assertEqual(res2.json()['diff']['new'], [])
+        self.assertEqual(res2.json()['diff']['fixed'], [])
+        self.assertEqual([i['summary'] for i in res2.json()['diff']['unchanged']], ['Hello World'])
+
+    def test_get_trends(self):
+        scan = Scan(self.user.email, self.TEST_PLAN["name"], {"target": self.target_url})
+        scan_id = scan.create().json()['scan']['id']
+        scan.start(scan_id)
+        time.sleep(6)
+
+        for res in (Reports().get_trends(site=self.target_url, days=7),
+                    Reports().get_trends(group_name=self.group.group_name, days=7),
+                    Reports().get_trends(days=7)):
+            self.assertEqual(res.json()['success'], True)
+            report = res.json()['report']
+            self.assertEqual(len(report), 7)
+            # HelloWorldPlugin reports one informational issue
+            self.assertEqual(report[-1]['issues'], {'high': 0, 'medium': 0, 'low': 0, 'info': 1})
+            self.assertEqual(report[-1]['codes'], {})
+            self.assertEqual(report[-1]['sites'], 1)
+
+        # Bob can not see the report of all sites
+        res = Reports().get_trends(user=self.user.email)
+        self.assertEqual(res.json()['success'], False)
+
+    def test_create_scan_batch(self):
+        res = Scans().create_batch(self.user.email, self.TEST_PLAN["name"], [self.target_url] * 3,
+                                   start=True, priority="scheduled")
+        self.assertEqual(res.json()["success"], True)
+        self.assertEqual(len(res.json()["scans"]), 3)
+        scan = Scan(self.user.email, self.TEST_PLAN["name"], {"target": self.target_url})
+        details = scan.get_scan_details(res.json()["scans"][0]).json()["scan"]
+        self.assertEqual(details["schedule"]["priority"], "scheduled")
+        self.assertEqual(details["sessions"][0]["configuration"]["target"], self.target_url)
+
+        res = Scans().create_batch(self.user.email, "no-such-plan", [self.target_url])
+        self.assertEqual(res.json()["reason"], "unknown-plan")
+
+    def test_coalesce_scans(self):
+        scan = Scan(self.user.email, self.TEST_PLAN["name"], {"target": self.target_url})
+        first = scan.create().json()["scan"]
+        second = scan.create().json()["scan"]
+        self.assertEqual(first["configuration_hash"], second["configuration_hash"])
+        scan.start(first["id"])
+        res = scan.start(second["id"], coalesce="true")
+        self.assertEqual(res.json()["success"], True)
+
+        # The second scan waits for the first and then gets its results
+        for _ in range(30):
+            details = scan.get_scan_details(second["id"]).json()["scan"]
+            if details["state"] == "FINISHED":
+                break
+            time.sleep(1)
+        self.assertEqual(details["coalesced"]["scan"], first["id"])
+        self.assertEqual(details["state"], "FINISHED")
+        self.assertEqual(details["issues"]["info"], 1)
+
+    def test_smart_rescan(self):
+        scan = Scan(self.user.email, self.TEST_PLAN["name"], {"target": self.target_url})
+        first = scan.create(smart_rescan=True).json()["scan"]
+        self.assertEqual(first["smart_rescan"], True)
+        scan.start(first["id"])
+        for _ in range(30):
+            details = scan.get_scan_details(first["id"]).json()["scan"]
+            if details["state"] == "FINISHED":
+                break
+            time.sleep(1)
+        self.assertEqual(details["state"], "FINISHED")
+
+        # HelloWorldPlugin does not declare its inputs, so it always runs
+        second = scan.create(smart_rescan=True).json()["scan"]
+        scan.start(second["id"])
+        for _ in range(30):
+            details = scan.get_scan_details(second["id"]).json()["scan"]
+            if details["state"] == "FINISHED":
+                break
+            time.sleep(1)
+        self.assertTrue("carried_over" not in details["sessions"][0])
+        self.assertEqual(details["issues"]["info"], 1)
@@ -0,0 +1,61 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import time
+
+from base import (TestAPIBaseClass, User, Site, Group, Plan, Schedule)
+
+class TestScheduleAPIs(TestAPIBaseClass):
+    TEST_PLAN = {
+        "name": "test-plan",
+        "description": "Plan that runs HelloWorldPlugin",
+        "workflow": [
+            {
+                "plugin_name": "minion.plugins.test.HelloWorldPlugin",
+                "description": "",
+                "configuration": {}
+            }
+        ]
+    }
+
+    def setUp(self):
+        super(TestScheduleAPIs, self).setUp()
+        Plan(self.TEST_PLAN).create()
+        self.user = User(self.email)
+        self.user.create()
+        Site(self.target_url, plans=[self.TEST_PLAN["name"]]).create()
+        Group(self.group_name, sites=[self.target_url], users=[self.user.email]).create()
+
+    def test_create_schedule(self):
+        schedule = Schedule(self.user.email, self.target_url, self.TEST_PLAN["name"], cron="0 0 * * *", jitter=600)
+        res = schedule.create()
+        self.assertEqual(res.json()["success"], True)
+        created = res.json()["schedule"]
+        self.assertEqual(created["enabled"], True)
+        self.assertTrue(created["next_run"] > time.time())
+        self.assertTrue(0 <= created["next_run"] - created["slot"] < 600)
+        self.assertEqual(created["slot"] % 86400, 0)
+
+        res = schedule.update(created["id"], interval=3600, enabled=False)
+        self.assertEqual(res.json()["schedule"]["cron"], None)
+        self.assertEqual(res.json()["schedule"]["enabled"], False)
+
+        res = schedule.get(target=self.target_url)
+        self.assertEqual([s["id"] for s in res.json()["schedules"]], [created["id"]])
+        res = schedule.delete(created["id"])
+        self.assertEqual(res.json()["success"], True)
+        res = schedule.get()
+        self.assertEqual(res.json()["schedules"], [])
+
+    def test_create_invalid_schedule(self):
+        for interval, cron in ((None, None), (3600, "0 0 * * *"), (10, None), (None, "0 0 30 2 *"), (None, "61 * * * *")):
+            res = Schedule(self.user.email, self.target_url, self.TEST_PLAN["name"], interval=interval, cron=cron).create()
+            self.assertEqual(res.json()["reason"], "invalid-schedule")
+        for interval, jitter in ((1e20, None), (3600, 0.5), (3600, -1), (3600, 1e20)):
+            res = Schedule(self.user.email, self.target_url, self.TEST_PLAN["name"], interval=interval, jitter=jitter).create()
+            self.assertEqual(res.json()["reason"], "invalid-schedule")
+        res = Schedule(self.user.email, self.target_url, "no-such-plan", interval=3600).create()
+        self.assertEqual(res.json()["reason"], "no-such-plan")
+        res = Schedule(self.user.email, "http://localhost:4321", self.TEST_PLAN["name"], interval=3600).create()
+        self.assertEqual(res.json()["reason"], "no-such-site")
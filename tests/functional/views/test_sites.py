@@ -12,7 +12,7 @@ class TestSitesAPIs(TestAPIBaseClass):
                                       "configuration": { "foo": "bar" }
                                       } ] }
 
-    expected_inner_keys = ('id', 'url', 'plans', 'created', 'verification', "groups")
+    expected_inner_keys = ('id', 'url', 'plans', 'created', 'verification', "groups", "politeness")
 
     def create_plan(self):
         self.plan = Plan(self.TEST_PLAN)
@@ -48,6 +48,18 @@ class TestSitesAPIs(TestAPIBaseClass):
         self.assertEqual(res.json()['site']['verification']['enabled'], True)
         self.assertTrue(res.json()['site']['verification']['value'])
 
+    def test_create_site_with_politeness(self):
+        site = Site(self.target_url, politeness={"rate": 2, "concurrency": 1})
+        res = site.create()
+        self.assertEqual(res.json()['site']['politeness'], {"rate": 2, "concurrency": 1})
+
+        # Bursts and concurrency are whole numbers of requests
+        for politeness in ({"rate": -1}, {"burst": 0.5}, {"concurrency": 1.5}, {"burst": 0}):
+            site = Site(self.target_url + ":8080", politeness=politeness)
+            res = site.create()
+            self.assertEqual(res.json()['success'], False)
+            self.assertEqual(res.json()['reason'], 'invalid-politeness')
+
     def test_create_duplicate_site(self):
         group = Group(self.group_name)
         group.create()
@@ -71,6 +83,39 @@ class TestSitesAPIs(TestAPIBaseClass):
         self.assertEqual(res.json()['sites'][0]['groups'], site.groups)
         self.assertEqual(res.json()['sites'][0]['plans'], site.plans)
 
+    def test_get_sites_by_page(self):
+        urls = ["http://a.example.com", "http://b.example.com", "http://c.example.com"]
+        for url in urls:
+            Site(url).create()
+
+        res1 = Sites().get(limit=2)
+        self.assertEqual(res1.json()["success"], True)
+        self.assertEqual(len(res1.json()["sites"]), 2)
+        self.assertTrue(res1.json()["next"])
+
+        res2 = Sites().get(limit=2, after=res1.json()["next"])
+        self.assertEqual(len(res2.json()["sites"]), 1)
+        self.assertEqual(res2.json()["next"], None)
+
+        seen = [site["url"] for site in res1.json()["sites"] + res2.json()["sites"]]
+        self.assertEqual(sorted(seen), urls)
+
+    def test_get_sites_with_fields(self):
+        Site(self.target_url).create()
+        res = Sites().get(fields=["url", "plans"])
+        self.assertEqual(set(res.json()["sites"][0].keys()), set(["url", "plans"]))
+
+    def test_get_sites_without_field_names(self):
+        Site(self.target_url).create()
+        res = Sites().get(fields=["", ""])
+        self.assertEqual(res.json()["success"], True)
+        self.assertEqual(res.json()["sites"][0]["url"], self.target_url)
+
+    def test_get_sites_with_invalid_cursor(self):
+        res = Sites().get(limit=2, after="yesterday")
+        self.assertEqual(res.json()["success"], False)
+        self.assertEqual(res.json()["reason"], "invalid-page")
+
     def test_get_site(self):
         group = Group(self.group_name)
         group.create()
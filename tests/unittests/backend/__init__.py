@@ -0,0 +1,10 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+from mock import patch
+
+# The tasks module connects to mongodb when it is imported, so it is
+# imported once here without a connection for all the tests
+with patch('minion.backend.metrics.InstrumentedMongoClient'):
+    from minion.backend import tasks
@@ -0,0 +1,122 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import unittest
+from mock import patch
+
+from minion.backend import tasks
+
+PLUGIN = {'class': 'minion.plugins.basic.XFrameOptionsPlugin', 'version': '0.1', 'inputs': ['X-Frame-Options']}
+CONFIGURATION = {'target': 'http://a'}
+
+class Response(object):
+    def __init__(self, headers, url='http://a/', status=200):
+        self.headers = headers
+        self.url = url
+        self.status = status
+
+class TestInputFingerprint(unittest.TestCase):
+
+    def test_same_inputs(self):
+        fingerprint = tasks.input_fingerprint(PLUGIN, CONFIGURATION, Response({'X-Frame-Options': 'DENY', 'Date': 'a'}))
+        self.assertEqual(fingerprint, tasks.input_fingerprint(PLUGIN, CONFIGURATION,
+                                                              Response({'X-Frame-Options': 'DENY', 'Date': 'b'})))
+
+    def test_different_inputs(self):
+        fingerprint = tasks.input_fingerprint(PLUGIN, CONFIGURATION, Response({'X-Frame-Options': 'DENY'}))
+        for plugin, configuration, response in ((PLUGIN, CONFIGURATION, Response({'X-Frame-Options': 'SAMEORIGIN'})),
+                                                (PLUGIN, CONFIGURATION, Response({})),
+                                                (PLUGIN, CONFIGURATION, Response({'X-Frame-Options': 'DENY'}, status=301)),
+                                                (PLUGIN, CONFIGURATION, Response({'X-Frame-Options': 'DENY'}, url='http://a/b')),
+                                                (PLUGIN, {'target': 'http://b'}, Response({'X-Frame-Options': 'DENY'})),
+                                                (dict(PLUGIN, version='0.2'), CONFIGURATION, Response({'X-Frame-Options': 'DENY'}))):
+            self.assertNotEqual(tasks.input_fingerprint(plugin, configuration, response), fingerprint)
+
+def _issue(i, severity, carried_over=None):
+    issue = {'Id': 'i%d' % i, 'Code': 'XFO-%d' % i, 'Severity': severity}
+    if carried_over:
+        issue['CarriedOver'] = carried_over
+    return {'_id': i, 'scan_id': 'previous', 'session_id': 'ps', 'seq': i, 'severity': severity,
+            'issue': issue, 'template': None}
+
+class TestCopyIssues(unittest.TestCase):
+
+    def test_copy_issues(self):
+        copied = [_issue(1, 'High'), _issue(2, 'Info', 'oldest')]
+        with patch.object(tasks, 'issues') as issues:
+            events = tasks.copy_issues('scan', copied, {'ps': 'session'}, 10, 'previous')
+        issues.insert.assert_called_once_with(copied)
+        self.assertEqual([(issue['scan_id'], issue['session_id'], issue['seq']) for issue in copied],
+                         [('scan', 'session', 11), ('scan', 'session', 12)])
+        self.assertTrue(all('_id' not in issue for issue in copied))
+        # Tagged with the scan that found them first
+        self.assertEqual([issue['issue']['CarriedOver'] for issue in copied], ['previous', 'oldest'])
+        self.assertEqual([(event['seq'], event['type'], event['session']) for event in events],
+                         [(11, 'issue', 'session'), (12, 'issue', 'session')])
+        self.assertEqual(events[0]['issue'], copied[0]['issue'])
+
+    def test_copy_issues_without_carry_over(self):
+        copied = [_issue(1, 'High')]
+        with patch.object(tasks, 'issues'):
+            tasks.copy_issues('scan', copied, {'ps': 'session'}, 0)
+        self.assertNotIn('CarriedOver', copied[0]['issue'])
+
+class TestSessionCarryOver(unittest.TestCase):
+
+    def setUp(self):
+        self.patches = [patch.object(tasks, name) for name in ('scans', 'latest_scans', 'issues', 'scan_events',
+                                                               'record_event', 'refresh_latest_scan')]
+        (self.scans, self.latest_scans, self.issues, self.scan_events,
+         self.record_event, self.refresh_latest_scan) = [p.start() for p in self.patches]
+        self.previous = {'id': 'previous', 'sessions': [{'id': 'ps', 'state': 'FINISHED', 'fingerprint': 'f'}]}
+        self.scans.find_one.side_effect = [{'id': 'scan', 'configuration': CONFIGURATION, 'plan': {'name': 'basic'}},
+                                           self.previous]
+        self.latest_scans.find_one.return_value = {'finished': {'id': 'previous'}}
+        self.copied = [_issue(1, 'High'), _issue(2, 'High'), _issue(3, 'Info')]
+        self.issues.find.return_value.sort.return_value = self.copied
+        # Five events were recorded before, three are reserved
+        self.scans.find_and_modify.return_value = {'seq': 8}
+
+    def tearDown(self):
+        for p in self.patches:
+            p.stop()
+
+    def test_carry_over(self):
+        self.assertTrue(tasks.session_carry_over('scan', 'session', 'f'))
+        self.assertEqual(self.scans.update.call_args[0],
+                         ({'id': 'scan', 'sessions.id': 'session'}, {'$set': {'sessions.$.fingerprint': 'f'}}))
+        self.issues.find.assert_called_once_with({'scan_id': 'previous', 'session_id': 'ps'})
+        spec, document = self.scans.find_and_modify.call_args[0]
+        self.assertEqual(spec, {'id': 'scan', 'sessions.id': 'session'})
+        self.assertEqual(document['$inc'], {'issues.high': 2, 'issues.info': 1, 'seq': 3})
+        self.assertEqual(document['$set']['sessions.$.state'], 'FINISHED')
+        self.assertEqual(document['$set']['sessions.$.carried_over'], 'previous')
+        # The issues get the reserved sequence numbers
+        self.assertEqual([issue['seq'] for issue in self.copied], [6, 7, 8])
+        self.assertEqual([issue['issue']['CarriedOver'] for issue in self.copied], ['previous'] * 3)
+        self.assertEqual([event['seq'] for event in self.scan_events.insert.call_args[0][0]], [6, 7, 8])
+        self.record_event.assert_called_once_with('scan', 'session-state', session='session', state='FINISHED')
+        self.refresh_latest_scan.assert_called_once_with('scan')
+
+    def test_different_fingerprint(self):
+        self.assertFalse(tasks.session_carry_over('scan', 'session', 'g'))
+        self.assertEqual(self.scans.update.call_args[0][1], {'$set': {'sessions.$.fingerprint': 'g'}})
+        self.assertFalse(self.scans.find_and_modify.called)
+        self.assertFalse(self.issues.insert.called)
+
+    def test_previous_session_did_not_finish(self):
+        self.previous['sessions'][0]['state'] = 'FAILED'
+        self.assertFalse(tasks.session_carry_over('scan', 'session', 'f'))
+        self.assertFalse(self.scans.find_and_modify.called)
+
+    def test_without_finished_scan(self):
+        self.latest_scans.find_one.return_value = {'scan': {'id': 'previous'}}
+        self.assertFalse(tasks.session_carry_over('scan', 'session', 'f'))
+        self.assertFalse(self.scans.find_and_modify.called)
+
+    def test_compacted_previous_scan(self):
+        self.scans.find_one.side_effect = [{'id': 'scan', 'configuration': CONFIGURATION, 'plan': {'name': 'basic'}},
+                                           None]
+        self.assertFalse(tasks.session_carry_over('scan', 'session', 'f'))
+        self.assertEqual(self.scans.find_one.call_args[0][0], {'id': 'previous', 'compacted': {'$exists': False}})
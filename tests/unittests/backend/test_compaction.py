@@ -0,0 +1,134 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import datetime
+import unittest
+import mongomock
+from mock import patch
+
+from minion.backend import tasks
+
+def _scan(scan_id, target, state, day, plan='basic', compacted=None):
+    scan = {'id': scan_id, 'configuration': {'target': target}, 'plan': {'name': plan}, 'state': state,
+            'created': datetime.datetime(2013, 10, day)}
+    if compacted:
+        scan['compacted'] = True
+    return scan
+
+class CompactionTestCase(unittest.TestCase):
+
+    def setUp(self):
+        db = mongomock.MongoClient().minion
+        self.patches = [patch.object(tasks, 'scans', db.scans),
+                        patch.object(tasks, 'latest_scans', db.latest_scans),
+                        patch.object(tasks, 'scheduler', db.scheduler)]
+        for p in self.patches:
+            p.start()
+        self.db = db
+
+    def tearDown(self):
+        for p in self.patches:
+            p.stop()
+
+    def add_scans(self, *scans):
+        for scan in scans:
+            self.db.scans.insert(scan)
+            self.db.latest_scans.update({'target': scan['configuration']['target'], 'plan': scan['plan']['name']},
+                                        {'$set': {'scan': {'id': scan['id']}}}, upsert=True)
+
+class TestCompactionCandidates(CompactionTestCase):
+
+    def test_too_few_finished_scans(self):
+        self.add_scans(_scan('a1', 'http://a', 'FAILED', 1),
+                       _scan('a2', 'http://a', 'FINISHED', 2),
+                       _scan('a3', 'http://a', 'FINISHED', 3, plan='full'))
+        self.assertEqual(tasks.compaction_candidates('http://a', 'basic', 2, 10), [])
+
+    def test_scans_before_oldest_kept_finished_scan(self):
+        self.add_scans(_scan('a3', 'http://a', 'STOPPED', 3),
+                       _scan('a1', 'http://a', 'FAILED', 1),
+                       _scan('a0', 'http://a', 'FINISHED', 1, compacted=True),
+                       _scan('a2', 'http://a', 'FINISHED', 2),
+                       _scan('a4', 'http://a', 'FINISHED', 4),
+                       _scan('a5', 'http://a', 'STOPPED', 5),
+                       _scan('a6', 'http://a', 'FINISHED', 6),
+                       _scan('b1', 'http://b', 'FINISHED', 1),
+                       _scan('f1', 'http://a', 'FINISHED', 1, plan='full'))
+        # Any scan that ended before the oldest kept FINISHED scan, also
+        # failed and stopped ones, oldest first, but never the kept
+        # FINISHED scans or the scans created after them
+        self.assertEqual(tasks.compaction_candidates('http://a', 'basic', 2, 10), ['a1', 'a2', 'a3'])
+        self.assertEqual(tasks.compaction_candidates('http://a', 'basic', 2, 2), ['a1', 'a2'])
+        self.assertEqual(tasks.compaction_candidates('http://a', 'basic', 1, 10), ['a1', 'a2', 'a3', 'a4', 'a5'])
+        self.assertEqual(tasks.compaction_candidates('http://a', 'basic', 3, 10), ['a1'])
+
+    def test_scans_that_did_not_end(self):
+        self.add_scans(_scan('a1', 'http://a', 'QUEUED', 1),
+                       _scan('a2', 'http://a', 'STARTED', 2),
+                       _scan('a3', 'http://a', 'FINISHED', 3))
+        self.assertEqual(tasks.compaction_candidates('http://a', 'basic', 1, 10), [])
+
+class TestCompactScans(CompactionTestCase):
+
+    def setUp(self):
+        super(TestCompactScans, self).setUp()
+        self.compacted = []
+        self.failing = set()
+        def compact_scan(scan_id, policy):
+            self.compacted.append(scan_id)
+            if scan_id in self.failing:
+                raise Exception('boom')
+            self.db.scans.update({'id': scan_id}, {'$set': {'compacted': True}})
+        self.patches += [patch.object(tasks, 'compact_scan', side_effect=compact_scan),
+                         patch.object(tasks, 'retention_policy')]
+        self.patches[-2].start()
+        self.policy = self.patches[-1].start()
+        # Two FINISHED scans are kept of every site
+        self.add_scans(_scan('a1', 'http://a', 'FINISHED', 1),
+                       _scan('a2', 'http://a', 'FINISHED', 2),
+                       _scan('a3', 'http://a', 'FINISHED', 3),
+                       _scan('b1', 'http://b', 'FAILED', 1),
+                       _scan('b2', 'http://b', 'FINISHED', 2),
+                       _scan('b3', 'http://b', 'FINISHED', 3),
+                       _scan('b4', 'http://b', 'FINISHED', 4),
+                       _scan('b5', 'http://b', 'FINISHED', 5),
+                       _scan('c1', 'http://c', 'FINISHED', 1),
+                       _scan('c2', 'http://c', 'FINISHED', 2))
+
+    def _run(self, batch, keep=2):
+        self.policy.return_value = {'keep': keep, 'batch': batch}
+        tasks.compact_scans()
+        return self.db.scheduler.find_one({'_id': 'compaction'})['after']
+
+    def test_without_keep(self):
+        self.policy.return_value = {'keep': None, 'batch': 100}
+        tasks.compact_scans()
+        self.assertEqual(self.compacted, [])
+        self.assertEqual(self.db.scheduler.find_one({'_id': 'compaction'}), None)
+
+    def test_compacts_all_and_starts_over(self):
+        self.assertEqual(self._run(100), None)
+        self.assertEqual(self.compacted, ['a1', 'b1', 'b2', 'b3'])
+        # Nothing is left the next time
+        self.assertEqual(self._run(100), None)
+        self.assertEqual(self.compacted, ['a1', 'b1', 'b2', 'b3'])
+
+    def test_stops_after_batch_scans(self):
+        self.assertEqual(self._run(3), ['http://a', 'basic'])
+        self.assertEqual(self.compacted, ['a1', 'b1', 'b2'])
+        # The next run starts with http://b again
+        self.assertEqual(self._run(3), None)
+        self.assertEqual(self.compacted, ['a1', 'b1', 'b2', 'b3'])
+
+    def test_stops_after_batch_sites(self):
+        self.assertEqual(self._run(2, keep=4), ['http://b', 'basic'])
+        self.assertEqual(self.compacted, ['b1'])
+        # The next run starts after http://b
+        self.assertEqual(self._run(2, keep=4), None)
+        self.assertEqual(self.compacted, ['b1'])
+
+    def test_keeps_going_after_error(self):
+        self.failing.add('a1')
+        self._run(100)
+        self.assertEqual(self.compacted, ['a1', 'b1', 'b2', 'b3'])
@@ -0,0 +1,72 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import unittest
+from mock import MagicMock, patch
+from pymongo.errors import DuplicateKeyError
+
+from minion.backend import tasks
+
+PLUGIN = {'class': 'minion.plugins.basic.XFrameOptionsPlugin', 'version': '0.1'}
+KEY = 'minion.plugins.basic.XFrameOptionsPlugin 0.1 XFO-2'
+
+ISSUE = {'Id': 'a', 'Code': 'XFO-2', 'Severity': 'High', 'Summary': 'Invalid X-Frame-Options',
+         'Description': 'The header is not valid.', 'Solution': 'Fix it.'}
+
+class TestIssueTemplates(unittest.TestCase):
+
+    def setUp(self):
+        self.stored = {}
+        def insert(document):
+            if document['_id'] in self.stored:
+                raise DuplicateKeyError('duplicate key')
+            self.stored[document['_id']] = document
+        collection = MagicMock()
+        collection.insert.side_effect = insert
+        collection.find_one.side_effect = lambda spec: self.stored.get(spec['_id'])
+        self.patches = [patch.object(tasks, 'issue_templates', collection),
+                        patch.object(tasks, '_issue_templates', {}),
+                        patch.object(tasks, '_stored_issue_templates', set())]
+        for p in self.patches:
+            p.start()
+
+    def tearDown(self):
+        for p in self.patches:
+            p.stop()
+
+    def test_intern_issue(self):
+        key, instance = tasks.intern_issue(PLUGIN, ISSUE)
+        self.assertEqual(key, KEY)
+        self.assertEqual(instance, {'Id': 'a', 'Code': 'XFO-2', 'Severity': 'High', 'Summary': 'Invalid X-Frame-Options'})
+        self.assertEqual(self.stored[KEY]['fields'], {'Description': 'The header is not valid.', 'Solution': 'Fix it.'})
+        self.assertEqual(tasks.expand_issue(key, instance), ISSUE)
+
+    def test_intern_issue_keeps_different_fields(self):
+        tasks.intern_issue(PLUGIN, ISSUE)
+        key, instance = tasks.intern_issue(PLUGIN, dict(ISSUE, Id='b', Solution='Fix it now.'))
+        self.assertEqual(key, KEY)
+        self.assertEqual(instance['Solution'], 'Fix it now.')
+        self.assertEqual(tasks.expand_issue(key, instance), dict(ISSUE, Id='b', Solution='Fix it now.'))
+
+    def test_intern_issue_that_does_not_fit_template(self):
+        tasks.intern_issue(PLUGIN, ISSUE)
+        issue = dict((k, v) for k, v in ISSUE.iteritems() if k != 'Solution')
+        self.assertEqual(tasks.intern_issue(PLUGIN, issue), (None, issue))
+
+    def test_intern_issue_stores_cached_template_again(self):
+        # The template was loaded before the database lost it
+        tasks._issue_templates[KEY] = {'Description': 'The header is not valid.', 'Solution': 'Fix it.'}
+        key, instance = tasks.intern_issue(PLUGIN, ISSUE)
+        self.assertEqual(key, KEY)
+        self.assertEqual(self.stored[KEY]['fields'], {'Description': 'The header is not valid.', 'Solution': 'Fix it.'})
+
+    def test_intern_issue_stores_template_once(self):
+        tasks.intern_issue(PLUGIN, ISSUE)
+        tasks.intern_issue(PLUGIN, dict(ISSUE, Id='b'))
+        self.assertEqual(tasks.issue_templates.insert.call_count, 1)
+
+    def test_expand_issue_without_template(self):
+        instance = {'Id': 'a', 'Code': 'XFO-2', 'Severity': 'High', 'Summary': 'Invalid X-Frame-Options'}
+        self.assertEqual(tasks.expand_issue(KEY, instance), instance)
+        self.assertEqual(tasks.expand_issue(None, instance), instance)
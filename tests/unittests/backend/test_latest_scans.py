@@ -0,0 +1,48 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import datetime
+import unittest
+from mock import patch
+
+from minion.backend import tasks
+
+def _scan(scan_id, target, plan, created):
+    return {'id': scan_id, 'meta': {}, 'state': 'QUEUED', 'created': created, 'queued': created, 'sessions': [],
+            'finished': None, 'configuration': {'target': target}, 'plan': {'name': plan}}
+
+class TestUpdateLatestScans(unittest.TestCase):
+
+    def test_update_latest_scans(self):
+        created = datetime.datetime(2013, 10, 1)
+        new_scans = [_scan('a1', 'http://a', 'basic', created),
+                     _scan('b1', 'http://b', 'basic', created),
+                     _scan('a2', 'http://a', 'basic', created),
+                     _scan('a3', 'http://a', 'full', created)]
+        current = [{'target': 'http://a', 'plan': 'basic',
+                    'scan': {'id': 'old', 'created': created - datetime.timedelta(days=1)}},
+                   {'target': 'http://a', 'plan': 'full',
+                    'scan': {'id': 'newer', 'created': created + datetime.timedelta(days=1)}}]
+        with patch.object(tasks, 'latest_scans') as latest_scans:
+            latest_scans.find.return_value = current
+            tasks.update_latest_scans(new_scans)
+        # The current documents are loaded together
+        self.assertEqual(latest_scans.find.call_count, 1)
+        self.assertFalse(latest_scans.find_one.called)
+        self.assertEqual(sorted(latest_scans.find.call_args[0][0]['target']['$in']), ['http://a', 'http://b'])
+        # One update for each site and plan, with the last of its scans,
+        # unless a newer scan was recorded already
+        updates = dict((c[0][0]['target'] + ' ' + c[0][0]['plan'], c[0][1]['$set']['scan']['id'])
+                       for c in latest_scans.update.call_args_list)
+        self.assertEqual(updates, {'http://a basic': 'a2', 'http://b basic': 'b1'})
+
+    def test_update_latest_scans_in_chunks(self):
+        created = datetime.datetime(2013, 10, 1)
+        new_scans = [_scan(str(i), 'http://%d' % i, 'basic', created) for i in range(5)]
+        with patch.object(tasks, 'LATEST_SCANS_CHUNK_SIZE', 2):
+            with patch.object(tasks, 'latest_scans') as latest_scans:
+                latest_scans.find.return_value = []
+                tasks.update_latest_scans(new_scans)
+        self.assertEqual(latest_scans.find.call_count, 3)
+        self.assertEqual(latest_scans.update.call_count, 5)
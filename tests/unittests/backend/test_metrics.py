@@ -0,0 +1,63 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import unittest
+from mock import Mock, patch
+from pymongo import MongoClient
+
+from minion.backend import metrics
+from minion.backend.metrics import InstrumentedMongoClient, MetricsMiddleware, render_metrics
+
+class TestMetrics(unittest.TestCase):
+
+    def _app(self, environ, start_response):
+        environ['minion.endpoint'] = 'get_things'
+        self.client._send_message_with_response('query')
+        start_response('200 OK', [('Content-Type', 'application/json')])
+        return ['{"success":', 'true}']
+
+    def setUp(self):
+        self.client = object.__new__(InstrumentedMongoClient)
+        self.collection = Mock()
+
+    def test_record_request(self):
+        middleware = MetricsMiddleware(self._app, self.collection)
+        with patch.object(MongoClient, '_send_message_with_response') as send:
+            body = middleware({'REQUEST_METHOD': 'GET', 'PATH_INFO': '/things'}, Mock())
+            self.assertEqual(''.join(body), '{"success":true}')
+            self.assertEqual(send.call_count, 1)
+        spec, document = self.collection.update.call_args[0]
+        self.assertEqual(spec, {'endpoint': 'get_things', 'method': 'GET', 'status': '200'})
+        self.assertEqual(document['$inc']['count'], 1)
+        self.assertEqual(document['$inc']['buckets.0'], 1)
+        self.assertEqual(document['$inc']['mongo_operations'], 1)
+        self.assertEqual(document['$inc']['bytes'], 16)
+
+    def test_only_count_inside_requests(self):
+        with patch.object(MongoClient, '_send_message') as send:
+            self.client._send_message('insert')
+            self.assertEqual(send.call_count, 1)
+        self.assertEqual(getattr(metrics._local, 'stats', None), None)
+
+    def test_slow_request(self):
+        middleware = MetricsMiddleware(self._app, self.collection, slow_threshold=0.0)
+        with patch.object(MongoClient, '_send_message_with_response'):
+            with patch.object(metrics.logger, 'warning') as warning:
+                list(middleware({'REQUEST_METHOD': 'GET', 'PATH_INFO': '/things'}, Mock()))
+                self.assertTrue('/things (get_things)' in warning.call_args[0][0])
+
+    def test_render_metrics(self):
+        self.collection.find.return_value.sort.return_value = [
+            {'endpoint': 'get_things', 'method': 'GET', 'status': '200', 'count': 3,
+             'buckets': {'0': 1, '4': 1, '11': 1}, 'seconds': 20.5,
+             'mongo_operations': 6, 'mongo_seconds': 0.5, 'bytes': 48}]
+        lines = render_metrics(self.collection).splitlines()
+        labels = 'endpoint="get_things",method="GET",status="200"'
+        self.assertTrue('minion_http_request_duration_seconds_bucket{%s,le="0.005"} 1' % labels in lines)
+        self.assertTrue('minion_http_request_duration_seconds_bucket{%s,le="0.1"} 2' % labels in lines)
+        self.assertTrue('minion_http_request_duration_seconds_bucket{%s,le="10.0"} 2' % labels in lines)
+        self.assertTrue('minion_http_request_duration_seconds_bucket{%s,le="+Inf"} 3' % labels in lines)
+        self.assertTrue('minion_http_request_duration_seconds_count{%s} 3' % labels in lines)
+        self.assertTrue('minion_mongo_operations_total{%s} 6' % labels in lines)
+        self.assertTrue('minion_http_response_bytes_total{%s} 48' % labels in lines)
@@ -0,0 +1,72 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import unittest
+from mock import patch
+
+from minion.backend import tasks
+
+PLUGIN = {'class': 'minion.plugins.basic.HSTSPlugin', 'version': '0.1', 'name': 'HSTS', 'weight': 'light'}
+
+class TestRecordPluginRun(unittest.TestCase):
+
+    def _record(self, *args):
+        with patch.object(tasks, 'plugin_stats') as plugin_stats:
+            tasks.record_plugin_run(PLUGIN, *args)
+        self.assertEqual(plugin_stats.update.call_count, 1)
+        query, document = plugin_stats.update.call_args[0]
+        self.assertEqual(query, {'class': 'minion.plugins.basic.HSTSPlugin', 'version': '0.1'})
+        self.assertEqual(document['$set'], {'name': 'HSTS', 'weight': 'light'})
+        self.assertEqual(plugin_stats.update.call_args[1], {'upsert': True})
+        return document['$inc']
+
+    def test_record_plugin_run(self):
+        self.assertEqual(self._record('FINISHED', 4.5, 3, 1024),
+                         {'runs': 1, 'states.FINISHED': 1, 'issues': 3,
+                          'durations.2': 1, 'duration_sum': 4.5,
+                          'rss_sum': 1024, 'rss_runs': 1})
+
+    def test_record_plugin_run_without_duration_and_rss(self):
+        self.assertEqual(self._record('FAILED', None, 0, None),
+                         {'runs': 1, 'states.FAILED': 1, 'issues': 0})
+
+    def test_duration_buckets(self):
+        self.assertEqual(tasks._duration_bucket(0), 0)
+        self.assertEqual(tasks._duration_bucket(1), 0)
+        self.assertEqual(tasks._duration_bucket(1.5), 1)
+        self.assertEqual(tasks._duration_bucket(14400), len(tasks.PLUGIN_DURATION_BUCKETS) - 1)
+        self.assertEqual(tasks._duration_bucket(20000), len(tasks.PLUGIN_DURATION_BUCKETS))
+
+class TestSummarizePluginStats(unittest.TestCase):
+
+    def test_summarize_plugin_stats(self):
+        # 10 runs: 5 between 0 and 1 second, 4 between 2 and 5 seconds
+        # and 1 that was not timed
+        stats = {'class': 'minion.plugins.basic.HSTSPlugin', 'version': '0.1', 'name': 'HSTS', 'weight': 'light',
+                 'runs': 10, 'states': {'FINISHED': 7, 'FAILED': 1, 'TIMEOUT': 1, 'STOPPED': 1},
+                 'durations': {'0': 5, '2': 4}, 'duration_sum': 18.0, 'issues': 25,
+                 'rss_sum': 3000, 'rss_runs': 3}
+        summary = tasks.summarize_plugin_stats(stats)
+        self.assertEqual(summary['runs'], 10)
+        self.assertEqual(summary['states'], stats['states'])
+        self.assertEqual(summary['duration']['mean'], 2.0)
+        self.assertAlmostEqual(summary['duration']['p50'], 0.9)
+        self.assertAlmostEqual(summary['duration']['p95'], 2 + 3 * 3.55 / 4)
+        self.assertAlmostEqual(summary['duration']['p99'], 2 + 3 * 3.91 / 4)
+        self.assertAlmostEqual(summary['failure_rate'], 0.2)
+        self.assertAlmostEqual(summary['abort_rate'], 0.1)
+        self.assertEqual(summary['issues_per_run'], 2.5)
+        self.assertEqual(summary['rss'], 1000)
+
+    def test_summarize_plugin_stats_without_runs(self):
+        summary = tasks.summarize_plugin_stats({'class': 'minion.plugins.basic.HSTSPlugin'})
+        self.assertEqual(summary['runs'], 0)
+        self.assertEqual(summary['duration'], {'mean': None, 'p50': None, 'p95': None, 'p99': None})
+        self.assertEqual((summary['failure_rate'], summary['abort_rate'], summary['issues_per_run'], summary['rss']),
+                         (None, None, None, None))
+
+    def test_slowest_bucket_has_no_upper_bound(self):
+        summary = tasks.summarize_plugin_stats({'class': 'c', 'runs': 1, 'durations': {str(len(tasks.PLUGIN_DURATION_BUCKETS)): 1},
+                                                'duration_sum': 20000.0})
+        self.assertEqual(summary['duration']['p99'], tasks.PLUGIN_DURATION_BUCKETS[-1])
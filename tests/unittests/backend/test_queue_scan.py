@@ -0,0 +1,60 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import unittest
+import mongomock
+from mock import patch
+
+from minion.backend import tasks
+
+class TestQueueScan(unittest.TestCase):
+
+    def setUp(self):
+        self.db = mongomock.MongoClient().minion
+        self.patches = [patch.object(tasks, 'scans', self.db.scans),
+                        patch.object(tasks, 'scan_tenant', return_value='user:bob@example.org'),
+                        patch.object(tasks, 'record_event'),
+                        patch.object(tasks, 'refresh_latest_scan'),
+                        patch.object(tasks, 'schedule_scan')]
+        self.schedule_scan = [p.start() for p in self.patches][-1]
+
+    def tearDown(self):
+        for p in self.patches:
+            p.stop()
+
+    def _scan(self, state, schedule=None):
+        scan = {'id': 's', 'state': state, 'schedule': schedule,
+                'configuration': {'target': 'http://a'}, 'meta': {'user': 'bob@example.org'}}
+        self.db.scans.insert(dict(scan))
+        return scan
+
+    def test_queue_created_scan(self):
+        scan = self._scan('CREATED')
+        self.assertTrue(tasks.queue_scan(scan, 'scheduled'))
+        queued = self.db.scans.find_one({'id': 's'})
+        self.assertEqual(queued['state'], 'QUEUED')
+        self.assertEqual(queued['schedule']['priority'], 'scheduled')
+        self.assertEqual(self.schedule_scan.apply_async.call_count, 1)
+
+    def test_queue_scan_twice(self):
+        # A campaign and a request both found the scan CREATED
+        scan = self._scan('CREATED')
+        self.assertTrue(tasks.queue_scan(scan))
+        self.db.scans.update({'id': 's'}, {'$set': {'schedule.dispatched': 1}})
+        self.assertFalse(tasks.queue_scan(scan))
+        # The scan keeps its schedule, so it is not dispatched again
+        self.assertEqual(self.db.scans.find_one({'id': 's'})['schedule']['dispatched'], 1)
+        self.assertEqual(self.schedule_scan.apply_async.call_count, 1)
+
+    def test_queue_coalesced_scan(self):
+        # A scan that was coalesced is QUEUED but was never scheduled
+        scan = self._scan('QUEUED')
+        self.assertTrue(tasks.queue_scan(scan))
+        self.assertNotEqual(self.db.scans.find_one({'id': 's'})['schedule'], None)
+
+    def test_queue_started_scan(self):
+        scan = self._scan('STARTED', tasks.new_schedule('user:bob@example.org'))
+        self.assertFalse(tasks.queue_scan(scan))
+        self.assertEqual(self.db.scans.find_one({'id': 's'})['state'], 'STARTED')
+        self.assertFalse(self.schedule_scan.apply_async.called)
@@ -0,0 +1,64 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import os
+import shutil
+import tempfile
+import unittest
+from mock import patch
+
+from minion.backend.registry import PluginRegistry
+from minion.plugins.test import HelloWorldPlugin
+
+class TestPluginRegistry(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.manifest_path = os.path.join(self.directory, 'plugin-manifest.json')
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_discover_plugins(self):
+        registry = PluginRegistry(self.manifest_path)
+        descriptor = registry.descriptor('minion.plugins.test.HelloWorldPlugin')
+        self.assertEqual(descriptor, {'class': 'minion.plugins.test.HelloWorldPlugin',
+                                      'name': 'HelloWorldPlugin',
+                                      'version': '0.0',
+                                      'weight': 'heavy',
+                                      'inputs': None})
+        self.assertTrue('minion.plugins.base.BlockingPlugin' not in registry)
+        self.assertTrue(os.path.exists(self.manifest_path))
+
+    def test_use_manifest(self):
+        descriptors = PluginRegistry(self.manifest_path).descriptors()
+        with patch.object(PluginRegistry, '_discover') as discover:
+            registry = PluginRegistry(self.manifest_path)
+            self.assertEqual(sorted(registry.descriptors()), sorted(descriptors))
+            self.assertFalse(discover.called)
+
+    def test_rebuild_stale_manifest(self):
+        PluginRegistry(self.manifest_path).descriptors()
+        with patch.object(PluginRegistry, '_sources') as sources:
+            sources.return_value = ['minion.plugins.new.NewPlugin = minion.plugins.new:NewPlugin (new 1.0)']
+            with patch.object(PluginRegistry, '_discover') as discover:
+                discover.return_value = {}
+                registry = PluginRegistry(self.manifest_path)
+                self.assertEqual(registry.descriptors(), [])
+                self.assertTrue(discover.called)
+
+    def test_load_class(self):
+        PluginRegistry(self.manifest_path).descriptors()
+        registry = PluginRegistry(self.manifest_path)
+        self.assertEqual(registry.load_class('minion.plugins.test.HelloWorldPlugin'), HelloWorldPlugin)
+        self.assertRaises(KeyError, registry.load_class, 'minion.plugins.test.NoSuchPlugin')
+
+    def test_revision(self):
+        registry = PluginRegistry(self.manifest_path)
+        revision = registry.revision()
+        self.assertEqual(PluginRegistry(self.manifest_path).revision(), revision)
+        with patch.object(PluginRegistry, '_load') as load:
+            load.return_value = {}
+            registry.refresh()
+            self.assertNotEqual(registry.revision(), revision)
@@ -0,0 +1,84 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import datetime
+import unittest
+import mongomock
+from mock import patch
+
+from minion.backend import tasks
+
+class TestRollups(unittest.TestCase):
+
+    def test_rollup_field(self):
+        for code in ('XFO-2', 'X.1', '$where', '100%', '%2E', 'a.$b%24'):
+            field = tasks.rollup_field(code)
+            self.assertNotIn('.', field)
+            self.assertFalse(field.startswith('$'))
+            self.assertEqual(tasks.rollup_code(field), code)
+
+    def _update(self, previous, other_plans):
+        scan = {'id': 's', 'finished': datetime.datetime(2013, 6, 1, 12), 'compacted': True,
+                'issue_codes': ['X.1'], 'issues': {'high': 1},
+                'configuration': {'target': 'http://a'}, 'plan': {'name': 'basic'}}
+        with patch.object(tasks, 'rollups') as rollups:
+            with patch.object(tasks, 'find_rollup', return_value=previous):
+                with patch.object(tasks, '_inc_rollup') as inc_rollup:
+                    rollups.find_one.return_value = {'_id': 1} if other_plans else None
+                    tasks.update_rollups(scan)
+        self.assertEqual(rollups.update.call_args[0][0], {'scope': 'site', 'key': 'http://a basic', 'day': '2013-06-01'})
+        self.assertEqual(rollups.update.call_args[0][1]['$set']['codes'], {'X%2E1': 1})
+        return inc_rollup.call_args[0]
+
+    def test_first_scan_of_site(self):
+        scope, key, day, delta = self._update(None, False)
+        self.assertEqual((scope, key, day), ('global', '', '2013-06-01'))
+        self.assertEqual(delta['sites'], 1)
+        self.assertEqual(delta['codes'], {'X%2E1': 1})
+        self.assertEqual(delta['issues']['high'], 1)
+
+    def test_first_scan_with_another_plan(self):
+        scope, key, day, delta = self._update(None, True)
+        self.assertEqual(delta['sites'], 0)
+
+    def test_next_scan(self):
+        previous = {'issues': {'high': 2, 'medium': 0, 'low': 0, 'info': 0}, 'codes': {'X%2E1': 1, 'Y': 1}, 'sites': 1}
+        scope, key, day, delta = self._update(previous, True)
+        self.assertEqual(delta['sites'], 0)
+        self.assertEqual(delta['codes'], {'X%2E1': 0, 'Y': -1})
+        self.assertEqual(delta['issues']['high'], -1)
+
+class Rollups(object):
+    """ A mongomock collection that returns the results of aggregations
+    in a document, like pymongo 2 does. """
+
+    def __init__(self):
+        self.collection = mongomock.MongoClient().minion.rollups
+
+    def __getattr__(self, name):
+        return getattr(self.collection, name)
+
+    def aggregate(self, pipeline):
+        return {'ok': 1.0, 'result': list(self.collection.aggregate(pipeline))}
+
+class TestFindRollups(unittest.TestCase):
+
+    def test_find_rollups(self):
+        rollups = Rollups()
+        for key, day, high in (('http://a basic', '2013-06-01', 1),
+                               ('http://a basic', '2013-06-03', 2),
+                               ('http://a basic', '2013-06-05', 3),
+                               ('http://b basic', '2013-06-02', 4),
+                               ('http://c basic', '2013-06-04', 5),
+                               ('http://d basic', '2013-06-01', 6)):
+            rollups.insert({'scope': 'site', 'key': key, 'day': day, 'issues': {'high': high}, 'codes': {}, 'sites': 1})
+        rollups.insert({'scope': 'global', 'key': '', 'day': '2013-06-01', 'issues': {'high': 7}, 'codes': {}, 'sites': 1})
+        with patch.object(tasks, 'rollups', rollups):
+            found = tasks.find_rollups('site', ['http://a basic', 'http://b basic', 'http://c basic'], '2013-06-04')
+            # The last rollup on or before the day, like find_rollup
+            self.assertEqual(dict((key, rollup['issues']['high']) for key, rollup in found.iteritems()),
+                             {'http://a basic': 2, 'http://b basic': 4, 'http://c basic': 5})
+            for key, rollup in found.iteritems():
+                self.assertEqual(rollup['day'], tasks.find_rollup('site', key, '2013-06-04')['day'])
+            self.assertEqual(tasks.find_rollups('site', ['http://c basic'], '2013-06-03'), {})
@@ -0,0 +1,151 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import datetime
+import unittest
+from mock import patch
+
+from minion.backend import tasks
+
+# A Tuesday
+NOW = datetime.datetime(2013, 10, 1, 4, 30)
+
+class TestParseCron(unittest.TestCase):
+
+    def test_sunday_is_0_and_7(self):
+        self.assertEqual(tasks.parse_cron('0 0 * * 7').day_of_week, set([0]))
+        self.assertEqual(tasks.parse_cron('0 0 * * 0,7').day_of_week, set([0]))
+        self.assertEqual(tasks.parse_cron('0 0 * * 5-7').day_of_week, set([0, 5, 6]))
+        self.assertEqual(tasks.parse_cron('0 0 * * sat-sun').day_of_week, set([0, 6]))
+        self.assertEqual(tasks.parse_cron('0 0 * * *').day_of_week, set(range(7)))
+
+    def test_invalid_expressions(self):
+        for expression in ('0 0 * *', '0 0 * * * *', '0 0 * * 8', '60 0 * * *'):
+            self.assertRaises(ValueError, tasks.parse_cron, expression)
+
+class TestNextCronTime(unittest.TestCase):
+
+    def _next(self, expression, after):
+        return tasks.next_cron_time(tasks.parse_cron(expression), after)
+
+    def test_later_today(self):
+        self.assertEqual(self._next('30 5 * * *', NOW), datetime.datetime(2013, 10, 1, 5, 30))
+
+    def test_tomorrow(self):
+        self.assertEqual(self._next('30 2 * * *', NOW), datetime.datetime(2013, 10, 2, 2, 30))
+
+    def test_strictly_after(self):
+        self.assertEqual(self._next('30 4 * * *', NOW), datetime.datetime(2013, 10, 2, 4, 30))
+        self.assertEqual(self._next('*/15 * * * *', NOW), datetime.datetime(2013, 10, 1, 4, 45))
+
+    def test_day_of_week(self):
+        self.assertEqual(self._next('0 12 * * 7', NOW), datetime.datetime(2013, 10, 6, 12, 0))
+        self.assertEqual(self._next('0 12 * * mon', NOW), datetime.datetime(2013, 10, 7, 12, 0))
+
+    def test_leap_day(self):
+        self.assertEqual(self._next('0 0 29 2 *', NOW), datetime.datetime(2016, 2, 29, 0, 0))
+
+    def test_never(self):
+        self.assertEqual(self._next('0 0 30 2 *', NOW), None)
+
+class TestNextSlot(unittest.TestCase):
+
+    SCHEDULE = {'id': 's', 'created': datetime.datetime(2013, 10, 1), 'interval': 3600, 'cron': None}
+
+    def test_interval(self):
+        self.assertEqual(tasks.next_slot(self.SCHEDULE, NOW), datetime.datetime(2013, 10, 1, 5))
+        self.assertEqual(tasks.next_slot(self.SCHEDULE, datetime.datetime(2013, 10, 1, 5)), datetime.datetime(2013, 10, 1, 6))
+        self.assertEqual(tasks.next_slot(self.SCHEDULE, datetime.datetime(2013, 10, 1)), datetime.datetime(2013, 10, 1, 1))
+
+    def test_cron(self):
+        schedule = dict(self.SCHEDULE, interval=None, cron='0 3 * * *')
+        self.assertEqual(tasks.next_slot(schedule, NOW), datetime.datetime(2013, 10, 2, 3))
+
+class TestScheduleOffset(unittest.TestCase):
+
+    def test_without_jitter(self):
+        self.assertEqual(tasks.schedule_offset({'id': 's', 'jitter': 0}), datetime.timedelta(0))
+
+    def test_offset_is_stable_and_within_jitter(self):
+        offsets = [tasks.schedule_offset({'id': str(i), 'jitter': 600}) for i in range(50)]
+        self.assertEqual(offsets, [tasks.schedule_offset({'id': str(i), 'jitter': 600}) for i in range(50)])
+        self.assertTrue(all(datetime.timedelta(0) <= offset < datetime.timedelta(seconds=600) for offset in offsets))
+        self.assertTrue(len(set(offsets)) > 1)
+
+    def test_jitter_is_at_most_the_interval(self):
+        for i in range(50):
+            self.assertTrue(tasks.schedule_offset({'id': str(i), 'jitter': 600, 'interval': 60}) < datetime.timedelta(seconds=60))
+
+    def test_jitter_below_one_second(self):
+        self.assertEqual(tasks.schedule_offset({'id': 's', 'jitter': 0.5}), datetime.timedelta(0))
+
+    def test_default_jitter(self):
+        with patch.object(tasks, 'schedules_policy', return_value={'jitter': 0}):
+            self.assertEqual(tasks.schedule_offset({'id': 's', 'jitter': None}), datetime.timedelta(0))
+
+class TestRunScanSchedule(unittest.TestCase):
+
+    # Last ran at 01:00, the state worker was not running until 04:30
+    SCHEDULE = {'id': 's', 'target': 'http://a', 'plan': 'basic', 'user': 'bob@example.org',
+                'created': datetime.datetime(2013, 10, 1), 'interval': 3600, 'cron': None, 'jitter': 0,
+                'smart_rescan': None, 'enabled': True,
+                'slot': datetime.datetime(2013, 10, 1, 1), 'next_run': datetime.datetime(2013, 10, 1, 1)}
+
+    def setUp(self):
+        self.patches = [patch.object(tasks, name) for name in ('scan_schedules', 'scans', 'plans', 'plan_sessions',
+                                                               'update_latest_scan', 'queue_scan')]
+        (self.scan_schedules, self.scans, self.plans, self.plan_sessions,
+         self.update_latest_scan, self.queue_scan) = [p.start() for p in self.patches]
+        self.scan_schedules.find_and_modify.return_value = self.SCHEDULE
+        self.scans.find_one.return_value = None
+        self.plans.find_one.return_value = {'name': 'basic', 'workflow': []}
+        self.plan_sessions.return_value = []
+
+    def tearDown(self):
+        for p in self.patches:
+            p.stop()
+
+    def test_missed_runs_are_coalesced(self):
+        tasks.run_scan_schedule(self.SCHEDULE, NOW)
+        # The slots at 02:00, 03:00 and 04:00 were missed, the next one is at 05:00
+        self.scan_schedules.find_and_modify.assert_called_once_with(
+            {'id': 's', 'next_run': datetime.datetime(2013, 10, 1, 1)},
+            {'$set': {'slot': datetime.datetime(2013, 10, 1, 5), 'next_run': datetime.datetime(2013, 10, 1, 5)},
+             '$inc': {'missed': 3}})
+        # But only one scan is started
+        self.assertEqual(self.scans.insert.call_count, 1)
+        scan = self.scans.insert.call_args[0][0]
+        self.assertEqual(scan['configuration'], {'target': 'http://a'})
+        self.assertEqual(scan['meta']['schedule'], 's')
+        self.queue_scan.assert_called_once_with(scan, 'scheduled')
+        self.assertEqual(self.scan_schedules.update.call_args[0][1],
+                         {'$set': {'last_run': NOW, 'last_scan': scan['id']}})
+
+    def test_run_on_time(self):
+        tasks.run_scan_schedule(dict(self.SCHEDULE, slot=datetime.datetime(2013, 10, 1, 4),
+                                     next_run=datetime.datetime(2013, 10, 1, 4)), NOW)
+        self.assertEqual(self.scan_schedules.find_and_modify.call_args[0][1]['$inc'], {'missed': 0})
+        self.assertEqual(self.scans.insert.call_count, 1)
+
+    def test_claimed_by_another_worker(self):
+        self.scan_schedules.find_and_modify.return_value = None
+        tasks.run_scan_schedule(self.SCHEDULE, NOW)
+        self.assertFalse(self.scans.find_one.called)
+        self.assertFalse(self.scans.insert.called)
+        self.assertFalse(self.scan_schedules.update.called)
+
+    def test_skipped_while_a_scan_is_running(self):
+        self.scans.find_one.return_value = {'id': 'r'}
+        tasks.run_scan_schedule(self.SCHEDULE, NOW)
+        self.assertEqual(self.scans.find_one.call_args[0][0],
+                         {'configuration.target': 'http://a', 'plan.name': 'basic',
+                          'state': {'$in': ['QUEUED', 'STARTED', 'STOPPING']}})
+        self.scan_schedules.update.assert_called_once_with({'id': 's'}, {'$inc': {'skipped': 1}})
+        self.assertFalse(self.scans.insert.called)
+        # The schedule still moves on to its next slot
+        self.assertEqual(self.scan_schedules.find_and_modify.call_count, 1)
+
+    def test_smart_rescan(self):
+        tasks.run_scan_schedule(dict(self.SCHEDULE, smart_rescan=False), NOW)
+        self.assertEqual(self.scans.insert.call_args[0][0]['smart_rescan'], False)
@@ -0,0 +1,43 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import unittest
+
+from minion.backend import tasks
+
+TIMESTAMPS = {'queued': 100.0,
+              'received': 100.5,
+              'fetched': 100.75,
+              'spawning': 101.0,
+              'spawned': 101.25,
+              'imported': 102.0,
+              'configured': 102.5,
+              'started': 103.0,
+              'first_issue': 110.0,
+              'finished': 120.0}
+
+class TestSessionTimings(unittest.TestCase):
+
+    def test_session_timings(self):
+        self.assertEqual(tasks.session_timings(TIMESTAMPS, 0.1234),
+                         {'broker_wait': 0.5,
+                          'api_fetch': 0.25,
+                          'spawn': 0.25,
+                          'import': 0.75,
+                          'configure': 0.5,
+                          'first_issue': 7.0,
+                          'run': 17.0,
+                          'persist': 0.123})
+
+    def test_missing_timestamps(self):
+        # A plugin without issues, and a runner that failed before it was configured
+        timestamps = dict(TIMESTAMPS, first_issue=None)
+        self.assertNotIn('first_issue', tasks.session_timings(timestamps, 0))
+        timestamps = dict((k, v) for k, v in TIMESTAMPS.iteritems() if k in ('queued', 'received', 'imported', 'finished'))
+        self.assertEqual(tasks.session_timings(timestamps, 0), {'broker_wait': 0.5, 'persist': 0})
+
+    def test_clock_skew(self):
+        # The timestamps come from different machines
+        timings = tasks.session_timings(dict(TIMESTAMPS, received=99.0), 0)
+        self.assertEqual(timings['broker_wait'], 0.0)
@@ -0,0 +1,123 @@
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this
+# file, You can obtain one at http://mozilla.org/MPL/2.0/.
+
+import copy
+import unittest
+from mock import MagicMock, patch
+from pymongo.errors import DuplicateKeyError
+
+import minion.curly
+from minion.limiter import HostLimiter, LimitTimeout
+
+class HostCollection(object):
+
+    """ Just enough of a collection for the limiter """
+
+    def __init__(self):
+        self.docs = {}
+
+    def find_one(self, spec):
+        return copy.deepcopy(self.docs.get(spec['host']))
+
+    def insert(self, doc):
+        if doc['host'] in self.docs:
+            raise DuplicateKeyError("duplicate host")
+        self.docs[doc['host']] = copy.deepcopy(doc)
+
+    def update(self, spec, document):
+        doc = self.docs.get(spec['host'])
+        if doc is None or doc.get('version') != spec.get('version', doc.get('version')):
+            return {'n': 0}
+        doc.update(document.get('$set', {}))
+        for field, n in document.get('$inc', {}).items():
+            doc[field] = doc.get(field, 0) + n
+        for field, match in document.get('$pull', {}).items():
+            doc[field] = [l for l in doc.get(field, []) if l['id'] != match['id']]
+        return {'n': 1}
+
+class Clock(object):
+
+    def __init__(self):
+        self.now = 1000.0
+
+    def time(self):
+        return self.now
+
+    def sleep(self, seconds):
+        self.now += seconds
+
+class TestHostLimiter(unittest.TestCase):
+
+    def setUp(self):
+        self.collection = HostCollection()
+        self.clock = Clock()
+        self._time = patch('minion.limiter.time', self.clock)
+        self._time.start()
+
+    def tearDown(self):
+        self._time.stop()
+
+    def test_rate(self):
+        limiter = HostLimiter(self.collection, {'rate': 2.0, 'burst': 2, 'concurrency': 10})
+        for i in range(2):
+            limiter.release('example.com', limiter.acquire('example.com'))
+        self.assertEqual(self.clock.now, 1000.0)
+        limiter.acquire('example.com')
+        self.assertAlmostEqual(self.clock.now, 1000.5)
+
+    def test_concurrency(self):
+        limiter = HostLimiter(self.collection, {'concurrency': 1, 'wait': 5})
+        lease = limiter.acquire('example.com')
+        self.assertRaises(LimitTimeout, limiter.acquire, 'example.com')
+        limiter.release('example.com', lease)
+        limiter.acquire('example.com')
+
+    def test_expired_lease(self):
+        limiter = HostLimiter(self.collection, {'concurrency': 1, 'lease': 10, 'wait': 60})
+        limiter.acquire('example.com')
+        limiter.acquire('example.com')
+        self.assertTrue(self.clock.now >= 1010.0)
+
+    def test_site_limits(self):
+        self.collection.insert({'host': 'example.com', 'concurrency': 2, 'rate': None})
+        limiter = HostLimiter(self.collection, {'concurrency': 1, 'wait': 5})
+        limiter.acquire('example.com')
+        limiter.acquire('example.com')
+        self.assertRaises(LimitTimeout, limiter.acquire, 'example.com')
+        with limiter.request('http://other.example.com/robots.txt'):
+            self.assertEqual(len(self.collection.docs['other.example.com']['leases']), 1)
+        self.assertEqual(self.collection.docs['other.example.com']['leases'], [])
+
+    def test_lease_covers_request_timeout(self):
+        limiter = HostLimiter(self.collection, {'concurrency': 1, 'lease': 10, 'wait': 60})
+        limiter.acquire('example.com', 30)
+        limiter.acquire('example.com')
+        self.assertTrue(self.clock.now >= 1030.0)
+
+class TestCurlyLimits(unittest.TestCase):
+
+    def setUp(self):
+        self.limiter = MagicMock()
+        self.limiter.limits = {'lease': 120}
+        self._limiter = patch('minion.curly.host_limiter', return_value=self.limiter)
+        self._limiter.start()
+        self.curl = MagicMock()
+
+    def tearDown(self):
+        self._limiter.stop()
+
+    def test_request_ends_before_its_lease(self):
+        minion.curly._get(self.curl, 'http://example.com/')
+        self.curl.setopt.assert_any_call(minion.curly.pycurl.TIMEOUT, 120)
+        self.limiter.request.assert_called_once_with('http://example.com/', None)
+        minion.curly._get(self.curl, 'http://example.com/', connect_timeout=10, timeout=300)
+        self.limiter.request.assert_called_with('http://example.com/', 300)
+
+    def test_limit_timeout_is_a_curly_error(self):
+        self.limiter.request.side_effect = LimitTimeout('example.com')
+        with self.assertRaises(minion.curly.CurlyError) as cm:
+            minion.curly._get(self.curl, 'http://example.com/')
+        self.assertEqual(cm.exception.host, 'example.com')
+        self.assertEqual(cm.exception.issue['Severity'], 'Error')
+        self.assertFalse(self.curl.perform.called)